@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Compares the twisted and the asyncio serving engine.
+
+For every engine, fakednsproxy.py is started with a default_value config
+and queried over UDP from this process, keeping a fixed number of queries
+in flight. The script prints the throughput and latency percentiles for
+each engine.
+
+    python3 benchmarks/bench_engines.py [--queries N] [--window W] [--fast-path]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.names import dns
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CONFIG_TEMPLATE = """
+engine: {engine}
+fast_path: {fast_path}
+listening_info:
+  ip: 127.0.0.1
+  port: {port}
+dns_server:
+  ip: 127.0.0.1
+  port: 53
+default_dns_policy: default_value
+default_dns_value: 127.0.0.1
+"""
+
+
+def buildQueries(count):
+    queries = []
+    for i in range(count):
+        m = dns.Message(id=i % 65536, recDes=1)
+        m.addQuery('host{}.example.com'.format(i).encode(), dns.A)
+        queries.append(m.toStr())
+    return queries
+
+
+def waitForServer(sock, address, timeout=10):
+    probe = buildQueries(1)[0]
+    sock.settimeout(0.2)
+    end = time.time() + timeout
+    while time.time() < end:
+        sock.sendto(probe, address)
+        try:
+            sock.recv(4096)
+            return
+        except socket.timeout:
+            pass
+    raise RuntimeError("fakednsproxy did not start")
+
+
+def runLoad(sock, address, queries, window):
+    sock.settimeout(2)
+    latencies = []
+    sent_at = {}
+    next_query = 0
+    start = time.perf_counter()
+    while next_query < len(queries) or sent_at:
+        while next_query < len(queries) and len(sent_at) < window:
+            data = queries[next_query]
+            sent_at[data[:2]] = time.perf_counter()
+            sock.sendto(data, address)
+            next_query += 1
+        try:
+            reply = sock.recv(4096)
+        except socket.timeout:
+            # lost packets are not retried, they are left out of the results
+            sent_at.clear()
+            continue
+        sent = sent_at.pop(reply[:2], None)
+        if sent is not None:
+            latencies.append(time.perf_counter() - sent)
+    return time.perf_counter() - start, latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def benchmark(engine, port, queries, window, fast_path=False):
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        f.write(CONFIG_TEMPLATE.format(engine=engine, port=port,
+                                       fast_path='true' if fast_path else 'false'))
+        config_file = f.name
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(ROOT, 'fakednsproxy.py'),
+                             config_file],
+                            stdout=subprocess.DEVNULL)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ('127.0.0.1', port)
+    try:
+        waitForServer(sock, address)
+        duration, latencies = runLoad(sock, address, queries, window)
+    finally:
+        sock.close()
+        proc.terminate()
+        proc.wait()
+        os.unlink(config_file)
+
+    print("{:8} {:6d} answers in {:6.2f}s  {:8.0f} qps  "
+          "p50 {:6.2f}ms  p99 {:6.2f}ms".format(
+              engine, len(latencies), duration, len(latencies) / duration,
+              percentile(latencies, 50) * 1000,
+              percentile(latencies, 99) * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--window', type=int, default=32)
+    parser.add_argument('--port', type=int, default=20053)
+    parser.add_argument('--fast-path', action='store_true')
+    args = parser.parse_args()
+
+    queries = buildQueries(args.queries)
+    for engine in ['twisted', 'asyncio']:
+        benchmark(engine, args.port, queries, args.window, args.fast_path)
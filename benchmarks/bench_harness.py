@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of FakeDnsProxy without sockets.
+
+The queries are handed to the DNS protocol of an in-memory harness (see
+core.harness), so the numbers only contain the work of FakeDnsProxy
+itself: parsing, the policy, generating or forwarding the answer, logging
+and encoding the reply. Forwarded queries are answered by a fake upstream.
+The script prints the queries per second for every scenario.
+
+    python3 benchmarks/bench_harness.py [--queries N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from twisted.names import dns
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from core.harness import Harness
+
+
+SCENARIOS = [
+    ('default_value', { 'default_dns_policy': 'default_value',
+                        'default_dns_value': '127.0.0.1' }, False),
+    ('fast_path', { 'default_dns_policy': 'default_value',
+                    'default_dns_value': '127.0.0.1' }, True),
+    ('forward', { 'default_dns_policy': 'forward',
+                  'dns_server': { 'ip': '192.0.2.53', 'port': 53 } }, False),
+    ('forward_cache', { 'default_dns_policy': 'forward',
+                        'dns_server': { 'ip': '192.0.2.53', 'port': 53 },
+                        'forward_cache': {} }, False),
+]
+
+
+def benchmark(name, config, fast_path, count):
+    harness = Harness(config, fast_path=fast_path)
+    # forward_cache queries repeat a few names, so that most are cache hits
+    names = ['host{}.example.com'.format(i % (100 if name == 'forward_cache'
+                                              else count))
+             for i in range(count)]
+    for n in set(names):
+        harness.upstream.setAnswer(n, dns.A, [dns.Record_A('10.0.0.1')])
+    queries = [harness.buildQuery(n) for n in names]
+    start = time.perf_counter()
+    for data in queries:
+        harness.send(data)
+    duration = time.perf_counter() - start
+    print("{:14} {:6d} answers in {:6.2f}s  {:8.0f} qps".format(
+              name, len(harness.replies), duration, count / duration))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, config, fast_path in SCENARIOS:
+        benchmark(name, config, fast_path, args.queries)
@@ -0,0 +1,235 @@
+"""
+Admin socket of FakeDnsProxy
+
+The admin socket is a Unix domain socket that accepts one command per line.
+Every command is answered with its output, followed by a line with OK, or
+by a single line starting with ERROR.
+"""
+
+import json
+
+import yaml
+
+from twisted.internet import protocol
+from twisted.protocols import basic
+
+import core.config
+import core.dns_reply_generators
+
+
+HELP = [
+    'add <domain> <value>     add or replace the rule for domain',
+    'remove <domain>          remove the rule for domain',
+    'list                     list all rules',
+    'policy <policy> [value]  set default_dns_policy (and default_dns_value)',
+    'flush                    flush the forward_cache',
+    'stats                    show counters',
+    'top [k]                  show the heavy hitters',
+    'stalls                   show the last stalls of the reactor',
+    'memory                   show the memory of the configuration and caches',
+    'save                     write the configuration to persist_file',
+    'quit                     close the connection',
+]
+
+
+def formatValue(value):
+    """
+    Formats a value of domain_config so that it can be passed to add again.
+    """
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+class AdminController:
+    """
+    Executes the admin commands on the configuration of a DNSHandler. Rule
+    changes are applied to the live DomainMatcher of the global config, so
+    they take effect with the next query. The domain_config of views is not
+    changed by the admin commands.
+
+    If persist_file is set, the configuration is written to it after every
+    change.
+    """
+    def __init__(self, dns_handler, persist_file=None, watchdog=None,
+                 udp_monitor=None, memory_monitor=None):
+        self.dns_handler = dns_handler
+        self.config = dns_handler.config
+        self.persist_file = persist_file
+        self.watchdog = watchdog
+        self.udp_monitor = udp_monitor
+        self.memory_monitor = memory_monitor
+
+    def execute(self, line):
+        """
+        Executes a command line and returns the lines of its output. Raises
+        a RuntimeError if the command fails.
+        """
+        parts = line.split(None, 1)
+        if not parts:
+            return []
+        command = parts[0].lower()
+        args = parts[1] if len(parts) > 1 else ''
+        handler = getattr(self, 'command_' + command, None)
+        if handler is None:
+            raise RuntimeError("ERROR: unknown command {}, try help".format(command))
+        return handler(args)
+
+    def parseValue(self, text):
+        try:
+            value = yaml.safe_load(text)
+        except yaml.YAMLError:
+            raise RuntimeError("ERROR: could not parse value {}".format(text))
+        if value is None:
+            raise RuntimeError("ERROR: {} is not a valid value".format(text))
+        return value
+
+    def getMatcher(self):
+        if not 'domain_config' in self.config:
+            self.config['domain_config'] = dict()
+        gen = core.dns_reply_generators.DNSReplyGenerator(self.config)
+        return gen.getDomainMatcher()
+
+    def configChanged(self):
+        if self.persist_file is not None:
+            self.config.write_config(self.persist_file)
+
+    def command_help(self, args):
+        return list(HELP)
+
+    def command_add(self, args):
+        parts = args.split(None, 1)
+        if len(parts) != 2:
+            raise RuntimeError("ERROR: usage: add <domain> <value>")
+        domain, value = parts[0], self.parseValue(parts[1])
+        try:
+            answer = core.config.DNSAnswerConfig(value)
+        except RuntimeError as e:
+            raise RuntimeError("ERROR: {}".format(e))
+        self.getMatcher().add(domain, answer)
+        self.configChanged()
+        return []
+
+    def command_remove(self, args):
+        domain = args.strip()
+        try:
+            self.getMatcher().remove(domain)
+        except KeyError:
+            raise RuntimeError("ERROR: there is no rule for {}".format(domain))
+        self.configChanged()
+        return []
+
+    def command_list(self, args):
+        if not 'domain_config' in self.config:
+            return []
+        return ['{} {}'.format(domain, formatValue(value.toValue()))
+                for domain, value in self.config['domain_config'].items()]
+
+    def command_policy(self, args):
+        parts = args.split(None, 1)
+        policies = core.config.DNSForwardPolicies()
+        if not parts:
+            return [self.config['default_dns_policy']]
+        policy = parts[0]
+        if not policies.is_valid_policy(policy):
+            raise RuntimeError("ERROR: policy must be one of {}".format(
+                               ','.join(policies.get_valid_policies())))
+        value = None
+        if len(parts) > 1:
+            try:
+                value = core.config.DNSAnswerConfig(self.parseValue(parts[1]))
+            except RuntimeError as e:
+                raise RuntimeError("ERROR: {}".format(e))
+        elif policy == 'default_value' and not 'default_dns_value' in self.config:
+            raise RuntimeError('ERROR: "default_dns_value" required if '
+                               'default_dns_policy is "default_value"')
+        if value is not None:
+            self.config['default_dns_value'] = value
+        self.config['default_dns_policy'] = policy
+        self.configChanged()
+        return []
+
+    def command_flush(self, args):
+        cache = self.dns_handler.forward_cache
+        if cache is None:
+            return ['flushed 0 entries']
+        count = len(cache)
+        cache.flush()
+        return ['flushed {} entries'.format(count)]
+
+    def command_stats(self, args):
+        handler = self.dns_handler
+        result = ['rules {}'.format(len(self.config['domain_config'])
+                                    if 'domain_config' in self.config else 0),
+                  'default_dns_policy {}'.format(self.config['default_dns_policy'])]
+        result.append('nxdomain_answers {}'.format(handler.nxdomain_answers))
+        result.append('nodata_answers {}'.format(handler.nodata_answers))
+        if handler.forward_cache is not None:
+            result.append('forward_cache_entries {}'.format(len(handler.forward_cache)))
+        if hasattr(handler.resolver, 'hedged'):
+            result.append('hedged {}'.format(handler.resolver.hedged))
+            result.append('hedge_wins {}'.format(handler.resolver.hedge_wins))
+        if handler.forward_limiter is not None:
+            result.extend('{} {}'.format(name, value)
+                          for name, value in handler.forward_limiter.getStats())
+        if handler.answer_policy is not None:
+            result.extend('{} {}'.format(name, value)
+                          for name, value in handler.answer_policy.getStats())
+        if handler.heavy_hitters is not None:
+            result.append('queries {}'.format(handler.heavy_hitters.qnames.total))
+        for source in [self.watchdog, self.udp_monitor, self.memory_monitor]:
+            if source is not None:
+                result.extend('{} {}'.format(name, value)
+                              for name, value in source.getStats())
+        return result
+
+    def command_top(self, args):
+        if self.dns_handler.heavy_hitters is None:
+            raise RuntimeError("ERROR: heavy_hitters are not enabled")
+        try:
+            k = int(args) if args.strip() else 10
+        except ValueError:
+            raise RuntimeError("ERROR: usage: top [k]")
+        return self.dns_handler.heavy_hitters.getLogMessages(k)
+
+    def command_stalls(self, args):
+        if self.watchdog is None:
+            raise RuntimeError("ERROR: the watchdog is not enabled")
+        result = []
+        for message in self.watchdog.getStallMessages():
+            result.extend(message.split('\n'))
+        return result
+
+    def command_memory(self, args):
+        if self.memory_monitor is None:
+            raise RuntimeError("ERROR: memory is not enabled")
+        return self.memory_monitor.getReportMessages()
+
+    def command_save(self, args):
+        if self.persist_file is None:
+            raise RuntimeError("ERROR: no persist_file configured")
+        self.config.write_config(self.persist_file)
+        return []
+
+
+class AdminProtocol(basic.LineReceiver):
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        line = line.decode('utf-8', 'replace').strip()
+        if line.lower() == 'quit':
+            self.transport.loseConnection()
+            return
+        try:
+            output = self.factory.controller.execute(line) + ['OK']
+        except RuntimeError as e:
+            output = [str(e)]
+        for l in output:
+            self.sendLine(l.encode('utf-8'))
+
+
+class AdminFactory(protocol.Factory):
+    protocol = AdminProtocol
+
+    def __init__(self, controller):
+        self.controller = controller
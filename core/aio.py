@@ -0,0 +1,181 @@
+"""
+asyncio serving engine for FakeDnsProxy
+
+The asyncio engine runs twisted on top of an asyncio event loop (optionally
+provided by uvloop) and receives the DNS datagrams on an asyncio datagram
+endpoint instead of a twisted UDP port. The received messages are passed to
+the same CustomDNSServerFactory/DNSHandler as with the twisted engine, so all
+policy decisions and reply generators are shared between both engines.
+
+This module must not import twisted.internet.reactor, because
+installReactor() has to be called before the reactor is imported anywhere.
+"""
+
+import asyncio
+import socket
+
+from twisted.internet import defer
+from twisted.logger import Logger
+from twisted.names import dns
+
+
+# largest datagram read from the socket
+MAX_DATAGRAM_SIZE = 65535
+
+def installReactor(use_uvloop=True):
+    """
+    Installs the asyncio based twisted reactor. If use_uvloop is True and
+    uvloop is installed, the event loop is provided by uvloop.
+    """
+    if use_uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install(loop)
+
+
+def getEventLoop(reactor):
+    """
+    Returns the asyncio event loop the reactor runs on, or None if the
+    reactor is not asyncio based.
+    """
+    return getattr(reactor, '_asyncioEventloop', None)
+
+
+class AsyncioDNSProtocol(asyncio.DatagramProtocol):
+    """
+    Receives DNS queries on an asyncio datagram endpoint and hands them to
+    the controller, like twisted's DNSDatagramProtocol does. If a responder
+    (see core.fastpath) is given, it gets the first chance to answer.
+
+    asyncio reads one datagram per readiness event of the socket. If sock
+    is given, further datagrams are read from it right away, up to
+    max_read_bytes per event (like twisted's maxThroughput), which saves a
+    round through the event loop per datagram under load.
+    """
+    def __init__(self, controller, responder=None, sock=None,
+                 max_read_bytes=256 * 1024):
+        self.controller = controller
+        self.responder = responder
+        self.socket = sock
+        self.max_read_bytes = max_read_bytes
+        self.reading = True
+        self.transport = None
+        self.logger = Logger()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.handleDatagram(data, addr)
+        if self.socket is None:
+            return
+        read = len(data)
+        while self.reading and read < self.max_read_bytes:
+            try:
+                data, addr = self.socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except OSError:
+                # nothing left (BlockingIOError), or an error that the
+                # transport reports on its next read
+                return
+            read += len(data)
+            self.handleDatagram(data, addr)
+
+    def handleDatagram(self, data, addr):
+        if self.responder is not None:
+            response = self.responder.handleDatagram(data, addr,
+                                                     self.transport.sendto)
+            if response is not None:
+                return
+            try:
+                return self.decodeDatagram(data, addr)
+            finally:
+                # in case the datagram did not reach the controller
+                self.controller.fast_path_action = None
+        return self.decodeDatagram(data, addr)
+
+    def decodeDatagram(self, data, addr):
+        m = dns.Message()
+        try:
+            m.fromStr(data)
+        except EOFError:
+            self.logger.debug("Truncated packet ({n} bytes) from {addr}",
+                              n=len(data), addr=addr)
+            return
+        except Exception:
+            self.logger.failure("Unexpected decoding error")
+            return
+        if m.answer:
+            # we do not send queries from this endpoint
+            return
+        self.controller.messageReceived(m, self, addr)
+
+    def writeMessage(self, message, address):
+        self.transport.sendto(message.toStr(), address)
+
+
+class AsyncioUDPPort:
+    """
+    The listening asyncio datagram endpoint, with the parts of twisted's
+    IListeningPort that FakeDnsProxy uses.
+    """
+    def __init__(self, sock, protocol, loop=None):
+        self.socket = sock
+        self.protocol = protocol
+        self.loop = loop
+        self.addressFamily = sock.family
+
+    def getHost(self):
+        return self.socket.getsockname()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def stopReading(self):
+        """
+        Stops receiving datagrams, while replies can still be sent.
+        """
+        self.protocol.reading = False
+        transport = self.protocol.transport
+        if transport is not None and hasattr(transport, 'pause_reading'):
+            # not part of the DatagramTransport interface, but provided by
+            # the selector based transports of asyncio
+            transport.pause_reading()
+        else:
+            self.loop.remove_reader(self.socket.fileno())
+
+    def stopListening(self):
+        if self.protocol.transport is not None:
+            self.protocol.transport.close()
+        else:
+            self.socket.close()
+        return defer.succeed(None)
+
+
+def listenUDP(reactor, port, controller, interface='', responder=None,
+              sock=None, max_read_bytes=256 * 1024):
+    """
+    Binds a UDP socket and serves it from the asyncio event loop of the
+    reactor. The socket is bound right away, so that errors are raised to
+    the caller. If sock is given, that already bound socket is served
+    instead.
+    """
+    loop = getEventLoop(reactor)
+    if loop is None:
+        raise RuntimeError("ERROR: engine asyncio requires the asyncio reactor."
+                           " Call core.aio.installReactor() before the "
+                           "twisted reactor is imported.")
+    if sock is None:
+        family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.bind((interface, port))
+    sock.setblocking(False)
+    protocol = AsyncioDNSProtocol(controller, responder, sock=sock,
+                                  max_read_bytes=max_read_bytes)
+    loop.create_task(loop.create_datagram_endpoint(lambda: protocol, sock=sock))
+    return AsyncioUDPPort(sock, protocol, loop)
@@ -0,0 +1,139 @@
+"""
+Policy for the addresses in forwarded answers
+
+The answers that the dns_server (or the server of a domain rule) returns
+are checked against the networks of answer_policy before they are cached
+and sent to the client. A/AAAA records with an address in a network are
+dropped (e.g. private addresses in public names, against DNS rebinding) or
+rewritten to other addresses (sinkholing). AAAA records can also be
+stripped altogether, for labs without IPv6.
+"""
+
+from twisted.names import dns
+
+import core.prefixtree
+
+
+ACTIONS = ['drop', 'rewrite']
+
+
+class AnswerRule:
+    """
+    What happens to the records with an address in the networks of a rule.
+    For rewrite, the records are replaced by records with the addresses of
+    the rule of the same family; if there are none, they are dropped.
+    """
+    def __init__(self, settings):
+        self.action = settings['action']
+        self.addresses = { dns.A: [], dns.AAAA: [] }
+        for address in settings.get('addresses', []):
+            version, _ = core.prefixtree.parseAddress(address)
+            if version == 4:
+                self.addresses[dns.A].append(dns.Record_A(address))
+            else:
+                self.addresses[dns.AAAA].append(dns.Record_AAAA(address))
+
+    def apply(self, record):
+        """
+        Returns the records that replace record.
+        """
+        if self.action == 'drop':
+            return []
+        return [dns.RRHeader(name=record.name.name, type=record.type,
+                             cls=record.cls, ttl=record.ttl, payload=payload,
+                             auth=record.auth)
+                for payload in self.addresses[record.type]]
+
+
+class AnswerPolicy:
+    """
+    Applies the rules of answer_policy to forwarded responses. The networks
+    of all rules are compiled into one PrefixTree, so checking an address
+    costs one longest prefix match, independent of the number of networks.
+    If networks of several rules contain an address, the most specific
+    network wins.
+    """
+    def __init__(self, settings):
+        self.strip_aaaa = settings.get('strip_aaaa', False)
+        self.tree = core.prefixtree.PrefixTree()
+        for rule_settings in settings.get('rules', []):
+            rule = AnswerRule(rule_settings)
+            for network in rule_settings['networks']:
+                self.tree.insert(network, rule)
+        self.dropped = 0
+        self.rewritten = 0
+        self.stripped = 0
+
+    def findRule(self, record):
+        """
+        Returns the rule for the address of an A or AAAA record, or None.
+        """
+        value = int.from_bytes(record.payload.address, 'big')
+        if record.type == dns.A:
+            return self.tree.lookupInt(4, value)
+        if value >> 32 == 0xffff:
+            # IPv4-mapped IPv6 addresses are checked as IPv4 addresses
+            return self.tree.lookupInt(4, value & 0xffffffff)
+        return self.tree.lookupInt(6, value)
+
+    def filterRecords(self, records):
+        """
+        Returns the records after applying the rules, or records itself if
+        no rule applied. Several records rewritten to the same addresses
+        are replaced by one set of records.
+        """
+        result = None
+        # (name, type, address) of the records added by rewrites
+        rewrites = set()
+        for i, record in enumerate(records):
+            if record.type == dns.AAAA and self.strip_aaaa:
+                replacement = []
+                self.stripped += 1
+            elif record.type in (dns.A, dns.AAAA):
+                rule = self.findRule(record)
+                if rule is None:
+                    if result is not None:
+                        result.append(record)
+                    continue
+                replacement = rule.apply(record)
+                if replacement:
+                    self.rewritten += 1
+                else:
+                    self.dropped += 1
+            else:
+                if result is not None:
+                    result.append(record)
+                continue
+            if result is None:
+                result = list(records[:i])
+            for new in replacement:
+                key = (new.name.name, new.type, new.payload.address)
+                if not key in rewrites:
+                    rewrites.add(key)
+                    result.append(new)
+        return records if result is None else result
+
+    def filterResponse(self, response, qtype):
+        """
+        Returns the response after applying the rules to its answers and
+        additional records, the response itself if no rule applied, or None
+        if no answer of the query type qtype is left.
+        """
+        ans, auth, add = response
+        filtered_ans = self.filterRecords(ans)
+        filtered_add = self.filterRecords(add)
+        if filtered_ans is ans and filtered_add is add:
+            return response
+        if filtered_ans is not ans:
+            if qtype == dns.ALL_RECORDS:
+                left = bool(filtered_ans)
+            else:
+                left = any(r.type == qtype for r in filtered_ans)
+            if not left:
+                return None
+        return filtered_ans, auth, filtered_add
+
+    def getStats(self):
+        return [('answer_policy_dropped', self.dropped),
+                ('answer_policy_rewritten', self.rewritten),
+                ('answer_policy_stripped', self.stripped)]
@@ -0,0 +1,185 @@
+"""
+Caches used by FakeDnsProxy
+"""
+
+import collections
+import os
+import struct
+import time
+
+from twisted.internet import reactor
+from twisted.names import dns
+
+
+def copyRecords(records, ttl):
+    """
+    Returns copies of the given RRHeaders with their ttl replaced. ttl is
+    either an int, or a callable that takes the original ttl and returns
+    the new one.
+    """
+    result = []
+    for r in records:
+        new_ttl = ttl(r.ttl) if callable(ttl) else ttl
+        result.append(dns.RRHeader(name=r.name.name, type=r.type, cls=r.cls,
+                                   ttl=new_ttl, payload=r.payload,
+                                   auth=r.auth))
+    return result
+
+
+def encodeResponse(response):
+    """
+    Returns (answers, authority, additional) in DNS wire format. The
+    message is not limited to the 512 bytes of a UDP answer, so large
+    responses are stored completely.
+    """
+    ans, auth, add = response
+    m = dns.Message(maxSize=0)
+    m.answers = list(ans)
+    m.authority = list(auth)
+    m.additional = list(add)
+    return m.toStr()
+
+
+def decodeResponse(data):
+    m = dns.Message()
+    m.fromStr(data)
+    return m.answers, m.authority, m.additional
+
+
+SNAPSHOT_MAGIC = b'FDPS'
+SNAPSHOT_VERSION = 1
+# magic, version, number of entries
+SNAPSHOT_HEADER = struct.Struct('!4sII')
+# stored, expires, type, class, name length, data length
+SNAPSHOT_ENTRY = struct.Struct('!ddHHHI')
+
+
+class ForwardCacheEntry:
+    def __init__(self, response, stored, expires):
+        self.response = response
+        self.stored = stored
+        self.expires = expires
+
+
+class ForwardCache:
+    """
+    Stores the answers we received from the upstream dns_server. The entries
+    are kept after their TTL expired for max_stale_age seconds, so that they
+    can be served as stale answers (RFC 8767) when the upstream does not
+    answer in time.
+    """
+    def __init__(self, max_entries=10000, max_stale_age=0, clock=None):
+        self.max_entries = max_entries
+        self.max_stale_age = max_stale_age
+        self.clock = clock or reactor
+        self.entries = collections.OrderedDict()
+
+    def getKey(self, query):
+        return (query.name.name.lower(), query.type, query.cls)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def store(self, query, response):
+        ans, auth, add = response
+        ttls = [r.ttl for r in ans + auth + add]
+        if not ttls:
+            return
+        now = self.clock.seconds()
+        key = self.getKey(query)
+        self.entries[key] = ForwardCacheEntry(response, now, now + min(ttls))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, query):
+        """
+        Returns a tuple (response, is_stale) for the query, or None if there
+        is no usable entry. The TTLs of the returned records are reduced by
+        the time the entry spent in the cache.
+        """
+        key = self.getKey(query)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        now = self.clock.seconds()
+        if now - entry.expires > self.max_stale_age:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        if now >= entry.expires:
+            return entry.response, True
+        age = int(now - entry.stored)
+        response = tuple(copyRecords(records, lambda ttl: max(0, ttl - age))
+                         for records in entry.response)
+        return response, False
+
+    def flush(self):
+        self.entries.clear()
+
+    def dump(self, filename):
+        """
+        Writes all entries to a binary snapshot, the most recently used
+        first. Times are stored as absolute (wall clock) times, so that the
+        time until the snapshot is loaded again counts as time spent in the
+        cache. The file is replaced atomically.
+        """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                         len(self.entries)))
+            for (name, qtype, cls), entry in reversed(self.entries.items()):
+                data = encodeResponse(entry.response)
+                f.write(SNAPSHOT_ENTRY.pack(entry.stored, entry.expires, qtype,
+                                            cls, len(name), len(data)))
+                f.write(name)
+                f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename, max_load_time=None):
+        """
+        Adds the entries of a snapshot written by dump. Entries that are
+        expired for more than max_stale_age are dropped. Loading stops after
+        max_load_time seconds or max_entries entries; as the snapshot starts
+        with the most recently used entries, those are the ones that are
+        kept. Returns the number of loaded entries.
+        """
+        deadline = None
+        if max_load_time is not None:
+            deadline = time.monotonic() + max_load_time
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise RuntimeError("ERROR: {} is not a cache snapshot".format(filename))
+        magic, version, count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise RuntimeError("ERROR: {} is not a cache snapshot".format(filename))
+        now = self.clock.seconds()
+        loaded = 0
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(count):
+            if len(self.entries) >= self.max_entries or \
+                    (deadline is not None and time.monotonic() > deadline):
+                break
+            if offset + SNAPSHOT_ENTRY.size > len(data):
+                break
+            stored, expires, qtype, cls, name_len, data_len = \
+                SNAPSHOT_ENTRY.unpack_from(data, offset)
+            offset += SNAPSHOT_ENTRY.size
+            name = data[offset:offset + name_len]
+            response = data[offset + name_len:offset + name_len + data_len]
+            offset += name_len + data_len
+            if len(response) != data_len:
+                break
+            key = (name, qtype, cls)
+            if now - expires > self.max_stale_age or key in self.entries:
+                continue
+            try:
+                response = decodeResponse(response)
+            except Exception:
+                continue
+            self.entries[key] = ForwardCacheEntry(response, stored, expires)
+            # older entries go in front of the ones loaded before
+            self.entries.move_to_end(key, last=False)
+            loaded += 1
+        return loaded
@@ -0,0 +1,156 @@
+"""
+Answers that FakeDnsProxy computes from the query name
+
+A domain_config entry of the form { compute: <kind>, ... } does not list its
+answers, but computes them from the name in the query:
+
+    embedded_ip   the IPv4 address in the name, nip.io style:
+                  10-1-2-3.lab.example or app.10.1.2.3.lab.example -> 10.1.2.3
+    hash          one address out of a pool, chosen by a hash of the name,
+                  so that a name always gets the same address
+    ptr           a PTR record for a reverse name (in-addr.arpa or
+                  ip6.arpa), built from a template
+"""
+
+import collections
+import hashlib
+import ipaddress
+import re
+
+
+KINDS = ['embedded_ip', 'hash', 'ptr']
+
+# four decimal octets separated by dots or dashes, delimited by the ends of
+# the name or by dots or dashes
+EMBEDDED_IPV4 = re.compile(r'(?:^|[.-])(\d{1,3})[.-](\d{1,3})[.-](\d{1,3})[.-]'
+                           r'(\d{1,3})(?=$|[.-])')
+
+
+def findEmbeddedAddress(name):
+    """
+    Returns the first IPv4 address embedded in name, or None.
+    """
+    for match in EMBEDDED_IPV4.finditer(name):
+        octets = match.groups()
+        if all(int(octet) <= 255 for octet in octets):
+            return '.'.join(str(int(octet)) for octet in octets)
+    return None
+
+
+def parseReverseName(name):
+    """
+    Returns the address of an in-addr.arpa or ip6.arpa name, or None.
+    """
+    labels = name.lower().rstrip('.').split('.')
+    try:
+        if labels[-2:] == ['in-addr', 'arpa'] and len(labels) == 6:
+            return ipaddress.IPv4Address('.'.join(reversed(labels[:4])))
+        if labels[-2:] == ['ip6', 'arpa'] and len(labels) == 34:
+            nibbles = ''.join(reversed(labels[:32]))
+            return ipaddress.IPv6Address(int(nibbles, 16))
+    except ValueError:
+        pass
+    return None
+
+
+class ComputedAnswer:
+    """
+    Computes the answers of a { compute: <kind>, ... } entry. The answers of
+    the last cache_size (name, query type) pairs are kept in an LRU, so that
+    frequently queried names are computed only once.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.kind = settings.get('compute')
+        if not self.kind in KINDS:
+            raise RuntimeError("DNSAnswerDict: compute must be one of "
+                               "{}".format(','.join(KINDS)))
+        self.cache_size = settings.get('cache_size', 10000)
+        if type(self.cache_size) != int or self.cache_size < 0:
+            raise RuntimeError("DNSAnswerDict: cache_size must be a "
+                               "non-negative integer")
+        self.memo = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        allowed = { 'compute', 'cache_size' }
+        if self.kind == 'hash':
+            allowed.add('pool')
+            self.pool = { 'A': [], 'AAAA': [] }
+            pool = settings.get('pool')
+            if not isinstance(pool, list) or not pool:
+                raise RuntimeError("DNSAnswerDict: compute hash requires a "
+                                   "pool of addresses")
+            for address in pool:
+                try:
+                    ip = ipaddress.ip_address(address)
+                except ValueError:
+                    raise RuntimeError("DNSAnswerDict: {} is not a valid IP "
+                                       "address".format(address))
+                self.pool['A' if ip.version == 4 else 'AAAA'].append(str(ip))
+        elif self.kind == 'ptr':
+            allowed.add('template')
+            self.template = settings.get('template')
+            if not isinstance(self.template, str):
+                raise RuntimeError("DNSAnswerDict: compute ptr requires a "
+                                   "template")
+            try:
+                self.formatPtr(ipaddress.ip_address('192.0.2.1'))
+            except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+                raise RuntimeError("DNSAnswerDict: invalid ptr template "
+                                   "{}".format(self.template))
+        for key in settings:
+            if not key in allowed:
+                raise RuntimeError("DNSAnswerDict: {} is not a setting of "
+                                   "compute {}".format(key, self.kind))
+
+    def formatPtr(self, ip):
+        return self.template.format(ip=str(ip),
+                                    dashed=str(ip).replace('.', '-').replace(':', '-'))
+
+    def getValues(self, name, qtype_string):
+        """
+        Returns the list of values of type qtype_string for name, like the
+        value_dict of a DNSAnswerConfig would.
+        """
+        key = (name.lower(), qtype_string)
+        values = self.memo.get(key)
+        if values is not None:
+            self.memo.move_to_end(key)
+            self.hits += 1
+            return values
+        self.misses += 1
+        values = self.compute(key[0], qtype_string)
+        if self.cache_size > 0:
+            self.memo[key] = values
+            if len(self.memo) > self.cache_size:
+                self.memo.popitem(last=False)
+        return values
+
+    def hasName(self, name):
+        """
+        Returns True if name has answers of some query type, so that a query
+        for another type gets NODATA instead of NXDOMAIN.
+        """
+        name = name.lower()
+        if self.kind == 'embedded_ip':
+            return findEmbeddedAddress(name) is not None
+        if self.kind == 'hash':
+            return True
+        return parseReverseName(name) is not None
+
+    def compute(self, name, qtype_string):
+        if self.kind == 'embedded_ip':
+            if qtype_string != 'A':
+                return []
+            address = findEmbeddedAddress(name)
+            return [address] if address is not None else []
+        if self.kind == 'hash':
+            pool = self.pool.get(qtype_string)
+            if not pool:
+                return []
+            digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+            return [pool[int.from_bytes(digest, 'big') % len(pool)]]
+        if qtype_string != 'PTR':
+            return []
+        ip = parseReverseName(name)
+        return [self.formatPtr(ip)] if ip is not None else []
@@ -1,9 +1,44 @@
 import yaml
+import ipaddress
+import os
 import pprint
 import socket
 
 from twisted.names import client, dns, error, server
 
+import core.answerpolicy
+import core.computed
+import core.matcher
+import core.strategies
+
+
+def parseUpstream(value):
+    """
+    Returns the settings of an upstream given as "ip", "ip:port" or
+    "[ipv6]:port" (port 53 if omitted), or as a dict with an ip, a port and
+    further settings of core.upstream.Upstream.
+    """
+    if isinstance(value, dict):
+        settings = dict(value)
+        settings.setdefault('port', 53)
+        return settings
+    if not isinstance(value, str):
+        raise RuntimeError("ERROR: invalid upstream {}".format(value))
+    ip, port = value, 53
+    if value.startswith('['):
+        ip, _, rest = value[1:].partition(']')
+        if rest:
+            if not rest.startswith(':'):
+                raise RuntimeError("ERROR: invalid upstream {}".format(value))
+            port = rest[1:]
+    elif value.count(':') == 1:
+        ip, port = value.split(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise RuntimeError("ERROR: invalid port in upstream {}".format(value))
+    return { 'ip': ip, 'port': port }
+
 
 class DNSAnswerConfig:
     def __getitem__(self, key):
@@ -34,8 +69,45 @@ class DNSAnswerConfig:
             return False
         return True
  
+    def getPolicy(self):
+        """
+        Returns the policy (e.g. forward, nxdomain) if this entry is a
+        policy instead of a value, otherwise None.
+        """
+        if '*' in self.value_dict:
+            return self.value_dict['*'][0]
+        return None
+
+    def toValue(self):
+        """
+        Returns the value in the form it is written in the configuration.
+        """
+        if self.upstream is not None:
+            forward = dict(self.upstream)
+            if self.fallback:
+                forward['fallback'] = self.fallback
+            return { 'forward': forward }
+        if self.computed is not None:
+            return dict(self.computed.settings)
+        policy = self.getPolicy()
+        if policy is not None:
+            return policy
+        value = dict((qtype, list(values))
+                     for qtype, values in self.value_dict.items())
+        if self.strategy is not None:
+            value.update(self.strategy.settings)
+        return value
+
     def __init__(self, value):
         self.value_dict = dict()
+        # settings of the upstream for {forward: upstream}
+        self.upstream = None
+        # use the dns_server while the upstream is down
+        self.fallback = False
+        # a core.computed.ComputedAnswer for {compute: kind, ...}
+        self.computed = None
+        # a core.strategies.AnswerStrategy for {..., strategy: kind}
+        self.strategy = None
         policies = DNSForwardPolicies()
         if isinstance(value, str):
             # interpret a string value either as an IPv4 address or
@@ -59,8 +131,29 @@ class DNSAnswerConfig:
                 else:
                     raise RuntimeError("DNSAnswerDict: {} is not a valid IP "
                                        "address".format(address))
+        elif isinstance(value, dict) and 'forward' in value:
+            # forward to the given upstream instead of the dns_server
+            if len(value) != 1:
+                raise RuntimeError('DNSAnswerDict: "forward" cannot be combined '
+                                   'with other values')
+            self.upstream = parseUpstream(value['forward'])
+            # fallback belongs to the rule, the other settings to the
+            # server, which is shared by all rules that forward to it
+            self.fallback = self.upstream.pop('fallback', False)
+            if not self.isIPv4Address(self.upstream.get('ip')) and \
+                    not self.isIPv6Address(self.upstream.get('ip')):
+                raise RuntimeError("DNSAnswerDict: {} is not a valid IP "
+                                   "address".format(self.upstream.get('ip')))
+            self.value_dict['*'] = [ 'forward' ]
+        elif isinstance(value, dict) and 'compute' in value:
+            # answers computed from the query name, see core.computed
+            self.computed = core.computed.ComputedAnswer(value)
         elif isinstance(value, dict):
+            strategy = dict((key, value[key]) for key in core.strategies.SETTINGS
+                            if key in value)
             for qtype in value.keys():
+                if qtype in strategy:
+                    continue
                 if not self.isValidQueryType(qtype):
                     raise RuntimeError('DNSAnswerDict: Query type "{}" is not a '
                                       'valid query type.'.format(qtype))
@@ -69,6 +162,15 @@ class DNSAnswerConfig:
                     self.value_dict[qtype] = [ v ]
                 else:
                     self.value_dict[qtype] = v
+            if strategy:
+                # how the answers are selected from the values, see
+                # core.strategies
+                self.strategy = core.strategies.AnswerStrategy(strategy,
+                                                               self.value_dict)
+        elif value is not None:
+            raise RuntimeError("DNSAnswerDict: {} is not a valid value, it must "
+                               "be an IP address, a list of IP addresses, a "
+                               "policy or a dict".format(value))
 
 
 
@@ -118,6 +220,7 @@ class ConfigParser:
             else:
                 domain_config[domain] = DNSAnswerConfig(value)
         self.config['domain_config'] = domain_config
+        self.config['domain_matcher'] = core.matcher.DomainMatcher(domain_config)
 
     def __getitem__(self, key):
         return self.config[key]
@@ -128,6 +231,33 @@ class ConfigParser:
     def __contains__(self, key):
         return key in self.config
 
+    def getPlainConfig(self):
+        """
+        Returns the configuration without the objects created by
+        generate_config_objects, as it would be read from a config file.
+        """
+        def plain(value):
+            if isinstance(value, DNSAnswerConfig):
+                return value.toValue()
+            if isinstance(value, dict):
+                return dict((k, plain(v)) for k, v in value.items()
+                            if k != 'domain_matcher')
+            if isinstance(value, list):
+                return [plain(v) for v in value]
+            return value
+        return plain(self.config)
+
+    def write_config(self, filename):
+        """
+        Writes the configuration to filename. The file is replaced
+        atomically, so that a crash never leaves a partial config behind.
+        """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            yaml.safe_dump(self.getPlainConfig(), f, default_flow_style=False,
+                           sort_keys=False)
+        os.replace(tmp_filename, filename)
+
     def print(self):
         printer = pprint.PrettyPrinter(indent=4)
         printer.pprint(self.config)
@@ -139,10 +269,12 @@ class ConfigParser:
             raise RuntimeError("ERROR: dns_server in configuration must be a dict")
         if not 'ip' in self.config['dns_server'] or not 'port' in self.config['dns_server']:
             raise RuntimeError("ERROR: dns_server in configuration must contain an ip and a port")
+        self.validate_upstream_settings('dns_server', self.config['dns_server'])
         if not 'listening_info' in self.config:
             raise RuntimeError("ERROR: Every config must contain a listening_info")
         if not 'ip' in self.config['listening_info'] or not 'port' in self.config['listening_info']:
             raise RuntimeError("ERROR: dns_server in configuration must contain an ip and a port")
+        self.validate_listening_info()
         if not 'default_dns_policy' in self.config:
             raise RuntimeError("ERROR: Every config must contains a default_dns_policy")
         forward_policies = DNSForwardPolicies()
@@ -152,4 +284,391 @@ class ConfigParser:
         if self.config['default_dns_policy'] == 'default_value':
             if not 'default_dns_value' in self.config:
                 raise RuntimeError('ERROR: "default_dns_value" required in config'
-                                   ' if default_dns_policy is "default_value"') 
+                                   ' if default_dns_policy is "default_value"')
+        if 'domain_config' in self.config:
+            self.validate_domain_upstreams(self.config['domain_config'])
+        if 'engine' in self.config and \
+                not self.config['engine'] in ['twisted', 'asyncio']:
+            raise RuntimeError("ERROR: engine in config must be one of "
+                               "twisted,asyncio")
+        if 'use_uvloop' in self.config and \
+                not isinstance(self.config['use_uvloop'], bool):
+            raise RuntimeError("ERROR: use_uvloop in config must be true or "
+                               "false")
+        if 'fast_path' in self.config and \
+                not isinstance(self.config['fast_path'], bool):
+            raise RuntimeError("ERROR: fast_path in config must be true or "
+                               "false")
+        if 'negative_ttl' in self.config and \
+                (type(self.config['negative_ttl']) != int or
+                 self.config['negative_ttl'] < 0):
+            raise RuntimeError("ERROR: negative_ttl in config must be a "
+                               "non-negative integer")
+        if 'forward_cache' in self.config:
+            self.validate_forward_cache()
+        if 'hedging' in self.config:
+            self.validate_hedging()
+        if 'views' in self.config:
+            self.validate_views()
+        if 'heavy_hitters' in self.config:
+            self.validate_heavy_hitters()
+        if 'admin_socket' in self.config:
+            self.validate_admin_socket()
+        if 'handoff' in self.config:
+            self.validate_handoff()
+        if 'query_log' in self.config:
+            self.validate_query_log()
+        if 'forward_limits' in self.config:
+            self.validate_forward_limits()
+        if 'answer_policy' in self.config:
+            self.validate_answer_policy()
+        if 'watchdog' in self.config:
+            self.validate_watchdog()
+        if 'tracing' in self.config:
+            self.validate_tracing()
+        if 'memory' in self.config:
+            self.validate_memory()
+        if 'zone_files' in self.config:
+            self.validate_zone_files()
+
+    def validate_listening_info(self):
+        settings = self.config['listening_info']
+        for key in ['receive_buffer', 'send_buffer', 'max_read_bytes']:
+            if key in settings and \
+                    (type(settings[key]) != int or settings[key] <= 0):
+                raise RuntimeError("ERROR: listening_info: {} must be a "
+                                   "positive integer".format(key))
+        if 'drop_check_interval' in settings and \
+                (not isinstance(settings['drop_check_interval'], (int, float)) or
+                 settings['drop_check_interval'] <= 0):
+            raise RuntimeError("ERROR: listening_info: drop_check_interval must "
+                               "be a positive number")
+
+    def validate_upstream_settings(self, name, settings):
+        for key in ['initial_timeout', 'min_timeout', 'max_timeout',
+                    'query_deadline']:
+            if key in settings and \
+                    (not isinstance(settings[key], (int, float)) or
+                     settings[key] <= 0):
+                raise RuntimeError("ERROR: {}: {} must be a positive "
+                                   "number".format(name, key))
+        if 'adaptive_timeout' in settings and \
+                not isinstance(settings['adaptive_timeout'], bool):
+            raise RuntimeError("ERROR: {}: adaptive_timeout must be true or "
+                               "false".format(name))
+        if 'max_failures' in settings and \
+                (type(settings['max_failures']) != int or
+                 settings['max_failures'] < 0):
+            raise RuntimeError("ERROR: {}: max_failures must be a "
+                               "non-negative integer".format(name))
+        if 'retry_interval' in settings and \
+                (not isinstance(settings['retry_interval'], (int, float)) or
+                 settings['retry_interval'] <= 0):
+            raise RuntimeError("ERROR: {}: retry_interval must be a positive "
+                               "number".format(name))
+
+    def validate_domain_upstreams(self, domain_config):
+        upstreams = dict()
+        for domain, value in domain_config.items():
+            if not isinstance(value, DNSAnswerConfig) or value.upstream is None:
+                continue
+            settings = value.upstream
+            self.validate_upstream_settings(domain, settings)
+            if not isinstance(value.fallback, bool):
+                raise RuntimeError("ERROR: {}: fallback must be true or "
+                                   "false".format(domain))
+            key = (settings['ip'], settings['port'])
+            if key in upstreams and upstreams[key] != settings:
+                raise RuntimeError("ERROR: {}: upstream {}:{} is configured "
+                                   "with different settings".format(domain, *key))
+            upstreams[key] = settings
+
+    def validate_hedging(self):
+        hedge_config = self.config['hedging']
+        if type(hedge_config) != dict:
+            raise RuntimeError("ERROR: hedging in configuration must be a dict")
+        servers = hedge_config.get('servers')
+        if type(servers) != list or len(servers) == 0:
+            raise RuntimeError("ERROR: hedging in configuration must contain "
+                               "a list of servers")
+        for server in servers:
+            if type(server) != dict or not 'ip' in server or not 'port' in server:
+                raise RuntimeError("ERROR: every server in hedging must "
+                                   "contain an ip and a port")
+            self.validate_upstream_settings('hedging', server)
+        for key in ['min_delay', 'max_delay', 'budget', 'max_burst']:
+            if key in hedge_config and \
+                    (not isinstance(hedge_config[key], (int, float)) or
+                     hedge_config[key] < 0):
+                raise RuntimeError("ERROR: hedging: {} must be a non-negative "
+                                   "number".format(key))
+        percentile = hedge_config.get('delay_percentile', 95)
+        if not isinstance(percentile, (int, float)) or \
+                not 0 <= percentile <= 100:
+            raise RuntimeError("ERROR: hedging: delay_percentile must be "
+                               "between 0 and 100")
+
+    def validate_views(self):
+        views = self.config['views']
+        if type(views) != list:
+            raise RuntimeError("ERROR: views in configuration must be a list")
+        names = set()
+        networks = set()
+        forward_policies = DNSForwardPolicies()
+        for view in views:
+            if type(view) != dict or not 'name' in view or not 'clients' in view:
+                raise RuntimeError("ERROR: every view must be a dict with a "
+                                   "name and clients")
+            if view['name'] in names:
+                raise RuntimeError("ERROR: view {} is defined more than "
+                                   "once".format(view['name']))
+            names.add(view['name'])
+            for key in view:
+                if not key in ['name', 'clients', 'default_dns_policy',
+                               'default_dns_value', 'domain_config']:
+                    raise RuntimeError("ERROR: view {}: unknown setting "
+                                       "{}".format(view['name'], key))
+            if type(view['clients']) != list:
+                raise RuntimeError("ERROR: view {}: clients must be a list of "
+                                   "networks".format(view['name']))
+            for network in view['clients']:
+                try:
+                    network = ipaddress.ip_network(network, strict=False)
+                except ValueError:
+                    raise RuntimeError("ERROR: view {}: {} is not a valid "
+                                       "network".format(view['name'], network))
+                if network in networks:
+                    raise RuntimeError("ERROR: view {}: network {} is already "
+                                       "used by another view".format(
+                                           view['name'], network))
+                networks.add(network)
+            policy = view.get('default_dns_policy',
+                              self.config['default_dns_policy'])
+            if not forward_policies.is_valid_policy(policy):
+                raise RuntimeError("ERROR: view {}: default_dns_policy must be "
+                                   "one of {}".format(view['name'],
+                                   ','.join(forward_policies.get_valid_policies())))
+            if policy == 'default_value' and not 'default_dns_value' in view \
+                    and not 'default_dns_value' in self.config:
+                raise RuntimeError('ERROR: view {}: "default_dns_value" required'
+                                   ' if default_dns_policy is '
+                                   '"default_value"'.format(view['name']))
+
+    def validate_heavy_hitters(self):
+        settings = self.config['heavy_hitters']
+        if type(settings) != dict:
+            raise RuntimeError("ERROR: heavy_hitters in configuration must be "
+                               "a dict")
+        if 'size' in settings and \
+                (type(settings['size']) != int or settings['size'] <= 0):
+            raise RuntimeError("ERROR: heavy_hitters: size must be a positive "
+                               "integer")
+        if 'snapshot_interval' in settings and \
+                (not isinstance(settings['snapshot_interval'], (int, float)) or
+                 settings['snapshot_interval'] <= 0):
+            raise RuntimeError("ERROR: heavy_hitters: snapshot_interval must be "
+                               "a positive number")
+
+    def validate_admin_socket(self):
+        settings = self.config['admin_socket']
+        if type(settings) != dict or type(settings.get('path')) != str:
+            raise RuntimeError("ERROR: admin_socket in configuration must be "
+                               "a dict with a path")
+        if 'persist_file' in settings and \
+                type(settings['persist_file']) != str:
+            raise RuntimeError("ERROR: admin_socket: persist_file must be a "
+                               "file name")
+
+    def validate_handoff(self):
+        settings = self.config['handoff']
+        if type(settings) != dict or type(settings.get('path')) != str:
+            raise RuntimeError("ERROR: handoff in configuration must be a "
+                               "dict with a path")
+        if 'drain_timeout' in settings and \
+                (not isinstance(settings['drain_timeout'], (int, float)) or
+                 settings['drain_timeout'] < 0):
+            raise RuntimeError("ERROR: handoff: drain_timeout must be a "
+                               "non-negative number")
+
+    def validate_query_log(self):
+        settings = self.config['query_log']
+        if type(settings) != dict or type(settings.get('database')) != str:
+            raise RuntimeError("ERROR: query_log in configuration must be a "
+                               "dict with a database")
+        if 'batch_size' in settings and \
+                (type(settings['batch_size']) != int or settings['batch_size'] <= 0):
+            raise RuntimeError("ERROR: query_log: batch_size must be a positive "
+                               "integer")
+        for key in ['flush_interval', 'retention']:
+            if key in settings and \
+                    (not isinstance(settings[key], (int, float)) or
+                     settings[key] <= 0):
+                raise RuntimeError("ERROR: query_log: {} must be a positive "
+                                   "number".format(key))
+
+    def validate_forward_limits(self):
+        settings = self.config['forward_limits']
+        if type(settings) != dict:
+            raise RuntimeError("ERROR: forward_limits in configuration must be "
+                               "a dict")
+        for key in ['max_in_flight', 'max_in_flight_per_client']:
+            if key in settings and \
+                    (type(settings[key]) != int or settings[key] <= 0):
+                raise RuntimeError("ERROR: forward_limits: {} must be a "
+                                   "positive integer".format(key))
+        if 'max_queued' in settings and \
+                (type(settings['max_queued']) != int or settings['max_queued'] < 0):
+            raise RuntimeError("ERROR: forward_limits: max_queued must be a "
+                               "non-negative integer")
+        if 'queue_timeout' in settings and \
+                (not isinstance(settings['queue_timeout'], (int, float)) or
+                 settings['queue_timeout'] <= 0):
+            raise RuntimeError("ERROR: forward_limits: queue_timeout must be a "
+                               "positive number")
+
+    def validate_answer_policy(self):
+        settings = self.config['answer_policy']
+        if type(settings) != dict:
+            raise RuntimeError("ERROR: answer_policy in configuration must be "
+                               "a dict")
+        if 'strip_aaaa' in settings and \
+                not isinstance(settings['strip_aaaa'], bool):
+            raise RuntimeError("ERROR: answer_policy: strip_aaaa must be true "
+                               "or false")
+        rules = settings.get('rules', [])
+        if type(rules) != list:
+            raise RuntimeError("ERROR: answer_policy: rules must be a list")
+        networks = set()
+        for rule in rules:
+            if type(rule) != dict or type(rule.get('networks')) != list or \
+                    not 'action' in rule:
+                raise RuntimeError("ERROR: answer_policy: every rule must be a "
+                                   "dict with networks and an action")
+            for network in rule['networks']:
+                try:
+                    network = ipaddress.ip_network(network, strict=False)
+                except ValueError:
+                    raise RuntimeError("ERROR: answer_policy: {} is not a valid "
+                                       "network".format(network))
+                if network in networks:
+                    raise RuntimeError("ERROR: answer_policy: network {} is used "
+                                       "by more than one rule".format(network))
+                networks.add(network)
+            if not rule['action'] in core.answerpolicy.ACTIONS:
+                raise RuntimeError("ERROR: answer_policy: action must be one of "
+                                   "{}".format(','.join(core.answerpolicy.ACTIONS)))
+            addresses = rule.get('addresses', [])
+            if rule['action'] == 'drop' and addresses:
+                raise RuntimeError("ERROR: answer_policy: a rule with action "
+                                   "drop cannot have addresses")
+            if rule['action'] == 'rewrite' and \
+                    (type(addresses) != list or not addresses):
+                raise RuntimeError("ERROR: answer_policy: a rule with action "
+                                   "rewrite needs a list of addresses")
+            for address in addresses:
+                try:
+                    ipaddress.ip_address(address)
+                except ValueError:
+                    raise RuntimeError("ERROR: answer_policy: {} is not a valid "
+                                       "address".format(address))
+
+    def validate_watchdog(self):
+        settings = self.config['watchdog']
+        if type(settings) != dict:
+            raise RuntimeError("ERROR: watchdog in configuration must be a dict")
+        for key in ['interval', 'threshold']:
+            if key in settings and \
+                    (not isinstance(settings[key], (int, float)) or
+                     settings[key] <= 0):
+                raise RuntimeError("ERROR: watchdog: {} must be a positive "
+                                   "number".format(key))
+        if 'max_stalls' in settings and \
+                (type(settings['max_stalls']) != int or settings['max_stalls'] <= 0):
+            raise RuntimeError("ERROR: watchdog: max_stalls must be a positive "
+                               "integer")
+
+    def validate_tracing(self):
+        settings = self.config['tracing']
+        if type(settings) != dict or type(settings.get('file')) != str:
+            raise RuntimeError("ERROR: tracing in configuration must be a dict "
+                               "with a file")
+        if 'sample_rate' in settings and \
+                (not isinstance(settings['sample_rate'], (int, float)) or
+                 not 0 < settings['sample_rate'] <= 1):
+            raise RuntimeError("ERROR: tracing: sample_rate must be a number "
+                               "between 0 and 1")
+        if 'max_traces' in settings and \
+                (type(settings['max_traces']) != int or settings['max_traces'] <= 0):
+            raise RuntimeError("ERROR: tracing: max_traces must be a positive "
+                               "integer")
+        if 'flush_interval' in settings and \
+                (not isinstance(settings['flush_interval'], (int, float)) or
+                 settings['flush_interval'] <= 0):
+            raise RuntimeError("ERROR: tracing: flush_interval must be a "
+                               "positive number")
+
+    def validate_memory(self):
+        settings = self.config['memory']
+        if type(settings) != dict:
+            raise RuntimeError("ERROR: memory in configuration must be a dict")
+        for key in ['report', 'freeze']:
+            if key in settings and type(settings[key]) != bool:
+                raise RuntimeError("ERROR: memory: {} must be true or "
+                                   "false".format(key))
+        if 'gauge_interval' in settings and \
+                (not isinstance(settings['gauge_interval'], (int, float)) or
+                 settings['gauge_interval'] <= 0):
+            raise RuntimeError("ERROR: memory: gauge_interval must be a "
+                               "positive number")
+
+    def validate_zone_files(self):
+        zone_files = self.config['zone_files']
+        if type(zone_files) != list:
+            raise RuntimeError("ERROR: zone_files in configuration must be a "
+                               "list")
+        for entry in zone_files:
+            if isinstance(entry, str):
+                continue
+            if type(entry) != dict or type(entry.get('file')) != str or \
+                    type(entry.get('origin', '')) != str:
+                raise RuntimeError("ERROR: zone_files: every entry must be a "
+                                   "file name or a dict with a file and an "
+                                   "origin")
+
+    def validate_forward_cache(self):
+        cache_config = self.config['forward_cache']
+        if type(cache_config) != dict:
+            raise RuntimeError("ERROR: forward_cache in configuration must be a dict")
+        for key in ['max_entries', 'stale_client_timeout', 'stale_answer_ttl',
+                    'max_stale_age']:
+            if key in cache_config and \
+                    (not isinstance(cache_config[key], (int, float)) or
+                     cache_config[key] < 0):
+                raise RuntimeError("ERROR: forward_cache: {} must be a "
+                                   "non-negative number".format(key))
+        if 'serve_stale' in cache_config and \
+                not isinstance(cache_config['serve_stale'], bool):
+            raise RuntimeError("ERROR: forward_cache: serve_stale must be "
+                               "true or false")
+        if 'shared_file' in cache_config and \
+                type(cache_config['shared_file']) != str:
+            raise RuntimeError("ERROR: forward_cache: shared_file must be a "
+                               "file name")
+        if 'snapshot_file' in cache_config:
+            if type(cache_config['snapshot_file']) != str:
+                raise RuntimeError("ERROR: forward_cache: snapshot_file must be "
+                                   "a file name")
+            if 'shared_file' in cache_config:
+                raise RuntimeError("ERROR: forward_cache: snapshot_file cannot "
+                                   "be combined with shared_file")
+        for key in ['snapshot_interval', 'snapshot_max_load_time']:
+            if key in cache_config and \
+                    (not isinstance(cache_config[key], (int, float)) or
+                     cache_config[key] <= 0):
+                raise RuntimeError("ERROR: forward_cache: {} must be a "
+                                   "positive number".format(key))
+        if 'slot_size' in cache_config and \
+                (type(cache_config['slot_size']) != int or
+                 not 128 <= cache_config['slot_size'] <= 65535):
+            raise RuntimeError("ERROR: forward_cache: slot_size must be "
+                               "between 128 and 65535")
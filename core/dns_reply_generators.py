@@ -1,12 +1,20 @@
 from twisted.names import client, dns, error, server
 
-import re
+import core.matcher
+
+
+# negative caching TTL of NODATA answers (see RFC 2308) if negative_ttl is
+# not configured
+DEFAULT_NEGATIVE_TTL = 60
+# names in the synthesized SOA records, in a TLD that never exists
+SOA_MNAME = b'fakednsproxy.invalid'
+SOA_RNAME = b'hostmaster.fakednsproxy.invalid'
 
 class DNSReplyGenerator:
     def __init__(self, config):
         self.config = config
 
-    def generateAnswerRecords(self, query, domain_config):
+    def generateAnswerRecords(self, query, domain_config, address=None):
         name = query.name.name
         qtype = query.type
         payload = None
@@ -16,11 +24,19 @@ class DNSReplyGenerator:
                                " DNS query type {}.".format(qtype))
 
         qtype_string = dns.QUERY_TYPES[qtype]
-        if not qtype_string in domain_config:
+        computed = getattr(domain_config, 'computed', None)
+        if computed is not None:
+            domain_entry = computed.getValues(name.decode(), qtype_string)
+        elif not qtype_string in domain_config:
             return []
+        else:
+            domain_entry = domain_config[qtype_string]
+            strategy = getattr(domain_config, 'strategy', None)
+            if strategy is not None:
+                domain_entry = strategy.select(qtype_string, domain_entry,
+                                               address)
 
         answers = []
-        domain_entry = domain_config[qtype_string]
         
         for value in domain_entry:
             payload = self.generateAnswerRecordPayload(qtype_string,
@@ -31,6 +47,36 @@ class DNSReplyGenerator:
             answers.append(answer)
         return answers
  
+    def nameExists(self, name, domain_config):
+        """
+        Returns True if domain_config has answers for name of any query type.
+        """
+        computed = getattr(domain_config, 'computed', None)
+        if computed is not None:
+            return computed.hasName(name.decode())
+        return any(domain_config.value_dict.values())
+
+    def generateNoDataReply(self, query):
+        """
+        Returns the reply for a name that exists, but has no records of the
+        query type: no answers, and an SOA record in the authority section
+        that tells the client how long to cache that (RFC 2308). The SOA is
+        owned by the query name.
+        """
+        ttl = self.config['negative_ttl'] if 'negative_ttl' in self.config \
+              else DEFAULT_NEGATIVE_TTL
+        soa = dns.Record_SOA(mname=SOA_MNAME, rname=SOA_RNAME, serial=1,
+                             refresh=3600, retry=600, expire=86400,
+                             minimum=ttl, ttl=ttl)
+        return [], [dns.RRHeader(name=query.name.name, type=dns.SOA, ttl=ttl,
+                                 payload=soa)], []
+
+    def generateValueReply(self, query, domain_config, address=None):
+        answers = self.generateAnswerRecords(query, domain_config, address)
+        if not answers and self.nameExists(query.name.name, domain_config):
+            return self.generateNoDataReply(query)
+        return answers, [], []
+
     def generateAnswerRecordPayload(self, qtype_string, record_value):
         payload = None
         if qtype_string == 'A':
@@ -60,7 +106,7 @@ class DNSReplyGenerator:
         elif qtype_string == 'WKS':
             raise NotImplementedError()
         elif qtype_string == 'PTR':
-            raise NotImplementedError()
+            payload = dns.Record_PTR(name=record_value)
         elif qtype_string == 'HINFO':
             raise NotImplementedError()
         elif qtype_string == 'MINFO':
@@ -89,44 +135,69 @@ class DNSReplyGenerator:
 
         return payload 
 
-    def generateReply(self, query):
+    def generateReply(self, query, address=None):
         raise NotImplementedError()
 
-    def getDomainConfigEntry(self, query_name):
-        """
-        Our matching is simple, we support the * as wildcard for our matching
-        of domain names. We match the query_name against our entries in 
-        domain_config:
-            query_name: a.foobar.com --> *.foobar.com
-        """
+    def getDomainMatcher(self):
         if not 'domain_config' in self.config:
             raise RuntimeError("ERROR: No specific domain config in config.")
         domain_config = self.config['domain_config']
+        if 'domain_matcher' in self.config and \
+                self.config['domain_matcher'].domain_config is domain_config:
+            return self.config['domain_matcher']
+        # the config was not compiled (or changed since), compile it now
+        matcher = core.matcher.DomainMatcher(domain_config)
+        self.config['domain_matcher'] = matcher
+        return matcher
 
-        for domain, value in domain_config.items():
-            escaped_domain = re.escape(domain)
-            # take our * and make them regular expression matching
-            regex_domain = escaped_domain.replace('\*', '.*')
-            m = re.match(regex_domain, query_name)
-            if m:
-                return value
+    def findDomainConfigEntry(self, query_name):
+        """
+        Returns the entry in domain_config that matches query_name, or None.
+        See core.matcher.DomainMatcher for the supported patterns:
+            query_name: a.foobar.com --> *.foobar.com
+        """
+        return self.getDomainMatcher().match(query_name)
 
-        raise RuntimeError("ERROR: Could not find custom_value definition "
-                           "for domain '{}' in config".format(query_name))
+    def getDomainConfigEntry(self, query_name):
+        """
+        Same as findDomainConfigEntry, but raises a RuntimeError if no entry
+        matches query_name.
+        """
+        value = self.findDomainConfigEntry(query_name)
+        if value is None:
+            raise RuntimeError("ERROR: Could not find custom_value definition "
+                               "for domain '{}' in config".format(query_name))
+        return value
 
 class NXDomainReply(DNSReplyGenerator):
-    def generateReply(self, query):
+    def generateReply(self, query, address=None):
         return [], [], []
 
 class DefaultValueReply(DNSReplyGenerator):
-    def generateReply(self, query):
-        answers = self.generateAnswerRecords(query, self.config['default_dns_value'])
-        return answers, [], []
+    def generateReply(self, query, address=None):
+        return self.generateValueReply(query, self.config['default_dns_value'],
+                                       address)
 
 class CustomValueReply(DNSReplyGenerator):
-    def generateReply(self, query):
+    def generateReply(self, query, address=None):
         name = query.name.name.decode()
         name_config = self.getDomainConfigEntry(name)
-        answers = self.generateAnswerRecords(query, name_config)
-        return answers, [], []
+        return self.generateValueReply(query, name_config, address)
+
+
+class ZoneReply(DNSReplyGenerator):
+    """
+    Answers queries for names in the zones of zone_files (see core.zones).
+    Names that do not exist in their zone raise a ZoneNameError.
+    """
+    def __init__(self, config, zones):
+        super().__init__(config)
+        self.zones = zones
 
+    def generateReply(self, query, address=None):
+        name = query.name.name.decode().lower().rstrip('.')
+        zone = self.zones.findZone(name)
+        if zone is None:
+            raise RuntimeError("ERROR: Could not find a zone for domain "
+                               "'{}'".format(name))
+        return zone.lookup(name, query.type)
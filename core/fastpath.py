@@ -0,0 +1,178 @@
+"""
+Fast path for queries that FakeDnsProxy answers itself
+
+Most queries that we answer with a synthetic answer are plain queries with a
+single question. For these, we only parse the header and the question
+directly from the datagram and write the response without building
+dns.Message objects. Everything else (forwarded queries, multiple questions,
+EDNS, opcodes other than QUERY, ...) is decoded by twisted as usual.
+"""
+
+import struct
+
+from io import BytesIO
+
+from twisted.names import dns
+
+import core.querylog
+
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RECORD_HEADER = struct.Struct('!HHIH')
+
+# QR bit, opcode and the TC bit must be 0 for a query we can answer here
+QUERY_FLAGS_MASK = 0xFA00
+# pointer to the question name, which always starts right after the header
+QNAME_POINTER = b'\xc0\x0c'
+
+
+def parseQuestion(data):
+    """
+    Parses the header and the question of a plain DNS query. Returns a tuple
+    (id, name, qtype, qclass, end), where end is the offset behind the
+    question, or None if the datagram needs the full message decoding.
+    """
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        return None
+    msg_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(view)
+    if flags & QUERY_FLAGS_MASK or qdcount != 1 or ancount or nscount or arcount:
+        return None
+
+    pos = HEADER.size
+    end = len(view)
+    while True:
+        if pos >= end:
+            return None
+        length = view[pos]
+        if length == 0:
+            break
+        # compression pointers and extended labels do not occur in plain
+        # questions
+        if length > 63 or pos + length >= end:
+            return None
+        pos += length + 1
+    name = bytes(view[HEADER.size + 1:pos])
+    pos += 1
+    if pos + QUESTION_TAIL.size > end:
+        return None
+    qtype, qclass = QUESTION_TAIL.unpack_from(view, pos)
+    # turn the length octets of the labels into dots, the first one was cut
+    # off above
+    labels = bytearray(name)
+    i = view[HEADER.size]
+    while i < len(labels):
+        step = labels[i]
+        labels[i] = 0x2e
+        i += step + 1
+    return msg_id, bytes(labels), qtype, qclass, pos + QUESTION_TAIL.size
+
+
+def encodeRecord(strio, record, qname):
+    if record.name.name == qname:
+        strio.write(QNAME_POINTER)
+    else:
+        record.name.encode(strio)
+    payload = BytesIO()
+    record.payload.encode(payload)
+    rdata = payload.getvalue()
+    strio.write(RECORD_HEADER.pack(record.type, record.cls, record.ttl,
+                                   len(rdata)))
+    strio.write(rdata)
+
+
+def buildResponse(question, msg_id, qname, rcode, response, recursion_available):
+    """
+    Builds the wire format response from the question section of the query
+    and the (answers, authority, additional) generated for it. The header
+    flags match those of CustomDNSServerFactory.
+    """
+    ans, auth, add = response
+    # an empty answer is authoritative with the SOA of a zone (NODATA)
+    authoritative = any(r.auth for r in (ans or auth))
+    flags = 0x8000 | (authoritative << 10) | (recursion_available << 7) | rcode
+    strio = BytesIO()
+    strio.write(HEADER.pack(msg_id, flags, 1, len(ans), len(auth), len(add)))
+    strio.write(question)
+    for records in response:
+        for record in records:
+            encodeRecord(strio, record, qname)
+    return strio.getvalue()
+
+
+class FastPathResponder:
+    """
+    Answers plain queries for names that the DNSHandler does not forward.
+    """
+    def __init__(self, dns_handler, factory):
+        self.dns_handler = dns_handler
+        self.factory = factory
+
+    def handleDatagram(self, data, address, write=None):
+        """
+        Returns the response to the datagram, or None if the datagram has to
+        take the normal path. If write is given, the response is written
+        with write(response, address).
+        """
+        parsed = parseQuestion(data)
+        if parsed is None:
+            return None
+        msg_id, qname, qtype, qclass, end = parsed
+        tracer = self.factory.tracer
+        received = tracer.timer() if tracer is not None else None
+        query = dns.Query(qname, qtype, qclass)
+        action = self.dns_handler.get_action_for_query(query, address)
+        if action == 'forward':
+            # the normal path samples the query, and uses the action
+            # instead of deciding it again
+            self.factory.fast_path_action = action
+            return None
+        decided = tracer.timer() if tracer is not None else None
+        try:
+            response = self.dns_handler.generateReply(action, query, address)
+        except Exception:
+            # let the normal path deal with the error (and sample the query)
+            self.factory.fast_path_action = action
+            return None
+        trace = tracer.startTrace(address, received) if tracer is not None else None
+        if trace is not None:
+            trace.mark('policy', decided)
+            trace.mark('answer')
+        self.dns_handler.recordQuery(query, address, action)
+        self.factory.logResponse(response, query, address)
+        if trace is not None:
+            trace.mark('logged')
+        rcode = self.factory.getResponseCode(response)
+        result = buildResponse(data[HEADER.size:end], msg_id, query.name.name,
+                               rcode, response, self.factory.canRecurse)
+        if write is not None:
+            write(result, address)
+        if trace is not None:
+            if write is not None:
+                trace.mark('reply_sent')
+            trace.args.update(qname=qname.decode(), action=action,
+                              qtype=dns.QUERY_TYPES.get(qtype, str(qtype)),
+                              rcode=core.querylog.RCODE_NAMES.get(rcode, str(rcode)),
+                              fast_path=True)
+            tracer.finishTrace(trace)
+        return result
+
+
+class FastPathDNSDatagramProtocol(dns.DNSDatagramProtocol):
+    """
+    DNSDatagramProtocol that tries the FastPathResponder before decoding
+    the datagram.
+    """
+    def __init__(self, controller, responder, reactor=None):
+        super().__init__(controller, reactor=reactor)
+        self.responder = responder
+
+    def datagramReceived(self, data, addr):
+        response = self.responder.handleDatagram(data, addr, self.transport.write)
+        if response is None:
+            try:
+                return super().datagramReceived(data, addr)
+            finally:
+                # in case the datagram did not reach the factory
+                self.controller.fast_path_action = None
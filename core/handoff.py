@@ -0,0 +1,114 @@
+"""
+Handoff of the listening socket to a new FakeDnsProxy process
+
+A running FakeDnsProxy with a handoff path listens on that Unix domain
+socket. A newly started FakeDnsProxy with the same configuration connects to
+it before it binds its own socket:
+
+    new process                         running process
+    HANDOFF             ------------->
+                        <-------------  UDP <family> + the socket (SCM_RIGHTS)
+    (adopts the socket)
+    READY               ------------->
+                                        stops reading from the socket,
+                                        closes its handoff and admin sockets
+                        <-------------  closes the connection
+    (listens on the handoff path)       drains its forwarded queries, exits
+
+Both processes share the same kernel socket, so no datagram is lost: until
+READY the running process reads from it, afterwards only the new one does.
+"""
+
+import socket
+
+from twisted.internet import defer, protocol
+from twisted.logger import Logger
+
+
+def receiveSocket(path, timeout=5):
+    """
+    Asks the process listening on path for its UDP socket. Returns
+    (connection, fd, family), or None if no process is listening on path.
+    The connection must be passed to finishHandoff once the socket is
+    served.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    try:
+        conn.sendall(b'HANDOFF\n')
+        # the descriptor arrives with the first byte of the message
+        msg, fds, _, _ = socket.recv_fds(conn, 1024, 1)
+        while msg and not msg.endswith(b'\n'):
+            data = conn.recv(1024)
+            if not data:
+                break
+            msg += data
+        parts = msg.split()
+        if len(fds) != 1 or len(parts) != 2 or parts[0] != b'UDP':
+            for fd in fds:
+                socket.close(fd)
+            raise RuntimeError("ERROR: invalid handoff from {}: {}".format(
+                               path, msg))
+    except:
+        conn.close()
+        raise
+    return conn, fds[0], int(parts[1])
+
+
+def finishHandoff(conn):
+    """
+    Tells the old process that the socket is served, and waits until it has
+    released the handoff path.
+    """
+    try:
+        conn.sendall(b'READY\n')
+        while conn.recv(1024):
+            pass
+    finally:
+        conn.close()
+
+
+class HandoffProtocol(protocol.Protocol):
+    """
+    The side of the running process. The proxy passed to the factory must
+    provide getListeningSocket(), returning (fd, family), and
+    handOff(), which returns a Deferred that fires once the proxy stopped
+    reading from the socket and released its Unix domain sockets.
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.sent = False
+        self.done = False
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.lineReceived(line.strip())
+
+    def lineReceived(self, line):
+        if line == b'HANDOFF' and not self.sent:
+            fd, family = self.factory.proxy.getListeningSocket()
+            self.transport.sendFileDescriptor(fd)
+            self.transport.write('UDP {}\n'.format(family).encode())
+            self.sent = True
+        elif line == b'READY' and self.sent and not self.done:
+            self.done = True
+            d = defer.maybeDeferred(self.factory.proxy.handOff)
+            d.addErrback(lambda f: self.factory.logger.failure('Handoff failed', f))
+            d.addBoth(lambda _: self.transport.loseConnection())
+        else:
+            self.transport.loseConnection()
+
+
+class HandoffFactory(protocol.Factory):
+    protocol = HandoffProtocol
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.logger = Logger()
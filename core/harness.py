@@ -0,0 +1,229 @@
+"""
+In-memory harness for FakeDnsProxy
+
+Runs the CustomDNSServerFactory and DNSHandler of a configuration without
+sockets: raw queries are handed to the DNS protocol as if they had been
+received from a client, the replies are captured by an in-memory
+transport, time is a task.Clock, and every upstream (dns_server, hedging
+servers and the servers of domain rules) answers from a FakeUpstream.
+Everything runs in the calling thread and only advances when the clock is
+advanced, so tests of throughput and latency give the same results every
+time and can run in parallel.
+
+    harness = Harness({ 'default_dns_policy': 'forward',
+                        'dns_server': { 'ip': '192.0.2.53', 'port': 53 } })
+    harness.upstream.setAnswer('foo.com', dns.A, [dns.Record_A('1.2.3.4')],
+                               latency=0.05)
+    harness.query('foo.com')        # None, the upstream has not answered yet
+    harness.advance(0.05)           # [the reply]
+    harness.latencies               # [0.05]
+"""
+
+from twisted.internet import defer, task
+from twisted.names import dns, error
+
+import core.config
+import core.fastpath
+import core.main
+import core.upstream
+
+
+# address of the client if none is given
+CLIENT = ('127.0.0.1', 53000)
+
+
+class MemoryTransport:
+    """
+    Datagram transport that keeps what is written to it, as
+    (data, address, time of the clock).
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.written = []
+
+    def write(self, data, addr=None):
+        self.written.append((data, addr, self.clock.seconds()))
+
+    def getHost(self):
+        return None
+
+    def stopListening(self):
+        pass
+
+
+class FakeUpstream:
+    """
+    Replaces the resolver of the upstreams. Answers are set per (name, query
+    type) with setAnswer and setError, queries for other names fail with
+    DNSNameError (NXDOMAIN). An answer with a latency is delivered when the
+    clock has advanced by latency, or fails with DNSQueryTimeoutError if the
+    latency exceeds the timeout of the query. Without latency, the answer is
+    delivered right away.
+    """
+    def __init__(self, clock, latency=0):
+        self.clock = clock
+        self.latency = latency
+        # (name, qtype) -> (result or exception, latency)
+        self.entries = dict()
+        self.queries = []
+        self.in_flight = 0
+
+    def getKey(self, name, qtype):
+        if isinstance(name, str):
+            name = name.encode()
+        return name.lower().rstrip(b'.'), qtype
+
+    def setAnswer(self, name, qtype, answers=(), authority=(), additional=(),
+                  latency=None):
+        """
+        Sets the answer for name. The records are given as RRHeaders or as
+        payloads (e.g. dns.Record_A) that are put into RRHeaders for name.
+        """
+        def headers(records):
+            return [record if isinstance(record, dns.RRHeader) else
+                    dns.RRHeader(name=name, type=record.TYPE, payload=record)
+                    for record in records]
+        self.entries[self.getKey(name, qtype)] = (
+                (headers(answers), headers(authority), headers(additional)),
+                latency)
+
+    def setError(self, name, qtype, exception, latency=None):
+        self.entries[self.getKey(name, qtype)] = (exception, latency)
+
+    def query(self, query, timeout=None):
+        self.queries.append(query)
+        result, latency = self.entries.get(
+                              self.getKey(query.name.name, query.type),
+                              (error.DNSNameError(), None))
+        if latency is None:
+            latency = self.latency
+        if timeout and latency >= sum(timeout):
+            result, latency = dns.DNSQueryTimeoutError(query), sum(timeout)
+        if not latency:
+            if isinstance(result, Exception):
+                return defer.fail(result)
+            return defer.succeed(result)
+
+        def cancel(d):
+            if call.active():
+                call.cancel()
+            self.in_flight -= 1
+
+        def deliver():
+            self.in_flight -= 1
+            if isinstance(result, Exception):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        d = defer.Deferred(cancel)
+        self.in_flight += 1
+        call = self.clock.callLater(latency, deliver)
+        return d
+
+
+class Harness:
+    """
+    Serves the configuration config (a dict as read from the config file)
+    from memory. The replies are kept in replies as (data, address, time),
+    and the latency of every answered query, in seconds of the clock, in
+    latencies.
+    """
+    def __init__(self, config, upstream=None, clock=None, fast_path=False):
+        self.clock = clock or task.Clock()
+        self.config = core.config.ConfigParser(config)
+        self.config.generate_config_objects()
+        self.dns_handler = core.main.DNSHandler(self.config, clock=self.clock)
+        self.upstream = upstream or FakeUpstream(self.clock)
+        for resolver in self.getUpstreams():
+            resolver.resolver = self.upstream
+        self.factory = core.main.CustomDNSServerFactory(clients=[self.dns_handler])
+        if fast_path:
+            responder = core.fastpath.FastPathResponder(self.dns_handler,
+                                                        self.factory)
+            self.protocol = core.fastpath.FastPathDNSDatagramProtocol(
+                                self.factory, responder, reactor=self.clock)
+        else:
+            self.protocol = dns.DNSDatagramProtocol(self.factory,
+                                                    reactor=self.clock)
+        self.transport = MemoryTransport(self.clock)
+        self.protocol.makeConnection(self.transport)
+        # (address, id) -> time the query was received
+        self.pending = dict()
+        self.latencies = []
+        self.next_id = 0
+
+    def getUpstreams(self):
+        """
+        Returns all core.upstream.Upstream objects of the DNSHandler.
+        """
+        resolver = self.dns_handler.resolver
+        upstreams = list(self.dns_handler.upstreams.upstreams.values())
+        if isinstance(resolver, core.upstream.HedgedResolver):
+            upstreams.append(resolver.primary)
+            upstreams.extend(resolver.secondaries)
+        elif resolver is not None:
+            upstreams.append(resolver)
+        return upstreams
+
+    @property
+    def replies(self):
+        return self.transport.written
+
+    def collect(self, start):
+        """
+        Returns the replies written since len(replies) was start, and
+        records their latencies.
+        """
+        replies = self.transport.written[start:]
+        for data, address, time in replies:
+            sent = self.pending.pop((address, data[:2]), None)
+            if sent is not None:
+                self.latencies.append(time - sent)
+        return [data for data, address, time in replies]
+
+    def send(self, data, address=CLIENT):
+        """
+        Hands the datagram to the protocol. Returns the replies that were
+        written right away.
+        """
+        start = len(self.transport.written)
+        self.pending[(address, data[:2])] = self.clock.seconds()
+        self.protocol.datagramReceived(data, address)
+        return self.collect(start)
+
+    def advance(self, seconds):
+        """
+        Advances the clock, stopping at every scheduled call on the way, so
+        that the replies are written at the time they are due. Returns the
+        replies written meanwhile.
+        """
+        start = len(self.transport.written)
+        end = self.clock.seconds() + seconds
+        while True:
+            due = [call.getTime() for call in self.clock.getDelayedCalls()]
+            if not due or min(due) > end:
+                break
+            self.clock.advance(max(0, min(due) - self.clock.seconds()))
+        self.clock.advance(end - self.clock.seconds())
+        return self.collect(start)
+
+    def buildQuery(self, name, qtype=dns.A):
+        self.next_id = (self.next_id + 1) % 65536
+        message = dns.Message(id=self.next_id, recDes=1)
+        if isinstance(name, str):
+            name = name.encode()
+        message.addQuery(name, qtype)
+        return message.toStr()
+
+    def query(self, name, qtype=dns.A, address=CLIENT):
+        """
+        Sends a query for name. Returns the reply as a dns.Message, or None
+        if it was not answered right away (see advance).
+        """
+        replies = self.send(self.buildQuery(name, qtype), address)
+        if not replies:
+            return None
+        message = dns.Message()
+        message.fromStr(replies[-1])
+        return message
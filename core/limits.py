@@ -0,0 +1,109 @@
+"""
+Limits on the queries FakeDnsProxy forwards to the dns_server
+"""
+
+import collections
+
+from twisted.internet import defer, reactor
+from twisted.names import error
+
+
+class ForwardQueryShed(error.DNSServerError):
+    """
+    The query was not forwarded, because too many queries are in flight.
+    """
+
+
+class _Waiter:
+    __slots__ = ['client', 'deferred', 'timer']
+
+    def __init__(self, client, deferred, timer):
+        self.client = client
+        self.deferred = deferred
+        self.timer = timer
+
+
+class ForwardLimiter:
+    """
+    Limits the number of forwarded queries in flight, in total
+    (max_in_flight) and per client address (max_in_flight_per_client).
+
+    A query above max_in_flight waits in a queue of at most max_queued
+    queries for up to queue_timeout seconds. Queries that exceed the limit
+    of their client, do not fit into the queue or time out in it are shed:
+    acquire fails with ForwardQueryShed. The queued queries count towards
+    the limit of their client.
+    """
+    def __init__(self, settings, clock=None):
+        self.clock = clock or reactor
+        self.max_in_flight = settings.get('max_in_flight', 1000)
+        self.max_per_client = settings.get('max_in_flight_per_client')
+        self.max_queued = settings.get('max_queued', 0)
+        self.queue_timeout = settings.get('queue_timeout', 0.5)
+        self.in_flight = 0
+        # client -> queries in flight or queued
+        self.clients = collections.Counter()
+        self.queue = collections.deque()
+        self.queued = 0
+        self.shed_client = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    def acquire(self, client):
+        """
+        Returns a Deferred that fires once the query may be sent. Every
+        successful acquire must be followed by a release.
+        """
+        if self.max_per_client is not None and \
+                self.clients[client] >= self.max_per_client:
+            self.shed_client += 1
+            return defer.fail(ForwardQueryShed())
+        if self.in_flight < self.max_in_flight:
+            self.in_flight += 1
+            self.clients[client] += 1
+            return defer.succeed(None)
+        if self.queued >= self.max_queued:
+            self.shed_queue_full += 1
+            return defer.fail(ForwardQueryShed())
+        # the queue is in timeout order, drop the waiters that timed out
+        while self.queue and not self.queue[0].timer.active():
+            self.queue.popleft()
+        d = defer.Deferred()
+        waiter = _Waiter(client, d, None)
+        waiter.timer = self.clock.callLater(self.queue_timeout,
+                                            self._timeout, waiter)
+        self.queue.append(waiter)
+        self.queued += 1
+        self.clients[client] += 1
+        return d
+
+    def _forget(self, client):
+        self.clients[client] -= 1
+        if self.clients[client] <= 0:
+            del self.clients[client]
+
+    def _timeout(self, waiter):
+        # the waiter stays in the queue until release skips it
+        self.queued -= 1
+        self._forget(waiter.client)
+        self.shed_timeout += 1
+        waiter.deferred.errback(ForwardQueryShed())
+
+    def release(self, client):
+        self.in_flight -= 1
+        self._forget(client)
+        while self.queue and self.in_flight < self.max_in_flight:
+            waiter = self.queue.popleft()
+            if not waiter.timer.active():
+                continue
+            waiter.timer.cancel()
+            self.queued -= 1
+            self.in_flight += 1
+            waiter.deferred.callback(None)
+
+    def getStats(self):
+        return [('forwards_in_flight', self.in_flight),
+                ('forwards_queued', self.queued),
+                ('shed_client_limit', self.shed_client),
+                ('shed_queue_full', self.shed_queue_full),
+                ('shed_queue_timeout', self.shed_timeout)]
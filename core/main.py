@@ -1,44 +1,164 @@
+import core.admin
+import core.aio
+import core.answerpolicy
+import core.cache
 import core.config
 import core.dns_reply_generators
+import core.fastpath
+import core.handoff
+import core.limits
+import core.memory
+import core.querylog
+import core.shmcache
+import core.stats
+import core.tracing
+import core.udp
+import core.upstream
+import core.views
+import core.watchdog
+import core.zones
 
-from twisted.internet import reactor, defer
-from twisted.names import client, dns, error, server
+from twisted.internet import reactor, defer, task
+from twisted.names import dns, error, server
 
-from twisted.logger import Logger, textFileLogObserver
+from twisted.logger import Logger, globalLogPublisher, textFileLogObserver
 
+import os
+import signal
 import sys
 import socket
 
 
+# upstream failures that are answered with a stale answer: timeouts and
+# SERVFAIL (DNSServerError, which includes UpstreamUnavailable and
+# ForwardQueryShed)
+STALE_ERRORS = (dns.DNSQueryTimeoutError, defer.TimeoutError,
+                error.DNSServerError)
+
+
 class DNSHandler(object):
-    def __init__(self, config):
+    def __init__(self, config, clock=None):
         self.config = config
+        self.clock = clock or reactor
         self.resolver = None
         if 'dns_server' in self.config:
-            self.resolver = client.Resolver(servers=[
-                                              (self.config['dns_server']['ip'],
-                                              self.config['dns_server']['port']
-                                            )])
+            self.resolver = core.upstream.Upstream(self.config['dns_server'],
+                                                   clock=self.clock)
+            if 'hedging' in self.config:
+                hedge_config = self.config['hedging']
+                secondaries = [core.upstream.Upstream(settings, clock=self.clock)
+                               for settings in hedge_config['servers']]
+                self.resolver = core.upstream.HedgedResolver(
+                                    self.resolver, secondaries, hedge_config,
+                                    clock=self.clock)
+        self.forward_cache = None
+        self.serve_stale = False
+        if 'forward_cache' in self.config:
+            cache_config = self.config['forward_cache']
+            self.serve_stale = cache_config.get('serve_stale', False)
+            self.stale_client_timeout = cache_config.get('stale_client_timeout', 1.8)
+            self.stale_answer_ttl = cache_config.get('stale_answer_ttl', 30)
+            max_stale_age = 0
+            if self.serve_stale:
+                max_stale_age = cache_config.get('max_stale_age', 86400)
+            if 'shared_file' in cache_config:
+                self.forward_cache = core.shmcache.SharedForwardCache(
+                                        cache_config['shared_file'],
+                                        slots=cache_config.get('max_entries', 10000),
+                                        slot_size=cache_config.get('slot_size', 512),
+                                        max_stale_age=max_stale_age,
+                                        clock=self.clock)
+            else:
+                self.forward_cache = core.cache.ForwardCache(
+                                        max_entries=cache_config.get('max_entries', 10000),
+                                        max_stale_age=max_stale_age,
+                                        clock=self.clock)
+        self.views = None
+        if 'views' in self.config:
+            self.views = core.views.Views(self.config)
+        # the upstreams of the domain rules, created now and shared by all
+        # queries (and views) that forward to them
+        self.upstreams = core.upstream.UpstreamPool(clock=self.clock)
+        configs = [self.config]
+        if self.views is not None:
+            configs.extend(self.views.views.values())
+        for config in configs:
+            if not 'domain_config' in config:
+                continue
+            for value in config['domain_config'].values():
+                if value.upstream is not None:
+                    self.upstreams.get(value.upstream)
+        self.zones = None
+        if 'zone_files' in self.config:
+            self.zones = core.zones.ZoneStore.fromConfig(self.config['zone_files'])
+        self.forwards_in_flight = 0
+        # empty answers that FakeDnsProxy generated itself
+        self.nxdomain_answers = 0
+        self.nodata_answers = 0
+        self.forward_limiter = None
+        if 'forward_limits' in self.config:
+            self.forward_limiter = core.limits.ForwardLimiter(
+                                    self.config['forward_limits'], clock=self.clock)
+        self.answer_policy = None
+        if 'answer_policy' in self.config:
+            self.answer_policy = core.answerpolicy.AnswerPolicy(
+                                    self.config['answer_policy'])
+        self.heavy_hitters = None
+        if 'heavy_hitters' in self.config:
+            self.heavy_hitters = core.stats.HeavyHitters(
+                                    self.config['heavy_hitters'].get('size', 100))
+
+    def recordQuery(self, query, address, action):
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.record(str(query.name), address, action)
+
+    def getConfigForClient(self, address):
+        """
+        Returns the config of the view the client belongs to, or the global
+        config if there are no views or the client is in none of them.
+        """
+        if self.views is None:
+            return self.config
+        return self.views.getConfig(address, self.config)
  
-    def get_action_for_query(self, query):
-        if 'domain_config' in self.config:
-            domain_configs = self.config['domain_config']
-            query_name = str(query.name)
-            try:
-                d = core.dns_reply_generators.DNSReplyGenerator(self.config)
-                domain_config = d.getDomainConfigEntry(query_name)
-                if domain_config == 'forward' or \
-                    domain_config == 'nxdomain' or \
-                    domain_config == 'default_value':
-                        return domain_config
-                else:
-                    return "custom_value"
-            except:
-                # fall through default policy
-                pass
-        return self.config['default_dns_policy'] 
-
-    def _dynamicResponseRequired(self, query):
+    def findDomainConfigEntry(self, query, address=None):
+        """
+        Returns the domain_config entry for the query of the client, or None.
+        """
+        config = self.getConfigForClient(address)
+        if not 'domain_config' in config:
+            return None
+        d = core.dns_reply_generators.DNSReplyGenerator(config)
+        return d.findDomainConfigEntry(str(query.name))
+
+    def get_action_for_query(self, query, address=None):
+        domain_config = self.findDomainConfigEntry(query, address)
+        if domain_config is not None:
+            policy = domain_config.getPolicy()
+            if policy is not None:
+                return policy
+            return "custom_value"
+        if self.zones is not None and \
+                self.zones.findZone(query.name.name.decode()) is not None:
+            return "zone"
+        return self.getConfigForClient(address)['default_dns_policy']
+
+    def getResolverForQuery(self, query, address=None):
+        """
+        Returns the upstream of the domain rule for the query, or the
+        dns_server if the rule does not name one. If the upstream of the
+        rule is down and the rule has fallback enabled, the dns_server is
+        used as well.
+        """
+        domain_config = self.findDomainConfigEntry(query, address)
+        if domain_config is None or domain_config.upstream is None:
+            return self.resolver
+        upstream = self.upstreams.get(domain_config.upstream)
+        if domain_config.fallback and not upstream.isHealthy():
+            return self.resolver
+        return upstream
+
+    def _dynamicResponseRequired(self, query, address=None, action=None):
         """
         This method decides whether any special handling for the DNS query
         is required. The decision is based on the configuration defined by the
@@ -47,40 +167,194 @@ class DNSHandler(object):
         in method _doDynamicResponse. Otherwise, the query will be sent to the
         configured dns_server in the user configuration file
         """
-        action = self.get_action_for_query(query)
-        if action in [ 'forward', 'nxdomain', 'default_value', 'custom_value' ]:
+        if action is None:
+            action = self.get_action_for_query(query, address)
+        if action in [ 'forward', 'nxdomain', 'default_value', 'custom_value',
+                       'zone' ]:
             return True
 
         raise RuntimeError("ERROR: Do not now how to handle this query with"
                 " the default policy {}. This is a bug!".format(self.config['default_dns_policy']))
 
-    def _doDynamicResponse(self, query, timeout=None):
+    def _doDynamicResponse(self, query, timeout=None, address=None, trace=None,
+                           action=None):
         """
         This method creates special responses based on the configuraiton provided
         by the user.
         """ 
-        action = self.get_action_for_query(query)
+        if action is None:
+            action = self.get_action_for_query(query, address)
+        if trace is not None:
+            trace.mark('policy')
+            trace.args['action'] = action
+        self.recordQuery(query, address, action)
         if action == "forward":
-            return self.resolver.query(query, timeout)
+            return self._forwardQuery(query, timeout, address, trace)
+        try:
+            response = self.generateReply(action, query, address)
+        except core.zones.ZoneNameError:
+            # counted here and not in generateReply, as the fast path hands
+            # these queries to the normal path
+            self.nxdomain_answers += 1
+            return defer.fail()
+        if trace is not None:
+            trace.mark('answer')
+        return defer.succeed(response)
+
+    def generateReply(self, action, query, address=None):
+        """
+        Generates the (answers, authority, additional) for all actions that
+        do not forward the query.
+        """
+        config = self.getConfigForClient(address)
         if action == "nxdomain":
-            gen = core.dns_reply_generators.NXDomainReply(self.config)
-            return defer.succeed(gen.generateReply(query))
-        if action == "default_value":
-            gen = core.dns_reply_generators.DefaultValueReply(self.config)
-            return defer.succeed(gen.generateReply(query))
-        if action == "custom_value":
-            gen = core.dns_reply_generators.CustomValueReply(self.config)
-            return defer.succeed(gen.generateReply(query))
+            gen = core.dns_reply_generators.NXDomainReply(config)
+        elif action == "default_value":
+            gen = core.dns_reply_generators.DefaultValueReply(config)
+        elif action == "custom_value":
+            gen = core.dns_reply_generators.CustomValueReply(config)
+        elif action == "zone":
+            gen = core.dns_reply_generators.ZoneReply(config, self.zones)
+        else:
+            raise RuntimeError("ERROR: requested action {}, which could not be"
+                    " provided by DNSHandler!".format(action))
+        response = gen.generateReply(query, address)
+        ans, auth, _ = response
+        if not ans:
+            # an SOA in the authority section marks NODATA, see
+            # CustomDNSServerFactory.getResponseCode
+            if any(r.type == dns.SOA for r in auth):
+                self.nodata_answers += 1
+            elif not any(r.type == dns.NS for r in auth):
+                self.nxdomain_answers += 1
+        return response
+
+    def _forwardQuery(self, query, timeout=None, address=None, trace=None):
+        """
+        Sends the query to the dns_server. If a forward_cache is configured,
+        fresh answers are served from the cache. With serve_stale enabled, 
+        an expired answer is returned to the client if the dns_server does
+        not answer within stale_client_timeout seconds, while the refresh
+        of the cache entry continues in the background.
+
+        Only answers of the dns_server are cached: the upstreams of domain
+        rules can answer differently (e.g. per view), and the cache key
+        does not tell them apart.
+        """
+        resolver = self.getResolverForQuery(query, address)
+        if self.forward_cache is None or resolver is not self.resolver:
+            return self._queryUpstream(query, timeout, address, trace, resolver)
+
+        cached = self.forward_cache.lookup(query)
+        if cached is not None and not cached[1]:
+            if trace is not None:
+                trace.mark('cache_hit')
+            return defer.succeed(cached[0])
+
+        upstream = self._queryUpstream(query, timeout, address, trace, resolver)
+        upstream.addCallback(self._cacheForwardResponse, query)
+        if cached is None or not self.serve_stale:
+            return upstream
+        return self._raceStaleAnswer(upstream, cached[0])
+
+    def _queryUpstream(self, query, timeout=None, address=None, trace=None,
+                       resolver=None):
+        """
+        Sends the query to the resolver, by default the one of
+        getResolverForQuery. With forward_limits, the query waits for a
+        free slot first, and fails with ForwardQueryShed if there is none
+        (which the client gets as SERVFAIL, or as a stale answer with
+        serve_stale).
+        """
+        if resolver is None:
+            resolver = self.getResolverForQuery(query, address)
+        if self.forward_limiter is None:
+            d = self._sendUpstream(resolver, query, timeout, trace)
+        else:
+            client_ip = address[0] if address is not None else None
+
+            def send(_):
+                d = self._sendUpstream(resolver, query, timeout, trace)
+                def release(result):
+                    self.forward_limiter.release(client_ip)
+                    return result
+                return d.addBoth(release)
+            d = self.forward_limiter.acquire(client_ip).addCallback(send)
+        if self.answer_policy is not None:
+            # before the forward_cache, so that cached answers are checked
+            # only once
+            d.addCallback(self._filterForwardResponse, query)
+        return d
+
+    def _filterForwardResponse(self, response, query):
+        filtered = self.answer_policy.filterResponse(response, query.type)
+        if filtered is None:
+            # the name exists, but none of its answers may be used
+            gen = core.dns_reply_generators.DNSReplyGenerator(self.config)
+            return gen.generateNoDataReply(query)
+        return filtered
+
+    def _sendUpstream(self, resolver, query, timeout=None, trace=None):
+        self.forwards_in_flight += 1
+        if trace is not None:
+            trace.mark('upstream_sent')
+        def done(result):
+            self.forwards_in_flight -= 1
+            if trace is not None:
+                trace.mark('upstream_received')
+            return result
+        return resolver.query(query, timeout).addBoth(done)
+
+    def _cacheForwardResponse(self, response, query):
+        self.forward_cache.store(query, response)
+        return response
+
+    def _raceStaleAnswer(self, upstream, stale_response):
+        """
+        Returns a Deferred that fires with the upstream answer if it arrives
+        before the client deadline, and with the stale answer otherwise.
+        """
+        result = defer.Deferred()
+        stale_response = tuple(
+                core.cache.copyRecords(records, self.stale_answer_ttl)
+                for records in stale_response)
+
+        def serveStale():
+            if not result.called:
+                result.callback(stale_response)
+
+        timer = self.clock.callLater(self.stale_client_timeout, serveStale)
 
-        raise RuntimeError("ERROR: requested action {}, which could not be"
-                " provided by DNSHandler!".format(action))
+        def gotUpstreamResponse(response):
+            if timer.active():
+                timer.cancel()
+            if not result.called:
+                result.callback(response)
 
-    def query(self, query, timeout=None):
+        def gotUpstreamError(failure):
+            if timer.active():
+                timer.cancel()
+            if failure.check(*STALE_ERRORS):
+                # an unreachable or failing upstream is answered with the
+                # stale data right away (RFC 8767)
+                serveStale()
+            elif not result.called:
+                # e.g. NXDOMAIN, the upstream answered
+                result.errback(failure)
+
+        upstream.addCallbacks(gotUpstreamResponse, gotUpstreamError)
+        return result
+
+    def query(self, query, timeout=None, address=None, trace=None, action=None):
         """
         This method decides how to handle 
         """
-        if self._dynamicResponseRequired(query):
-            return self._doDynamicResponse(query)
+        # the action is decided once per query
+        if action is None:
+            action = self.get_action_for_query(query, address)
+        if self._dynamicResponseRequired(query, address, action):
+            return self._doDynamicResponse(query, address=address, trace=trace,
+                                           action=action)
         else:
             return defer.fail(error.DomainError())
 
@@ -99,8 +373,83 @@ class CustomDNSServerFactory(server.DNSServerFactory):
     """
     def __init__(self, authorities=None, caches=None, clients=None, verbose=0): 
         self.logger = Logger()
+        self.dns_handler = None
+        # emit a structured dns_query event per answer, see core.querylog
+        self.log_query_events = False
+        # a core.tracing.QueryTracer if queries are traced
+        self.tracer = None
+        # the action the fast path decided for the datagram it hands to the
+        # normal path, see messageReceived
+        self.fast_path_action = None
+        for c in clients or []:
+            if isinstance(c, DNSHandler):
+                self.dns_handler = c
         super().__init__(authorities, caches, clients, verbose)
 
+    def handleQuery(self, message, protocol, address):
+        """
+        Same as DNSServerFactory.handleQuery, but the address of the client is
+        passed on to the DNSHandler, as its answer can depend on the client.
+        """
+        if self.dns_handler is None:
+            return super().handleQuery(message, protocol, address)
+        query = message.queries[0]
+        # only queries are traced, as only their traces are finished
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.startTrace(address)
+            message.trace = trace
+        if trace is not None:
+            trace.args['qname'] = query.name.name.decode()
+            trace.args['qtype'] = dns.QUERY_TYPES.get(query.type, str(query.type))
+        d = self.dns_handler.query(query, address=address, trace=trace,
+                                   action=getattr(message, 'action', None)) \
+                .addCallback(self.gotResolverResponse, protocol, message, address) \
+                .addErrback(self.gotResolverError, protocol, message, address)
+        if trace is not None:
+            d.addBoth(self._finishTrace, trace)
+        return d
+
+    def messageReceived(self, message, proto, address=None):
+        message.action, self.fast_path_action = self.fast_path_action, None
+        return super().messageReceived(message, proto, address)
+
+    def _finishTrace(self, result, trace):
+        trace.mark('reply_sent')
+        self.tracer.finishTrace(trace)
+        return result
+
+    def gotResolverError(self, failure, protocol, message, address):
+        trace = getattr(message, 'trace', None)
+        if trace is not None:
+            trace.args['error'] = failure.type.__name__
+        if failure.check(core.zones.ZoneNameError):
+            # NXDOMAIN inside a zone, with the SOA of the zone
+            authority = failure.value.authority
+            self.logResponse(([], authority, []), message.queries[0], address)
+            response = self._responseFromMessage(message=message,
+                                                 rCode=dns.ENAME,
+                                                 authority=authority)
+            response.auth = True
+            self.sendReply(protocol, response, address)
+            return
+        # DNSServerError is a DomainError, but must not become NXDOMAIN
+        if failure.check(error.DNSServerError):
+            rcode = dns.ESERVER
+        elif failure.check(dns.DomainError, dns.AuthoritativeDomainError):
+            rcode = dns.ENAME
+        else:
+            rcode = dns.ESERVER
+        self.logResponse(([], [], []), message.queries[0], address, rcode=rcode)
+        if failure.check(error.DNSServerError):
+            # SERVFAIL upstreams and shed queries (ForwardQueryShed) are
+            # expected under load, do not log a traceback
+            response = self._responseFromMessage(message=message,
+                                                 rCode=dns.ESERVER)
+            self.sendReply(protocol, response, address)
+            return
+        return super().gotResolverError(failure, protocol, message, address)
+
     def getDNSAnswerRecordLog(self, rrheader):
         dns_record = rrheader.payload
         result = "{} - {} - ".format(dns.QUERY_TYPES[rrheader.type],
@@ -115,39 +464,90 @@ class CustomDNSServerFactory(server.DNSServerFactory):
         return result
 
     def getDNSResponseLogMessage(self, response, protocol, message, address):
-        ans, _, _ = response
         if len(message.queries) > 1:
             raise RuntimeError("ERROR: received request with more than one query!"
                     " cannot handle that!")
-        query = message.queries[0]
+        return self.getQueryLogMessages(response, message.queries[0], address)
+
+    def getQueryLogMessages(self, response, query, address, rcode=None):
+        ans, _, _ = response
         if len(ans) == 0:
-            return [ 'Request from - {}:{} - Query: {}:{} - Answer: NXDomain'.format(
-                        address[0], address[1], dns.QUERY_TYPES[query.type],
-                        query.name.name.decode()) ]
+            if rcode is None:
+                rcode = self.getResponseCode(response)
+            if rcode == dns.OK:
+                answer = 'NoData'
+            elif rcode == dns.ENAME:
+                answer = 'NXDomain'
+            else:
+                answer = core.querylog.RCODE_NAMES.get(rcode, str(rcode))
+            return [ 'Request from - {}:{} - Query: {}:{} - Answer: {}'.format(
+                        address[0], address[1], dns.QUERY_TYPES.get(query.type, str(query.type)),
+                        query.name.name.decode(), answer) ]
         
         result = []
 
         for a in ans:
             ans_string = self.getDNSAnswerRecordLog(a)
             result.append('Request from - {}:{} - Query: {}:{} - Answer: {}'.format(
-                address[0], address[1], dns.QUERY_TYPES[query.type],
+                address[0], address[1], dns.QUERY_TYPES.get(query.type, str(query.type)),
                 query.name.name.decode(), ans_string))
 
         return result
 
-    def gotResolverResponse(self, response, protocol, message, address):
-        ans, auth, add = response
-        log_messages = self.getDNSResponseLogMessage(response, protocol,
-                                                    message, address)
-        for m in log_messages:
+    def getQueryLogRecord(self, response, query, address, rcode=None):
+        ans, _, _ = response
+        if rcode is None:
+            rcode = self.getResponseCode(response)
+        return { 'client': address[0],
+                 'port': address[1],
+                 'qname': query.name.name.decode(),
+                 'qtype': dns.QUERY_TYPES.get(query.type, str(query.type)),
+                 'rcode': core.querylog.RCODE_NAMES.get(rcode, str(rcode)),
+                 'answers': ', '.join(self.getDNSAnswerRecordLog(a) for a in ans) }
+
+    def logResponse(self, response, query, address, rcode=None):
+        """
+        Logs the response to query, rcode overrides the response code that
+        is derived from the response, e.g. for failed lookups.
+        """
+        for m in self.getQueryLogMessages(response, query, address, rcode):
             self.logger.info(m)
+        if self.log_query_events:
+            # no format, so that the text log ignores the event
+            self.logger.info(dns_query=self.getQueryLogRecord(response, query,
+                                                              address, rcode))
+
+    def getResponseCode(self, response):
+        ans, auth, _ = response
         if len(ans) > 0:
+            return dns.OK
+        # the name exists, but has no records of the type (NODATA), or
+        # is delegated to other name servers (referral)
+        if any(r.type in (dns.SOA, dns.NS) for r in auth):
+            return dns.OK
+        return dns.ENAME
+
+    def gotResolverResponse(self, response, protocol, message, address):
+        ans, auth, add = response
+        if len(message.queries) > 1:
+            raise RuntimeError("ERROR: received request with more than one query!"
+                    " cannot handle that!")
+        self.logResponse(response, message.queries[0], address)
+        rcode = self.getResponseCode(response)
+        trace = getattr(message, 'trace', None)
+        if trace is not None:
+            trace.mark('logged')
+            trace.args['rcode'] = core.querylog.RCODE_NAMES.get(rcode, str(rcode))
+        if rcode == dns.OK and ans:
             # here we go to the parent as there is an answer
             return super().gotResolverResponse(response, protocol, message, address)
 
         response = self._responseFromMessage(
-                                message=message, rCode=dns.ENAME,
+                                message=message, rCode=rcode,
                                 answers=ans, authority=auth, additional=add)
+        # NODATA of a zone: its SOA makes the empty answer authoritative
+        if any(r.auth for r in auth):
+            response.auth = True
         self.sendReply(protocol, response, address)
 
         l = len(ans) + len(auth) + len(add)
@@ -169,19 +569,273 @@ class FakeDnsProxy:
         self.is_setup = True
         self.config.generate_config_objects()
         self.dns_handler = DNSHandler(self.config)
+        self.factory = CustomDNSServerFactory(clients=[self.dns_handler])
+        self.port = self.listen(self.factory)
+        self.loops = []
+        self.udp_monitor = None
+        self.setupSocket(self.config['listening_info'])
+        self.admin_port = None
+        self.handoff_port = None
+        self.watchdog = None
+        if 'watchdog' in self.config:
+            self.setupWatchdog(self.config['watchdog'])
+        if 'tracing' in self.config:
+            self.setupTracing(self.config['tracing'])
+        if self.dns_handler.heavy_hitters is not None:
+            self.setupHeavyHitters(self.config['heavy_hitters'])
+        if 'forward_cache' in self.config and \
+                'snapshot_file' in self.config['forward_cache']:
+            self.setupCacheSnapshots(self.config['forward_cache'])
+        if 'query_log' in self.config:
+            self.setupQueryLog(self.config['query_log'])
+        self.memory_monitor = None
+        if 'memory' in self.config:
+            self.setupMemory(self.config['memory'])
+        if 'admin_socket' in self.config:
+            self.admin_port = self.listenAdmin(self.config['admin_socket'])
+        if 'handoff' in self.config:
+            self.handoff_port = reactor.listenUNIX(
+                                    self.config['handoff']['path'],
+                                    core.handoff.HandoffFactory(self),
+                                    mode=0o600, wantPID=True)
+        if self.memory_monitor is not None:
+            frozen = self.memory_monitor.freeze()
+            if frozen:
+                self.factory.logger.info("Froze {} objects for the garbage "
+                                         "collector".format(frozen))
+
+    def listen(self, factory):
+        """
+        Binds the listening socket, or takes it over from the running
+        FakeDnsProxy if a handoff is configured (see core.handoff).
+        """
+        responder = None
+        if 'fast_path' in self.config and self.config['fast_path']:
+            responder = core.fastpath.FastPathResponder(self.dns_handler, factory)
+
+        handoff = None
+        if 'handoff' in self.config:
+            handoff = core.handoff.receiveSocket(self.config['handoff']['path'])
+
+        if 'engine' in self.config and self.config['engine'] == 'asyncio':
+            sock = None
+            if handoff is not None:
+                sock = socket.socket(fileno=handoff[1])
+            port = core.aio.listenUDP(reactor,
+                                      self.config['listening_info']['port'],
+                                      factory,
+                                      interface=self.config['listening_info']['ip'],
+                                      responder=responder,
+                                      sock=sock,
+                                      max_read_bytes=self.config['listening_info'].get(
+                                          'max_read_bytes', 256 * 1024))
+        else:
+            if responder is not None:
+                protocol = core.fastpath.FastPathDNSDatagramProtocol(factory, responder)
+            else:
+                protocol = dns.DNSDatagramProtocol(controller=factory)
+
+            if handoff is not None:
+                # the reactor serves a duplicate of the descriptor
+                port = reactor.adoptDatagramPort(handoff[1], handoff[2], protocol)
+                os.close(handoff[1])
+            else:
+                port = reactor.listenUDP(self.config['listening_info']['port'], 
+                                         protocol, 
+                                         interface=self.config['listening_info']['ip'])
+
+        if handoff is not None:
+            core.handoff.finishHandoff(handoff[0])
+            factory.logger.info("Took over the listening socket from the "
+                                "running FakeDnsProxy")
+        return port
+
+    def getListeningSocket(self):
+        return self.port.fileno(), self.port.addressFamily
+
+    def handOff(self):
+        """
+        Called once a new FakeDnsProxy serves our listening socket. We stop
+        reading from it and release the Unix domain sockets for the new
+        process. The queries that are still forwarded are answered before
+        the reactor is stopped, up to drain_timeout seconds.
+        """
+        self.factory.logger.info("Handed the listening socket over, draining "
+                                 "{} forwarded queries".format(
+                                     self.dns_handler.forwards_in_flight))
+        self.port.stopReading()
+        if self.udp_monitor is not None:
+            # the new process accounts the drops of the shared socket
+            self.udp_monitor.stop()
+        if 'forward_cache' in self.config and \
+                'snapshot_file' in self.config['forward_cache']:
+            # the new process loads the snapshot once we are done
+            self.dumpForwardCache(self.config['forward_cache']['snapshot_file'])
+        stopped = []
+        for name in ['handoff_port', 'admin_port']:
+            port = getattr(self, name)
+            if port is not None:
+                setattr(self, name, None)
+                stopped.append(defer.maybeDeferred(port.stopListening))
+        deadline = reactor.seconds() + self.config['handoff'].get('drain_timeout', 5)
+
+        def checkDrained():
+            if self.dns_handler.forwards_in_flight > 0 and \
+                    reactor.seconds() < deadline:
+                return
+            drain.stop()
+            self.stopListening()
+            reactor.stop()
+        drain = task.LoopingCall(checkDrained)
+        drain.start(0.05)
+        return defer.gatherResults(stopped)
+
+    def listenAdmin(self, settings):
+        controller = core.admin.AdminController(
+                        self.dns_handler,
+                        persist_file=settings.get('persist_file'),
+                        watchdog=self.watchdog,
+                        udp_monitor=self.udp_monitor,
+                        memory_monitor=self.memory_monitor)
+        return reactor.listenUNIX(settings['path'],
+                                  core.admin.AdminFactory(controller),
+                                  mode=0o600, wantPID=True)
+
+    def setupCacheSnapshots(self, settings):
+        """
+        Loads the forward_cache from the snapshot_file, and writes it back
+        every snapshot_interval seconds and on shutdown.
+        """
+        filename = settings['snapshot_file']
+        try:
+            loaded = self.dns_handler.forward_cache.load(
+                        filename, settings.get('snapshot_max_load_time', 2))
+            self.factory.logger.info("Loaded {loaded} entries from cache "
+                                     "snapshot {filename}", loaded=loaded,
+                                     filename=filename)
+        except FileNotFoundError:
+            pass
+        except (OSError, RuntimeError) as e:
+            self.factory.logger.warn("Could not load cache snapshot "
+                                     "{filename}: {error}",
+                                     filename=filename, error=e)
+        loop = task.LoopingCall(self.dumpForwardCache, filename)
+        loop.start(settings.get('snapshot_interval', 300), now=False)
+        self.loops.append(loop)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      self.dumpForwardCache, filename)
+
+    def dumpForwardCache(self, filename):
+        try:
+            self.dns_handler.forward_cache.dump(filename)
+        except OSError as e:
+            self.factory.logger.warn("Could not write cache snapshot "
+                                     "{filename}: {error}",
+                                     filename=filename, error=e)
+
+    def setupSocket(self, settings):
+        """
+        Applies the buffer sizes and the read batch size of listening_info
+        to the listening socket, and starts the drop accounting.
+        """
+        receive_buffer, send_buffer = core.udp.tuneSocket(self.port.socket,
+                                                          settings)
+        if 'receive_buffer' in settings or 'send_buffer' in settings:
+            self.factory.logger.info("UDP socket buffers: {} bytes receive, {} "
+                                     "bytes send".format(receive_buffer,
+                                                         send_buffer))
+        if 'max_read_bytes' in settings and hasattr(self.port, 'maxThroughput'):
+            # twisted reads datagrams until this many bytes per event
+            self.port.maxThroughput = settings['max_read_bytes']
+        monitor = core.udp.UDPSocketMonitor(self.port.socket,
+                                            settings.get('drop_check_interval', 60))
+        if monitor.start():
+            self.udp_monitor = monitor
+            self.loops.append(monitor.loop)
+
+    def setupWatchdog(self, settings):
+        self.watchdog = core.watchdog.ReactorWatchdog(settings)
+        self.watchdog.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.watchdog.stop)
+
+    def setupMemory(self, settings):
+        """
+        Logs the memory report and starts the memory gauges. The
+        configuration is frozen at the end of setup, when all long-lived
+        objects exist.
+        """
+        self.memory_monitor = core.memory.MemoryMonitor(self.dns_handler,
+                                                        settings)
+        if settings.get('report', True):
+            for m in self.memory_monitor.getReportMessages():
+                self.factory.logger.info(m)
+        self.memory_monitor.start()
+        self.loops.append(self.memory_monitor.loop)
+
+    def setupTracing(self, settings):
+        tracer = core.tracing.QueryTracer(
+                    settings['file'],
+                    sample_rate=settings.get('sample_rate', 0.01),
+                    max_traces=settings.get('max_traces', 100000))
+        self.factory.tracer = tracer
+        loop = task.LoopingCall(tracer.flush)
+        loop.start(settings.get('flush_interval', 5), now=False)
+        self.loops.append(loop)
+        reactor.addSystemEventTrigger('after', 'shutdown', tracer.close)
+
+    def setupQueryLog(self, settings):
+        observer = core.querylog.SQLiteQueryLogObserver(
+                        settings['database'],
+                        batch_size=settings.get('batch_size', 500),
+                        flush_interval=settings.get('flush_interval', 1),
+                        retention=settings.get('retention', 7 * 86400))
+        observer.start()
+        globalLogPublisher.addObserver(observer)
+        self.factory.log_query_events = True
+
+        def stop():
+            globalLogPublisher.removeObserver(observer)
+            observer.stop()
+        reactor.addSystemEventTrigger('after', 'shutdown', stop)
+
+    def setupHeavyHitters(self, settings):
+        """
+        The heavy hitters are logged on SIGUSR1 and written to the
+        snapshot_file every snapshot_interval seconds.
+        """
+        def dump(signum, frame):
+            reactor.callFromThread(self.logHeavyHitters)
+        signal.signal(signal.SIGUSR1, dump)
+        if 'snapshot_file' in settings:
+            loop = task.LoopingCall(self.snapshotHeavyHitters,
+                                    settings['snapshot_file'])
+            loop.start(settings.get('snapshot_interval', 60), now=False)
+            self.loops.append(loop)
 
-        factory = CustomDNSServerFactory(clients=[self.dns_handler])
-        protocol = dns.DNSDatagramProtocol(controller=factory)
+    def snapshotHeavyHitters(self, filename):
+        try:
+            self.dns_handler.heavy_hitters.snapshot(filename)
+        except OSError as e:
+            self.factory.logger.warn("Could not write heavy hitters snapshot "
+                                     "{filename}: {error}",
+                                     filename=filename, error=e)
 
-        self.port = reactor.listenUDP(self.config['listening_info']['port'], 
-                                      protocol, 
-                                      interface=self.config['listening_info']['ip'])
+    def logHeavyHitters(self):
+        for m in self.dns_handler.heavy_hitters.getLogMessages():
+            self.factory.logger.info(m)
 
-   
     def run(self):
         self.setup()
         return reactor.run()
 
     def stopListening(self):
         if self.is_setup: 
+            for loop in self.loops:
+                if loop.running:
+                    loop.stop()
+            for port in [self.admin_port, self.handoff_port]:
+                if port is not None:
+                    port.stopListening()
+            self.admin_port = None
+            self.handoff_port = None
             return self.port.stopListening()
@@ -0,0 +1,193 @@
+"""
+Matching of query names against the domains in domain_config
+"""
+
+import re
+
+
+def translateGlob(pattern):
+    """
+    Translates a domain pattern into a regular expression. Supported are
+        *       any sequence of characters (including dots)
+        ?       exactly one character
+        [abc]   one of the characters a, b, c; ranges like [0-9] work as well
+        [!abc]  any character except a, b, c
+    """
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            result.append('.*')
+        elif c == '?':
+            result.append('.')
+        elif c == '[':
+            end = pattern.find(']', i + 1 if i < n and pattern[i] == '!' else i)
+            if end < 0:
+                raise RuntimeError("ERROR: domain pattern {} contains an "
+                                   "unterminated '['".format(pattern))
+            chars = pattern[i:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            result.append('[' + chars + ']')
+            i = end + 1
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
+
+
+def isPattern(domain):
+    return any(c in domain for c in '*?[')
+
+
+class DomainMatcher:
+    """
+    Finds the entry of domain_config for a query name. The rules have the
+    priority of their order in domain_config: the first rule that matches
+    the whole query name (case-insensitive) wins.
+
+    Names without wildcards are looked up in a dict. Patterns of the form
+    *.suffix, where suffix has no wildcards, are indexed by their suffix:
+    a lookup checks the suffixes of the query name behind each of its dots
+    in a dict, so it costs one dict lookup per label, independent of the
+    number of rules. All other patterns are matched one by one, in
+    priority order.
+
+    Rules can be added and removed at runtime (see add and remove), which
+    keeps domain_config in sync.
+    """
+    def __init__(self, domain_config):
+        self.domain_config = domain_config
+        # (domain, value) in priority order, None for removed rules
+        self.rules = []
+        # domain -> index of its rule
+        self.indices = dict()
+        # name -> indices of the rules without wildcards for that name
+        self.exact = dict()
+        # suffix -> indices of the rules *.suffix
+        self.suffixes = dict()
+        # (index, regex) of the other patterns, in priority order
+        self.patterns = []
+        for domain, value in domain_config.items():
+            self._addRule(domain, value, self._compile(domain))
+
+    def _normalize(self, domain):
+        return domain.rstrip('.').lower()
+
+    def _compile(self, domain):
+        """
+        Returns the regex for domain if it is a pattern that is not indexed
+        by its suffix, and None otherwise.
+        """
+        name = self._normalize(domain)
+        if not isPattern(name) or self._getSuffix(name) is not None:
+            return None
+        try:
+            return re.compile(translateGlob(name), re.IGNORECASE | re.DOTALL)
+        except re.error as e:
+            raise RuntimeError("ERROR: invalid domain pattern {}: "
+                               "{}".format(domain, e))
+
+    def _getSuffix(self, name):
+        if name.startswith('*.') and not isPattern(name[2:]):
+            return name[2:]
+        return None
+
+    def _addRule(self, domain, value, regex):
+        """
+        Appends a rule, regex is the result of _compile for domain.
+        """
+        index = len(self.rules)
+        self.rules.append((domain, value))
+        self.indices[domain] = index
+        name = self._normalize(domain)
+        if regex is not None:
+            self.patterns.append((index, regex))
+            return
+        suffix = self._getSuffix(name)
+        if suffix is not None:
+            self.suffixes.setdefault(suffix, []).append(index)
+        else:
+            self.exact.setdefault(name, []).append(index)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def add(self, domain, value):
+        """
+        Sets the value for domain. An existing rule keeps its priority, a
+        new rule gets the lowest priority, as if it was appended to the end
+        of domain_config.
+        """
+        if domain in self.indices:
+            self.rules[self.indices[domain]] = (domain, value)
+            self.domain_config[domain] = value
+            return
+        # before any change, an invalid pattern must not leave a rule behind
+        regex = self._compile(domain)
+        self._addRule(domain, value, regex)
+        self.domain_config[domain] = value
+
+    def remove(self, domain):
+        """
+        Removes the rule for domain. Raises KeyError if there is none.
+        """
+        index = self.indices.pop(domain)
+        self.rules[index] = None
+        del self.domain_config[domain]
+        name = self._normalize(domain)
+        suffix = self._getSuffix(name)
+        if suffix is not None:
+            table, key = self.suffixes, suffix
+        elif isPattern(name):
+            self.patterns = [(i, regex) for i, regex in self.patterns
+                             if i != index]
+            return
+        else:
+            table, key = self.exact, name
+        indices = table[key]
+        indices.remove(index)
+        if not indices:
+            del table[key]
+
+    def _findSuffixIndex(self, name):
+        index = None
+        suffixes = self.suffixes
+        dot = name.find('.')
+        while dot >= 0:
+            indices = suffixes.get(name[dot + 1:])
+            if indices and (index is None or indices[0] < index):
+                index = indices[0]
+            dot = name.find('.', dot + 1)
+        return index
+
+    def findIndex(self, query_name):
+        """
+        Returns the index of the first rule matching query_name, or None.
+        """
+        name = query_name.lower()
+        indices = self.exact.get(name)
+        index = indices[0] if indices else None
+        if self.suffixes:
+            suffix_index = self._findSuffixIndex(name)
+            if suffix_index is not None and (index is None or suffix_index < index):
+                index = suffix_index
+        for pattern_index, regex in self.patterns:
+            if index is not None and pattern_index > index:
+                break
+            if regex.fullmatch(name):
+                return pattern_index
+        return index
+
+    def match(self, query_name):
+        """
+        Returns the value of the first rule matching query_name, or None.
+        """
+        index = self.findIndex(query_name)
+        if index is None:
+            return None
+        return self.rules[index][1]
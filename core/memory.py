@@ -0,0 +1,220 @@
+"""
+Memory accounting of FakeDnsProxy
+
+With a large domain_config, most objects of FakeDnsProxy are the rules and
+their answers, which live as long as the configuration. The cyclic garbage
+collector walks all of them on every full collection, although none of them
+ever become garbage. Freezing moves them into the permanent generation of
+the collector (gc.freeze), so that collections only walk the objects
+created afterwards.
+
+The memory report measures how much memory each structure takes, by
+following the references of its objects (see measure), and the gauges read
+the memory of the process and the counters of the collector regularly.
+"""
+
+import collections
+import gc
+import os
+import re
+import resource
+import sys
+
+from twisted.internet import reactor, task
+
+
+# objects that are measured without following their references
+ATOMS = (str, bytes, bytearray, int, float, complex, bool, type(None),
+         re.Pattern)
+CONTAINERS = (dict, list, tuple, set, frozenset, collections.deque)
+# instances of classes of these modules are followed through their
+# attributes; everything else (the reactor, loggers, sockets) is shared
+# with the rest of the process and not counted
+MEASURED_MODULES = ('core.', 'twisted.names.dns', 'ipaddress')
+ATOM, DICT, SEQUENCE = 'atom', 'dict', 'sequence'
+
+
+def classify(cls):
+    """
+    Returns how measure treats instances of cls: None (not counted), ATOM,
+    DICT, SEQUENCE or the tuple of the slots of the instance.
+    """
+    if issubclass(cls, ATOMS):
+        return ATOM
+    if issubclass(cls, dict):
+        return DICT
+    if issubclass(cls, CONTAINERS):
+        return SEQUENCE
+    if not cls.__module__.startswith(MEASURED_MODULES):
+        return None
+    slots = []
+    for klass in cls.__mro__:
+        names = vars(klass).get('__slots__', ())
+        slots.extend([names] if isinstance(names, str) else names)
+    return tuple(slots)
+
+
+def measure(roots, seen):
+    """
+    Returns (bytes, objects) of the objects reachable from roots that are
+    not in seen (a set of ids), and adds them to seen, so that objects
+    shared by several structures are only counted for the first one.
+    """
+    size = 0
+    count = 0
+    stack = list(roots)
+    kinds = dict()
+    # local names, this loop runs for every object of the configuration
+    pop, push, extend = stack.pop, stack.append, stack.extend
+    add, getsizeof = seen.add, sys.getsizeof
+    while stack:
+        obj = pop()
+        key = id(obj)
+        if key in seen:
+            continue
+        cls = type(obj)
+        kind = kinds.get(cls, False)
+        if kind is False:
+            kind = kinds[cls] = classify(cls)
+        if kind is None:
+            continue
+        add(key)
+        size += getsizeof(obj)
+        count += 1
+        if kind is ATOM:
+            continue
+        if kind is DICT:
+            extend(obj.keys())
+            extend(obj.values())
+        elif kind is SEQUENCE:
+            extend(obj)
+        else:
+            if hasattr(obj, '__dict__'):
+                push(obj.__dict__)
+            for slot in kind:
+                if hasattr(obj, slot):
+                    push(getattr(obj, slot))
+    return size, count
+
+
+def readResidentMemory():
+    """
+    Returns the resident memory of the process in bytes, or None.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def formatBytes(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GiB'.format(size)
+
+
+class MemoryMonitor:
+    """
+    Reports the memory of the structures of a DNSHandler, freezes the
+    configuration for the garbage collector, and keeps gauges of the memory
+    of the process that are updated every gauge_interval seconds.
+    """
+    def __init__(self, dns_handler, settings, clock=None):
+        self.dns_handler = dns_handler
+        self.settings = settings
+        self.clock = clock or reactor
+        self.rss = None
+        self.peak_rss = None
+        self.loop = task.LoopingCall(self.update)
+        self.loop.clock = self.clock
+
+    def start(self):
+        self.loop.start(self.settings.get('gauge_interval', 60))
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def freeze(self):
+        """
+        Collects the garbage and moves all remaining objects into the
+        permanent generation. Frozen objects are still freed when they are
+        no longer referenced (e.g. a removed rule), unless they are part of
+        a reference cycle. Returns the number of frozen objects.
+        """
+        if not self.settings.get('freeze', True):
+            return 0
+        gc.collect()
+        gc.freeze()
+        return gc.get_freeze_count()
+
+    def getStructures(self):
+        """
+        Returns (name, roots) of the structures of the report. Structures
+        are measured in this order, shared objects count for the first.
+        """
+        handler = self.dns_handler
+        configs = [handler.config]
+        if handler.views is not None:
+            configs.extend(handler.views.views.values())
+        answers = []
+        rules = []
+        for config in configs:
+            if 'default_dns_value' in config:
+                answers.append(config['default_dns_value'])
+            if 'domain_config' in config:
+                answers.extend(config['domain_config'].values())
+                rules.append(config['domain_config'])
+            if 'domain_matcher' in config:
+                rules.append(config['domain_matcher'])
+        if handler.views is not None:
+            rules.append(handler.views.tree)
+        return [('answers', answers),
+                ('rules', rules),
+                ('zones', [handler.zones]),
+                ('forward_cache', [handler.forward_cache]),
+                ('heavy_hitters', [handler.heavy_hitters])]
+
+    def getReport(self):
+        """
+        Returns (name, bytes, objects) for each structure.
+        """
+        seen = set()
+        # None stands for a structure that is not configured
+        seen.add(id(None))
+        report = []
+        for name, roots in self.getStructures():
+            size, count = measure(roots, seen)
+            report.append((name, size, count))
+        return report
+
+    def getReportMessages(self):
+        messages = ['Memory of {}: {} in {} objects'.format(name, formatBytes(size),
+                                                            count)
+                    for name, size, count in self.getReport()]
+        messages.append('Objects tracked by the garbage collector: {}, frozen: '
+                        '{}'.format(len(gc.get_objects()), gc.get_freeze_count()))
+        rss = readResidentMemory()
+        if rss is not None:
+            messages.append('Resident memory: {}'.format(formatBytes(rss)))
+        return messages
+
+    def update(self):
+        self.rss = readResidentMemory()
+        # ru_maxrss is in kilobytes on Linux
+        self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def getStats(self):
+        stats = []
+        if self.rss is not None:
+            stats.append(('memory_rss_bytes', self.rss))
+        if self.peak_rss is not None:
+            stats.append(('memory_peak_rss_bytes', self.peak_rss))
+        stats.append(('gc_frozen_objects', gc.get_freeze_count()))
+        for generation, gen_stats in enumerate(gc.get_stats()):
+            stats.append(('gc_gen{}_collections'.format(generation),
+                          gen_stats['collections']))
+        return stats
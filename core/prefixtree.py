@@ -0,0 +1,110 @@
+"""
+Longest prefix match over IPv4 and IPv6 addresses
+"""
+
+import ipaddress
+import socket
+
+
+# node layout: [child for bit 0, child for bit 1, has_value, value]
+ZERO, ONE, HAS_VALUE, VALUE = range(4)
+
+
+def parseAddress(address):
+    """
+    Returns (version, address as int) for an IPv4 or IPv6 address string.
+    IPv4-mapped IPv6 addresses are returned as IPv4 addresses, the zone
+    of scoped IPv6 addresses (fe80::1%eth0) is ignored.
+    """
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+    except OSError:
+        pass
+    address = address.partition('%')[0]
+    value = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+    if value >> 32 == 0xffff:
+        return 4, value & 0xffffffff
+    return 6, value
+
+
+class PrefixTree:
+    """
+    A binary radix tree that maps IPv4 and IPv6 networks to values. A lookup
+    returns the value of the longest prefix containing the address and
+    takes at most one step per address bit, independent of the number of
+    networks stored.
+    """
+    BITS = {4: 32, 6: 128}
+
+    def __init__(self):
+        self.roots = {4: [None, None, False, None],
+                      6: [None, None, False, None]}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _walk(self, network, create):
+        network = ipaddress.ip_network(network, strict=False)
+        bits = self.BITS[network.version]
+        address = int(network.network_address)
+        node = self.roots[network.version]
+        path = [node]
+        for i in range(network.prefixlen):
+            bit = (address >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, False, None]
+            node = node[bit]
+            path.append(node)
+        return path
+
+    def insert(self, network, value):
+        node = self._walk(network, True)[-1]
+        if not node[HAS_VALUE]:
+            self.size += 1
+        node[HAS_VALUE] = True
+        node[VALUE] = value
+
+    def remove(self, network):
+        """
+        Removes the network and prunes the nodes that are no longer needed.
+        Raises KeyError if the network is not stored in the tree.
+        """
+        path = self._walk(network, False)
+        if path is None or not path[-1][HAS_VALUE]:
+            raise KeyError(network)
+        path[-1][HAS_VALUE] = False
+        path[-1][VALUE] = None
+        self.size -= 1
+        for i in range(len(path) - 1, 0, -1):
+            node = path[i]
+            if node[ZERO] is not None or node[ONE] is not None or node[HAS_VALUE]:
+                break
+            parent = path[i - 1]
+            if parent[ZERO] is node:
+                parent[ZERO] = None
+            else:
+                parent[ONE] = None
+
+    def lookup(self, address, default=None):
+        """
+        Returns the value of the longest network containing address, or
+        default if no network contains it.
+        """
+        version, value = parseAddress(address)
+        return self.lookupInt(version, value, default)
+
+    def lookupInt(self, version, value, default=None):
+        node = self.roots[version]
+        result = default
+        shift = self.BITS[version] - 1
+        while node is not None:
+            if node[HAS_VALUE]:
+                result = node[VALUE]
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+            shift -= 1
+        return result
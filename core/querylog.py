@@ -0,0 +1,149 @@
+"""
+Query log of FakeDnsProxy in a SQLite database
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+from zope.interface import implementer
+
+from twisted.logger import ILogObserver, Logger
+from twisted.names import dns
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS queries (
+        time REAL NOT NULL,
+        client TEXT,
+        port INTEGER,
+        qname TEXT,
+        qtype TEXT,
+        rcode TEXT,
+        answers TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS queries_time ON queries (time)",
+    "CREATE INDEX IF NOT EXISTS queries_qname ON queries (qname, time)",
+    "CREATE INDEX IF NOT EXISTS queries_client ON queries (client, time)",
+]
+
+INSERT = "INSERT INTO queries VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+PRUNE_INTERVAL = 60
+
+RCODE_NAMES = {
+    dns.OK: 'NOERROR',
+    dns.EFORMAT: 'FORMERR',
+    dns.ESERVER: 'SERVFAIL',
+    dns.ENAME: 'NXDOMAIN',
+    dns.ENOTIMP: 'NOTIMP',
+    dns.EREFUSED: 'REFUSED',
+}
+
+
+@implementer(ILogObserver)
+class SQLiteQueryLogObserver(object):
+    """
+    Writes the dns_query events logged by CustomDNSServerFactory to a SQLite
+    database.
+
+    The observer only puts the events into a queue, all database work is
+    done by a background thread: it inserts the queued events in one
+    transaction per batch_size events or flush_interval seconds, and deletes
+    the events older than retention seconds once a minute. If the database
+    cannot keep up and max_queue events are waiting, further events are
+    dropped (and counted) instead of blocking the reactor.
+    """
+    def __init__(self, filename, batch_size=500, flush_interval=1.0,
+                 retention=None, max_queue=100000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        self.logger = Logger()
+        # create the schema right away, so that errors reach the caller
+        db = self.connect()
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+        return db
+
+    def __call__(self, event):
+        record = event.get('dns_query')
+        if record is None:
+            return
+        try:
+            self.queue.put_nowait((event.get('log_time', time.time()),
+                                   record['client'], record['port'],
+                                   record['qname'], record['qtype'],
+                                   record['rcode'], record['answers']))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='SQLiteQueryLog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes the queued events and stops the background thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def prune(self, db, now=None):
+        if self.retention is None:
+            return
+        if now is None:
+            now = time.time()
+        with db:
+            db.execute("DELETE FROM queries WHERE time < ?",
+                       (now - self.retention, ))
+
+    def run(self):
+        db = self.connect()
+        try:
+            next_prune = time.monotonic()
+            stopping = False
+            while not stopping:
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get(
+                                timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                try:
+                    if batch:
+                        with db:
+                            db.executemany(INSERT, batch)
+                        self.written += len(batch)
+                    if time.monotonic() >= next_prune:
+                        next_prune = time.monotonic() + PRUNE_INTERVAL
+                        self.prune(db)
+                except sqlite3.Error as e:
+                    self.dropped += len(batch)
+                    self.logger.error("Could not write query log to "
+                                      "{filename}: {error}",
+                                      filename=self.filename, error=e)
+        finally:
+            db.close()
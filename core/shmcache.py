@@ -0,0 +1,221 @@
+"""
+Forward cache shared by all FakeDnsProxy processes on a host
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+from twisted.internet import reactor
+
+import core.cache
+
+
+MAGIC = b'FDPC'
+VERSION = 1
+# magic, version, number of slots, slot size
+HEADER = struct.Struct('!4sIII')
+HEADER_SIZE = 64
+# sequence number, key hash, stored, expires, key length, data length
+SLOT_HEADER = struct.Struct('!IQddHH')
+SEQUENCE = struct.Struct('!I')
+# slots per bucket, a key can be stored in any slot of its bucket
+WAYS = 4
+STRIPES = 64
+# attempts to read a slot while it is being written, then it is a miss
+READ_ATTEMPTS = 3
+
+
+class SharedForwardCache:
+    """
+    A ForwardCache in a memory mapped file, so that every process that maps
+    the same file serves the answers any of them received.
+
+    The file is a hash table of fixed-size slots, grouped into buckets of
+    WAYS slots. A key is stored in one slot of the bucket selected by its
+    hash; if the bucket is full, the entry that expires first is replaced.
+    Answers that do not fit into a slot are not shared.
+
+    Writers take an fcntl lock on one of STRIPES byte ranges of the file,
+    chosen by the bucket, so writers of different buckets do not block each
+    other. Readers take no lock: every slot carries a sequence number that
+    is odd while the slot is written (a seqlock), and a reader retries if
+    the sequence number was odd or changed while it copied the slot.
+
+    Entries expire by the wall clock, which all processes share, so the
+    clock must be the reactor (or a task.Clock in tests).
+    """
+    def __init__(self, filename, slots=10000, slot_size=512,
+                 max_stale_age=0, clock=None):
+        self.filename = filename
+        self.max_stale_age = max_stale_age
+        self.clock = clock or reactor
+        slots = max(WAYS, slots + (-slots) % WAYS)
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._lock(0)
+            try:
+                self.slots, self.slot_size = self._initFile(slots, slot_size)
+            finally:
+                self._unlock(0)
+            self.buckets = self.slots // WAYS
+            self.mm = mmap.mmap(self.fd, HEADER_SIZE + self.slots * self.slot_size)
+        except:
+            os.close(self.fd)
+            raise
+
+    def _initFile(self, slots, slot_size):
+        """
+        Creates the table, or checks the table another process created.
+        Returns its (slots, slot_size).
+        """
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.ftruncate(self.fd, HEADER_SIZE + slots * slot_size)
+            os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, slots, slot_size), 0)
+            return slots, slot_size
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            raise RuntimeError("ERROR: {} is not a shared forward cache".format(
+                               self.filename))
+        magic, version, file_slots, file_slot_size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or \
+                size < HEADER_SIZE + file_slots * file_slot_size:
+            raise RuntimeError("ERROR: {} is not a shared forward cache".format(
+                               self.filename))
+        if (file_slots, file_slot_size) != (slots, slot_size):
+            raise RuntimeError("ERROR: shared forward cache {} has {} slots of "
+                               "{} bytes, but {} slots of {} bytes are "
+                               "configured".format(self.filename, file_slots,
+                                                   file_slot_size, slots,
+                                                   slot_size))
+        return slots, slot_size
+
+    def _lock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, offset)
+
+    def _unlock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, offset)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def getKey(self, query):
+        return query.name.name.lower() + struct.pack('!HH', query.type, query.cls)
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+    def _slotOffsets(self, bucket):
+        first = HEADER_SIZE + bucket * WAYS * self.slot_size
+        return range(first, first + WAYS * self.slot_size, self.slot_size)
+
+    def _readSlot(self, offset):
+        """
+        Returns (hash, stored, expires, key, data) of a slot, or None if the
+        slot is empty or could not be read consistently.
+        """
+        mm = self.mm
+        for _ in range(READ_ATTEMPTS):
+            seq, h, stored, expires, key_len, data_len = \
+                SLOT_HEADER.unpack_from(mm, offset)
+            if seq & 1:
+                continue
+            if key_len == 0:
+                return None
+            start = offset + SLOT_HEADER.size
+            payload = mm[start:start + key_len + data_len]
+            if SEQUENCE.unpack_from(mm, offset)[0] != seq:
+                continue
+            return h, stored, expires, payload[:key_len], payload[key_len:]
+        return None
+
+    def _writeSlot(self, offset, h, stored, expires, key, data):
+        mm = self.mm
+        # odd while writing; a slot left odd by a crashed writer is repaired
+        seq = (SEQUENCE.unpack_from(mm, offset)[0] + 1 | 1) & 0xffffffff
+        SEQUENCE.pack_into(mm, offset, seq)
+        start = offset + SLOT_HEADER.size
+        mm[start:start + len(key) + len(data)] = key + data
+        SLOT_HEADER.pack_into(mm, offset, seq, h, stored, expires,
+                              len(key), len(data))
+        SEQUENCE.pack_into(mm, offset, (seq + 1) & 0xffffffff)
+
+    def __len__(self):
+        now = self.clock.seconds()
+        count = 0
+        for offset in range(HEADER_SIZE, HEADER_SIZE + self.slots * self.slot_size,
+                            self.slot_size):
+            slot = self._readSlot(offset)
+            if slot is not None and now - slot[2] <= self.max_stale_age:
+                count += 1
+        return count
+
+    def store(self, query, response):
+        ans, auth, add = response
+        ttls = [r.ttl for r in ans + auth + add]
+        if not ttls:
+            return
+        key = self.getKey(query)
+        data = core.cache.encodeResponse(response)
+        if SLOT_HEADER.size + len(key) + len(data) > self.slot_size:
+            return
+        now = self.clock.seconds()
+        h = self._hash(key)
+        bucket = h % self.buckets
+        stripe = 1 + bucket % STRIPES
+        self._lock(stripe)
+        try:
+            victim = None
+            victim_expires = None
+            for offset in self._slotOffsets(bucket):
+                slot = self._readSlot(offset)
+                if slot is None:
+                    expires = float('-inf')
+                elif slot[0] == h and slot[3] == key:
+                    victim = offset
+                    break
+                else:
+                    expires = slot[2]
+                if victim is None or expires < victim_expires:
+                    victim, victim_expires = offset, expires
+            self._writeSlot(victim, h, now, now + min(ttls), key, data)
+        finally:
+            self._unlock(stripe)
+
+    def lookup(self, query):
+        """
+        Same as ForwardCache.lookup.
+        """
+        key = self.getKey(query)
+        h = self._hash(key)
+        for offset in self._slotOffsets(h % self.buckets):
+            slot = self._readSlot(offset)
+            if slot is None or slot[0] != h or slot[3] != key:
+                continue
+            _, stored, expires, _, data = slot
+            now = self.clock.seconds()
+            if now - expires > self.max_stale_age:
+                return None
+            response = core.cache.decodeResponse(data)
+            if now >= expires:
+                return response, True
+            age = int(now - stored)
+            response = tuple(core.cache.copyRecords(records,
+                                                    lambda ttl: max(0, ttl - age))
+                             for records in response)
+            return response, False
+        return None
+
+    def flush(self):
+        for stripe in range(STRIPES):
+            self._lock(1 + stripe)
+            try:
+                for bucket in range(stripe, self.buckets, STRIPES):
+                    for offset in self._slotOffsets(bucket):
+                        self._writeSlot(offset, 0, 0, 0, b'', b'')
+            finally:
+                self._unlock(1 + stripe)
@@ -0,0 +1,173 @@
+"""
+Traffic statistics of FakeDnsProxy
+"""
+
+import json
+import os
+
+
+class _Bucket:
+    __slots__ = ['count', 'items', 'prev', 'next']
+
+    def __init__(self, count):
+        self.count = count
+        self.items = dict()
+        self.prev = None
+        self.next = None
+
+
+class SpaceSaving:
+    """
+    Approximate top-k counting in constant memory (Metwally et al., "Efficient
+    Computation of Frequent and Top-k Elements in Data Streams").
+
+    At most `size` items are counted. If a new item arrives while all
+    counters are in use, the item with the lowest count is replaced, and the
+    new item inherits its count; this count is remembered as the maximum
+    error of the new item. Every item with a true count above
+    (number of updates / size) is guaranteed to be counted.
+
+    The counters are kept in a list of buckets of equal count (the "stream
+    summary"), so that an update takes constant time.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = dict()   # item -> bucket
+        self.errors = dict()  # item -> maximum overestimation
+        self.head = None      # bucket with the lowest count
+        self.total = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _unlink(self, bucket):
+        if bucket.prev is not None:
+            bucket.prev.next = bucket.next
+        else:
+            self.head = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+
+    def _bucketAfter(self, bucket, count):
+        """
+        Returns the bucket for count, which must directly follow bucket (or
+        be the head if bucket is None), and creates it if necessary.
+        """
+        following = self.head if bucket is None else bucket.next
+        if following is not None and following.count == count:
+            return following
+        new = _Bucket(count)
+        new.prev = bucket
+        new.next = following
+        if following is not None:
+            following.prev = new
+        if bucket is None:
+            self.head = new
+        else:
+            bucket.next = new
+        return new
+
+    def _moveUp(self, item, bucket, count):
+        target = self._bucketAfter(bucket, count)
+        del bucket.items[item]
+        if not bucket.items:
+            self._unlink(bucket)
+        target.items[item] = None
+        self.items[item] = target
+
+    def add(self, item):
+        self.total += 1
+        bucket = self.items.get(item)
+        if bucket is not None:
+            self._moveUp(item, bucket, bucket.count + 1)
+            return
+        if len(self.items) < self.size:
+            target = self._bucketAfter(None, 1)
+            target.items[item] = None
+            self.items[item] = target
+            self.errors[item] = 0
+            return
+        # replace an item with the lowest count
+        bucket = self.head
+        evicted = next(iter(bucket.items))
+        del bucket.items[evicted]
+        del self.items[evicted]
+        del self.errors[evicted]
+        bucket.items[item] = None
+        self.items[item] = bucket
+        self.errors[item] = bucket.count
+        self._moveUp(item, bucket, bucket.count + 1)
+
+    def top(self, k=None):
+        """
+        Returns a list of (item, count, error) with the highest counts first.
+        """
+        result = []
+        bucket = self.head
+        while bucket is not None and bucket.next is not None:
+            bucket = bucket.next
+        while bucket is not None:
+            for item in bucket.items:
+                result.append((item, bucket.count, self.errors[item]))
+            bucket = bucket.prev
+        if k is not None:
+            result = result[:k]
+        return result
+
+    def clear(self):
+        self.items.clear()
+        self.errors.clear()
+        self.head = None
+        self.total = 0
+
+
+class HeavyHitters:
+    """
+    Tracks the query names, the clients and the (query name, policy) pairs
+    that cause the most queries.
+    """
+    def __init__(self, size=100):
+        self.qnames = SpaceSaving(size)
+        self.clients = SpaceSaving(size)
+        self.qname_policies = SpaceSaving(size)
+
+    def record(self, qname, address, policy):
+        self.qnames.add(qname)
+        if address is not None:
+            self.clients.add(address[0])
+        self.qname_policies.add((qname, policy))
+
+    def report(self, k=None):
+        def entries(tracker, keyfunc):
+            return [{'key': keyfunc(item), 'count': count, 'error': error}
+                    for item, count, error in tracker.top(k)]
+        return {
+            'qnames': entries(self.qnames, lambda item: item),
+            'clients': entries(self.clients, lambda item: item),
+            'qname_policies': entries(self.qname_policies,
+                                      lambda item: '{} {}'.format(*item)),
+        }
+
+    def getLogMessages(self, k=10):
+        result = []
+        report = self.report(k)
+        for table in ['qnames', 'clients', 'qname_policies']:
+            for entry in report[table]:
+                result.append('Heavy hitter - {} - {} - {} (+-{})'.format(
+                    table, entry['key'], entry['count'], entry['error']))
+        return result
+
+    def snapshot(self, filename):
+        """
+        Writes the report as JSON. The file is replaced atomically, so that
+        readers never see a partially written snapshot.
+        """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(tmp_filename, filename)
+
+    def clear(self):
+        self.qnames.clear()
+        self.clients.clear()
+        self.qname_policies.clear()
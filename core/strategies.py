@@ -0,0 +1,112 @@
+"""
+Strategies to select the answers of rules with several values
+
+By default, the answer of a rule contains all its values in the order of
+the config, so every client uses the first one. A rule in dict form can
+select its answers with a strategy instead:
+
+    round_robin   the values are rotated by one for every query
+    weighted      the first value is picked at random, in proportion to the
+                  weights of the values
+    consistent    the first value is picked by a hash of the client address,
+                  in proportion to the weights, so that a client always gets
+                  the same answer
+
+The other values of the answer follow the first one in the order of the
+config, up to count values. The weights are kept as cumulative sums, so
+picking the first value is a binary search, and the answer is sliced from
+the values at query time: the memory of a rule grows linearly with its
+values and weights.
+"""
+
+import bisect
+import functools
+import itertools
+import math
+import random
+import zlib
+
+
+KINDS = ['round_robin', 'weighted', 'consistent']
+# the keys of a rule in dict form that configure its strategy
+SETTINGS = ['strategy', 'weights', 'count']
+
+
+class AnswerStrategy:
+    """
+    Selects the values of a rule for a query. value_dict maps the query
+    types to their values, like the value_dict of a DNSAnswerConfig.
+    """
+    def __init__(self, settings, value_dict, random=random.random):
+        self.settings = settings
+        self.kind = settings.get('strategy')
+        if not self.kind in KINDS:
+            raise RuntimeError("DNSAnswerDict: strategy must be one of "
+                               "{}".format(','.join(KINDS)))
+        self.random = random
+        default_count = None if self.kind == 'round_robin' else 1
+        self.count = settings.get('count', default_count)
+        if self.count is not None and \
+                (type(self.count) != int or self.count <= 0):
+            raise RuntimeError("DNSAnswerDict: count must be a positive integer")
+        weights = settings.get('weights', dict())
+        if type(weights) != dict:
+            raise RuntimeError("DNSAnswerDict: weights must map values to "
+                               "their weight")
+        if weights and self.kind == 'round_robin':
+            raise RuntimeError("DNSAnswerDict: weights cannot be used with "
+                               "strategy round_robin")
+        all_values = set(str(v) for values in value_dict.values() for v in values)
+        for value, weight in weights.items():
+            if not str(value) in all_values:
+                raise RuntimeError("DNSAnswerDict: weight for {}, which is not a "
+                                   "value of the rule".format(value))
+            if type(weight) != int or weight <= 0:
+                raise RuntimeError("DNSAnswerDict: the weight of {} must be a "
+                                   "positive integer".format(value))
+        weights = dict((str(value), weight) for value, weight in weights.items())
+        # qtype -> list of the values
+        self.values = dict()
+        # qtype -> cumulative sums of the weights of the values
+        self.cumulative = dict()
+        # qtype -> index of the first value of the next answer for round_robin
+        self.next = dict()
+        for qtype, values in value_dict.items():
+            values = list(values)
+            self.values[qtype] = values
+            self.next[qtype] = 0
+            if self.kind != 'round_robin' and values:
+                value_weights = [weights.get(str(v), 1) for v in values]
+                gcd = functools.reduce(math.gcd, value_weights)
+                self.cumulative[qtype] = list(itertools.accumulate(
+                                            w // gcd for w in value_weights))
+
+    def rotate(self, values, first):
+        """
+        Returns the answer that starts with values[first], followed by the
+        other values in the order of the config, up to count values.
+        """
+        answer = values[first:] + values[:first]
+        if self.count is not None:
+            return answer[:self.count]
+        return answer
+
+    def select(self, qtype_string, values, address=None):
+        """
+        Returns the values of the answer to a query of type qtype_string
+        from the client address. values are the values of the rule for
+        qtype_string.
+        """
+        own_values = self.values.get(qtype_string)
+        if not own_values:
+            return values
+        if self.kind == 'round_robin':
+            first = self.next[qtype_string]
+            self.next[qtype_string] = (first + 1) % len(own_values)
+            return self.rotate(own_values, first)
+        cumulative = self.cumulative[qtype_string]
+        if self.kind == 'weighted' or address is None:
+            position = self.random() * cumulative[-1]
+        else:
+            position = zlib.crc32(address[0].encode()) % cumulative[-1]
+        return self.rotate(own_values, bisect.bisect_right(cumulative, position))
@@ -0,0 +1,109 @@
+"""
+Sampled per-query traces of FakeDnsProxy
+
+A trace records when a query passed the stages of its way through
+FakeDnsProxy. The traces are written in the JSON array format of the Trace
+Event Format, which chrome://tracing and https://ui.perfetto.dev load: every
+query is a track of its own, with one span for the whole query and one span
+per stage, named after the stage that ends it. The stages are:
+
+    received            the query was decoded
+    policy              the policy of the query was decided
+    answer              the answer was generated (not forwarded queries)
+    cache_hit           the answer was found in the forward_cache
+    upstream_sent       the query was sent to the upstream
+    upstream_received   the answer of the upstream arrived
+    logged              the answer was logged
+    reply_sent          the reply was written to the socket
+"""
+
+import json
+import random
+import time
+
+
+class Trace:
+    __slots__ = ['id', 'args', 'stages', 'timer']
+
+    def __init__(self, trace_id, timer, args, received=None):
+        self.id = trace_id
+        self.timer = timer
+        self.args = args
+        self.stages = [('received', timer() if received is None else received)]
+
+    def mark(self, stage, t=None):
+        """
+        Ends stage now, or at t (of timer) if it was taken before.
+        """
+        self.stages.append((stage, self.timer() if t is None else t))
+
+
+class QueryTracer:
+    """
+    Starts a Trace for a sample_rate fraction of the queries, and writes the
+    finished traces to filename. After max_traces traces, no further queries
+    are traced, so that the file does not grow without bounds.
+    """
+    def __init__(self, filename, sample_rate=0.01, max_traces=100000,
+                 timer=time.perf_counter, random=random.random):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.max_traces = max_traces
+        self.timer = timer
+        self.random = random
+        self.started = 0
+        self.written = 0
+        self.epoch = timer()
+        self.events = 0
+        self.file = open(filename, 'w')
+        # the closing bracket of the array is optional in the format, so
+        # the file can be loaded while traces are still added
+        self.file.write('[')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.write('\n]\n')
+        self.file.close()
+
+    def startTrace(self, address=None, received=None):
+        """
+        Returns a new Trace if the query is sampled, and None otherwise.
+        received is the time (of timer) the query was received, if it was
+        taken before the trace was started.
+        """
+        if self.started >= self.max_traces or self.random() >= self.sample_rate:
+            return None
+        self.started += 1
+        args = {}
+        if address is not None:
+            args['client'] = '{}:{}'.format(address[0], address[1])
+        return Trace(self.started, self.timer, args, received)
+
+    def _microseconds(self, t):
+        return round((t - self.epoch) * 1e6, 1)
+
+    def getEvents(self, trace):
+        first = trace.stages[0][1]
+        last = trace.stages[-1][1]
+        name = trace.args.get('qname', 'query')
+        events = [{ 'name': name, 'cat': 'query', 'ph': 'X', 'pid': 1,
+                    'tid': trace.id, 'ts': self._microseconds(first),
+                    'dur': round((last - first) * 1e6, 1),
+                    'args': trace.args }]
+        previous = first
+        for stage, t in trace.stages[1:]:
+            events.append({ 'name': stage, 'cat': 'stage', 'ph': 'X',
+                            'pid': 1, 'tid': trace.id,
+                            'ts': self._microseconds(previous),
+                            'dur': round((t - previous) * 1e6, 1) })
+            previous = t
+        return events
+
+    def finishTrace(self, trace):
+        for event in self.getEvents(trace):
+            self.file.write(',\n' if self.events else '\n')
+            self.file.write(json.dumps(event, separators=(',', ':')))
+            self.events += 1
+        self.written += 1
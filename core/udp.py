@@ -0,0 +1,130 @@
+"""
+Tuning and drop accounting of the listening UDP socket of FakeDnsProxy
+
+If datagrams arrive faster than FakeDnsProxy reads them, the receive buffer
+of the socket fills up and the kernel drops further datagrams without
+FakeDnsProxy noticing. On Linux, the number of these drops is read from the
+socket (SO_MEMINFO, or /proc/net/udp on older kernels), so that a full
+socket buffer can be told apart from a busy FakeDnsProxy.
+"""
+
+import os
+import socket
+import struct
+
+from twisted.internet import reactor, task
+from twisted.logger import Logger
+
+
+# not exported by the socket module, see linux/sock_diag.h
+SO_MEMINFO = getattr(socket, 'SO_MEMINFO', 55)
+# rmem_alloc, rcvbuf, wmem_alloc, sndbuf, fwd_alloc, wmem_queued, optmem,
+# backlog, drops
+MEMINFO = struct.Struct('9I')
+PROC_FILES = { socket.AF_INET: '/proc/net/udp', socket.AF_INET6: '/proc/net/udp6' }
+
+
+def tuneSocket(sock, settings):
+    """
+    Sets the buffer sizes of the socket from the receive_buffer and
+    send_buffer settings. Returns the sizes the kernel granted, which can
+    be lower (net.core.rmem_max) or higher (Linux doubles the value).
+    """
+    if 'receive_buffer' in settings:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        settings['receive_buffer'])
+    if 'send_buffer' in settings:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                        settings['send_buffer'])
+    return (sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+
+def readProcDrops(sock):
+    """
+    Returns (bytes in the receive queue, drops) of the socket from
+    /proc/net/udp, or None.
+    """
+    filename = PROC_FILES.get(sock.family)
+    if filename is None:
+        return None
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    try:
+        with open(filename) as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    queue = int(fields[4].split(':')[1], 16)
+                    return queue, int(fields[12])
+    except OSError:
+        pass
+    return None
+
+
+def readSocketDrops(sock):
+    """
+    Returns (bytes in the receive queue, drops) of the socket, or None if
+    the platform does not report them.
+    """
+    try:
+        info = MEMINFO.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_MEMINFO,
+                                              MEMINFO.size))
+        return info[0], info[8]
+    except (OSError, struct.error):
+        return readProcDrops(sock)
+
+
+class UDPSocketMonitor:
+    """
+    Reads the drop counter of the socket every interval seconds, and logs
+    a warning if the kernel dropped datagrams since the last check.
+    """
+    def __init__(self, sock, interval=60, clock=None, read=readSocketDrops):
+        self.socket = sock
+        self.interval = interval
+        self.clock = clock or reactor
+        self.read = read
+        self.logger = Logger()
+        self.drops = 0
+        self.queued = 0
+        self.receive_buffer = None
+        self.last_drops = None
+        self.loop = task.LoopingCall(self.check)
+        self.loop.clock = self.clock
+
+    def start(self):
+        self.receive_buffer = self.socket.getsockopt(socket.SOL_SOCKET,
+                                                     socket.SO_RCVBUF)
+        if self.read(self.socket) is None:
+            self.logger.info("The kernel does not report drops of the UDP "
+                             "socket, drop accounting is disabled")
+            return False
+        self.loop.start(self.interval)
+        return True
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def check(self):
+        result = self.read(self.socket)
+        if result is None:
+            return
+        self.queued, drops = result
+        if self.last_drops is None:
+            # drops before we started are not ours to report
+            self.last_drops = drops
+        new = (drops - self.last_drops) & 0xffffffff
+        self.last_drops = drops
+        self.drops += new
+        if new:
+            self.logger.warn("The kernel dropped {new} datagrams in the last "
+                             "{interval} seconds because the receive buffer "
+                             "of the UDP socket was full", new=new,
+                             interval=self.interval)
+
+    def getStats(self):
+        return [('udp_receive_buffer', self.receive_buffer),
+                ('udp_receive_queue', self.queued),
+                ('udp_drops', self.drops)]
@@ -0,0 +1,281 @@
+"""
+Upstream DNS servers that FakeDnsProxy forwards queries to
+"""
+
+import collections
+
+from twisted.internet import reactor, defer
+from twisted.names import client, dns, error
+from twisted.python.failure import Failure
+
+
+# the retry schedule twisted uses if no timeout is given
+DEFAULT_TIMEOUTS = (1, 3, 11, 45)
+
+
+class UpstreamUnavailable(error.DNSServerError):
+    """
+    The upstream is considered down, so the query was not sent.
+    """
+
+
+class RTTEstimator:
+    """
+    Estimates the round trip time to an upstream from a smoothed mean and
+    variance, like TCP does for its retransmission timer (RFC 6298). The
+    retransmission timeout is srtt + 4 * rttvar, limited to
+    [min_timeout, max_timeout].
+    """
+    def __init__(self, initial_timeout=1.0, min_timeout=0.02, max_timeout=3.0):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_timeout
+
+    def addSample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + 4 * self.rttvar
+        self.rto = min(self.max_timeout, max(self.min_timeout, rto))
+
+    def getTimeouts(self, deadline):
+        """
+        Returns the retransmission schedule for one query: starting with the
+        current timeout, every retry waits twice as long as the previous one,
+        until the deadline is used up.
+        """
+        timeouts = []
+        total = 0
+        rto = self.rto
+        while total + rto < deadline:
+            timeouts.append(rto)
+            total += rto
+            rto = min(2 * rto, self.max_timeout)
+        if deadline - total > 0:
+            timeouts.append(deadline - total)
+        return tuple(timeouts)
+
+
+class Upstream:
+    """
+    A DNS server that we forward queries to. The Upstream measures the round
+    trip time of its queries and, if adaptive_timeout is enabled, derives
+    the retransmission timeouts from it. Every query is bounded by
+    query_deadline seconds.
+
+    If max_failures is set, the upstream is considered down after that many
+    queries in a row failed (e.g. timed out), and queries fail right away
+    with UpstreamUnavailable for retry_interval seconds. The first query
+    after that checks whether the upstream is back.
+    """
+    def __init__(self, settings, clock=None):
+        self.settings = settings
+        self.ip = settings['ip']
+        self.port = settings['port']
+        self.clock = clock or reactor
+        self.adaptive_timeout = settings.get('adaptive_timeout', False)
+        self.query_deadline = settings.get('query_deadline',
+                                           sum(DEFAULT_TIMEOUTS))
+        self.rtt = RTTEstimator(settings.get('initial_timeout', 1.0),
+                                settings.get('min_timeout', 0.02),
+                                settings.get('max_timeout', 3.0))
+        self.samples = collections.deque(maxlen=256)
+        self.max_failures = settings.get('max_failures', 0)
+        self.retry_interval = settings.get('retry_interval', 30)
+        self.failures = 0
+        self.down_until = None
+        self.resolver = client.Resolver(servers=[(self.ip, self.port)])
+
+    def __repr__(self):
+        return "Upstream({}:{})".format(self.ip, self.port)
+
+    def getRTTPercentile(self, percentile):
+        """
+        Returns the given percentile of the recently measured round trip
+        times, or None if nothing was measured yet.
+        """
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def getTimeouts(self):
+        if self.adaptive_timeout:
+            return self.rtt.getTimeouts(self.query_deadline)
+        timeouts = []
+        total = 0
+        for t in DEFAULT_TIMEOUTS:
+            if total + t >= self.query_deadline:
+                break
+            timeouts.append(t)
+            total += t
+        timeouts.append(self.query_deadline - total)
+        return tuple(timeouts)
+
+    def isHealthy(self):
+        return self.down_until is None or self.clock.seconds() >= self.down_until
+
+    def query(self, query, timeout=None):
+        if not self.isHealthy():
+            return defer.fail(UpstreamUnavailable(
+                    "{} is down".format(self)))
+        if timeout is None:
+            timeout = self.getTimeouts()
+        sent = self.clock.seconds()
+        d = self.resolver.query(query, timeout)
+        d.addBoth(self._measure, sent, timeout[0])
+        if self.max_failures:
+            d.addBoth(self._checkHealth)
+        return d
+
+    def _checkHealth(self, result):
+        if isinstance(result, Failure) and \
+                not result.check(error.DomainError,
+                                 error.AuthoritativeDomainError,
+                                 defer.CancelledError):
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.down_until = self.clock.seconds() + self.retry_interval
+        else:
+            self.failures = 0
+            self.down_until = None
+        return result
+
+    def _measure(self, result, sent, first_timeout):
+        rtt = self.clock.seconds() - sent
+        # Karn's algorithm: answers to retransmitted queries cannot be
+        # attributed to a single packet, so they are not used as samples
+        if rtt <= first_timeout:
+            if not isinstance(result, Failure) or \
+                    not result.check(dns.DNSQueryTimeoutError,
+                                     defer.TimeoutError,
+                                     defer.CancelledError):
+                self.rtt.addSample(rtt)
+                self.samples.append(rtt)
+        return result
+
+
+
+class HedgedResolver:
+    """
+    Sends a query to the primary upstream. If the primary did not answer
+    after the hedge delay (a percentile of its recent round trip times), the
+    query is also sent to a secondary upstream and the first answer wins.
+    NXDOMAIN is an answer as well, only timeouts and transport errors make
+    the query go to the secondary right away. The query that lost is not
+    cancelled: the resolver keeps retransmitting it until it is answered or
+    times out, so a hedged query can cost up to two full queries.
+
+    Every query adds budget to a token bucket and every hedged query takes
+    one token, so at most a fraction of budget queries cause extra load on
+    the upstreams.
+    """
+    def __init__(self, primary, secondaries, settings, clock=None):
+        self.primary = primary
+        self.secondaries = secondaries
+        self.clock = clock or reactor
+        self.delay_percentile = settings.get('delay_percentile', 95)
+        self.min_delay = settings.get('min_delay', 0.01)
+        self.max_delay = settings.get('max_delay', 1.0)
+        self.budget = settings.get('budget', 0.05)
+        self.max_tokens = max(1.0, settings.get('max_burst', 10))
+        self.tokens = 0.0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def getHedgeDelay(self):
+        delay = self.primary.getRTTPercentile(self.delay_percentile)
+        if delay is None:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def getSecondary(self):
+        return min(self.secondaries, key=lambda upstream: upstream.rtt.rto)
+
+    def query(self, query, timeout=None):
+        self.tokens = min(self.max_tokens, self.tokens + self.budget)
+        result = defer.Deferred()
+        attempts = []
+        hedges = []
+
+        def finished(response, attempt):
+            if result.called:
+                return
+            if timer.active():
+                timer.cancel()
+            if attempt in hedges:
+                self.hedge_wins += 1
+            if isinstance(response, Failure):
+                result.errback(response)
+            else:
+                result.callback(response)
+            for other in list(attempts):
+                if other is not attempt:
+                    # we stop waiting for it, see above
+                    other.cancel()
+
+        def failed(failure, attempt):
+            if result.called:
+                return
+            if failure.check(error.DomainError, error.AuthoritativeDomainError):
+                # the name does not exist, asking another server won't help
+                finished(failure, attempt)
+                return
+            attempts.remove(attempt)
+            if timer.active():
+                # the primary failed before we hedged, so try right away
+                timer.cancel()
+                if hedge():
+                    return
+            if not attempts:
+                result.errback(failure)
+
+        def send(upstream, group):
+            d = upstream.query(query, timeout)
+            attempts.append(d)
+            group.append(d)
+            d.addCallbacks(finished, failed, callbackArgs=(d,),
+                           errbackArgs=(d,))
+
+        def hedge():
+            if result.called or not self.secondaries or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            send(self.getSecondary(), hedges)
+            return True
+
+        timer = self.clock.callLater(self.getHedgeDelay(), hedge)
+        send(self.primary, [])
+        return result
+
+
+class UpstreamPool:
+    """
+    Creates one Upstream per distinct (ip, port), so that all domain rules
+    that forward to the same server share its resolver, RTT estimate and
+    health.
+    """
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.upstreams = dict()
+
+    def __len__(self):
+        return len(self.upstreams)
+
+    def get(self, settings):
+        key = (settings['ip'], settings['port'])
+        upstream = self.upstreams.get(key)
+        if upstream is None:
+            upstream = Upstream(settings, clock=self.clock)
+            self.upstreams[key] = upstream
+        elif upstream.settings != settings:
+            raise RuntimeError("ERROR: upstream {}:{} is configured with "
+                               "different settings".format(*key))
+        return upstream
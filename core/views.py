@@ -0,0 +1,43 @@
+"""
+Per-client views on the FakeDnsProxy configuration
+"""
+
+import core.config
+import core.prefixtree
+
+
+# settings that a view can override
+VIEW_SETTINGS = ['default_dns_policy', 'default_dns_value', 'domain_config']
+
+
+class Views:
+    """
+    Maps the client networks of the views in the config to the view's
+    configuration. A view uses the settings of the global configuration for
+    everything it does not define itself. The view of a client is selected
+    by longest prefix match of its address.
+    """
+    def __init__(self, config):
+        self.tree = core.prefixtree.PrefixTree()
+        self.views = dict()
+        base = dict(config.config)
+        del base['views']
+        for view in config['views']:
+            view_config = dict(base)
+            for key in VIEW_SETTINGS:
+                if key in view:
+                    view_config[key] = view[key]
+            cp = core.config.ConfigParser(view_config)
+            cp.generate_config_objects()
+            self.views[view['name']] = cp
+            for network in view['clients']:
+                self.tree.insert(network, cp)
+
+    def getConfig(self, address, default):
+        """
+        Returns the config of the view for the client address, or default if
+        the address is not in any view.
+        """
+        if address is None:
+            return default
+        return self.tree.lookup(address[0], default)
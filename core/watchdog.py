@@ -0,0 +1,192 @@
+"""
+Watchdog for stalls of the reactor thread of FakeDnsProxy
+"""
+
+import collections
+import gc
+import sys
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor, task
+from twisted.logger import Logger
+
+
+# upper bounds of the lag histogram in seconds, the last bucket is unbounded
+LAG_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+class LagHistogram:
+    """
+    Counts how late the timer of the watchdog fired, in LAG_BUCKETS.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LAG_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lag):
+        i = 0
+        while i < len(LAG_BUCKETS) and lag > LAG_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += lag
+        self.max = max(self.max, lag)
+
+    def getStats(self):
+        """
+        Returns the cumulative counts per bucket as (name, value) pairs.
+        """
+        result = []
+        cumulative = 0
+        for bound, count in zip(LAG_BUCKETS, self.counts):
+            cumulative += count
+            result.append(('loop_lag_le_{:g}ms'.format(bound * 1000), cumulative))
+        result.append(('loop_lag_count', self.count))
+        result.append(('loop_lag_max_ms', round(self.max * 1000, 1)))
+        if self.count:
+            result.append(('loop_lag_avg_ms',
+                           round(self.total / self.count * 1000, 2)))
+        return result
+
+
+class Stall:
+    __slots__ = ['time', 'duration', 'gc_time', 'in_gc', 'stack']
+
+    def __init__(self, time, stack=None, in_gc=False):
+        self.time = time
+        self.duration = None
+        self.gc_time = 0.0
+        self.in_gc = in_gc
+        self.stack = stack
+
+    def getLogMessage(self):
+        msg = 'Reactor stalled for {:.0f} ms'.format(self.duration * 1000)
+        if self.gc_time > 0:
+            msg += ', {:.0f} ms of it in garbage collection'.format(
+                        self.gc_time * 1000)
+        if self.stack is None:
+            return msg + ', no stack captured'
+        where = 'in garbage collection called at' if self.in_gc else 'at'
+        return msg + ', ' + where + ':\n' + ''.join(self.stack).rstrip()
+
+
+class ReactorWatchdog:
+    """
+    Measures the lag of the reactor: a LoopingCall fires every interval
+    seconds and records how late it fired in a LagHistogram.
+
+    A monitor thread checks every interval seconds whether the timer is
+    overdue by more than threshold seconds. If it is, the reactor thread is
+    stuck in some call, and the monitor captures the stack of the reactor
+    thread at that moment. Once the reactor is back, the stall is logged
+    with its duration, its stack and the time the garbage collector ran
+    meanwhile. Stalls shorter than interval + threshold may be missed by
+    the monitor; they are still logged, without a stack.
+
+    clock schedules the timer, timer() returns the time the lag is measured
+    with. Both can be replaced in tests; checkStall is called by the
+    monitor thread.
+    """
+    def __init__(self, settings, clock=None, timer=time.monotonic):
+        self.clock = clock or reactor
+        self.timer = timer
+        self.interval = settings.get('interval', 0.1)
+        self.threshold = settings.get('threshold', 0.5)
+        self.histogram = LagHistogram()
+        self.stalls = collections.deque(maxlen=settings.get('max_stalls', 20))
+        self.stall_count = 0
+        self.gc_time = 0.0
+        self.gc_start = None
+        self.logger = Logger()
+        # shared with the monitor thread
+        self.lock = threading.Lock()
+        self.last_tick = None
+        self.pending = None
+        self.gc_time_at_tick = 0.0
+        self.reactor_thread = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = self.clock
+
+    def start(self, monitor=True):
+        """
+        Starts the watchdog, which must be done in the reactor thread.
+        """
+        self.reactor_thread = threading.get_ident()
+        self.last_tick = self.timer()
+        self.loop.start(self.interval, now=False)
+        gc.callbacks.append(self.gcCallback)
+        if monitor:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.monitor,
+                                           name='ReactorWatchdog', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        if self.gcCallback in gc.callbacks:
+            gc.callbacks.remove(self.gcCallback)
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def monitor(self):
+        while not self.stopping.wait(self.interval):
+            self.checkStall(self.timer())
+
+    def gcCallback(self, phase, info):
+        if phase == 'start':
+            self.gc_start = self.timer()
+        elif self.gc_start is not None:
+            self.gc_time += self.timer() - self.gc_start
+            self.gc_start = None
+
+    def checkStall(self, now):
+        """
+        Captures the stack of the reactor thread if the timer is overdue by
+        more than threshold seconds and the stall was not captured yet.
+        """
+        with self.lock:
+            if self.pending is not None or self.last_tick is None or \
+                    now - self.last_tick - self.interval <= self.threshold:
+                return
+            frame = sys._current_frames().get(self.reactor_thread)
+            stack = traceback.format_stack(frame) if frame is not None else None
+            self.pending = Stall(now, stack, in_gc=self.gc_start is not None)
+
+    def tick(self):
+        now = self.timer()
+        with self.lock:
+            lag = max(0.0, now - self.last_tick - self.interval)
+            self.last_tick = now
+            stall, self.pending = self.pending, None
+            gc_time = self.gc_time - self.gc_time_at_tick
+            self.gc_time_at_tick = self.gc_time
+        self.histogram.record(lag)
+        if stall is None and lag > self.threshold:
+            stall = Stall(now)
+        if stall is not None:
+            stall.duration = lag
+            stall.gc_time = gc_time
+            self.stalls.append(stall)
+            self.stall_count += 1
+            self.logger.warn('{message}', message=stall.getLogMessage())
+
+    def getStats(self):
+        return self.histogram.getStats() + \
+               [('stalls', self.stall_count),
+                ('gc_time_ms', round(self.gc_time * 1000, 1))]
+
+    def getStallMessages(self):
+        """
+        Returns the log messages of the last max_stalls stalls, most recent
+        first.
+        """
+        return [stall.getLogMessage() for stall in reversed(self.stalls)]
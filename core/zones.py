@@ -0,0 +1,475 @@
+"""
+Authoritative data of FakeDnsProxy from zone files
+
+The zone files are read in the master file format of RFC 1035 (as used by
+BIND), with the $ORIGIN, $TTL and $INCLUDE directives, relative names, '@',
+parentheses spanning lines and wildcard names (RFC 4592). The supported
+record types are A, AAAA, CNAME, MX, NS, PTR, SOA, SRV and TXT.
+
+Every zone is indexed by owner name and record type, so a lookup takes a
+few dict lookups, whatever the size of the zone.
+"""
+
+import os
+import re
+
+from twisted.names import dns, error
+
+
+CLASSES = { 'IN', 'CH', 'HS', 'CS' }
+TTL_UNITS = { '': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+TTL_PART = re.compile(r'(\d+)([smhdw]?)', re.IGNORECASE)
+# characters that require the slow tokenizer
+SPECIAL = re.compile(r'[";()\\]')
+# maximum number of CNAMEs followed inside a zone
+MAX_CNAME_CHAIN = 8
+
+
+class ZoneNameError(error.AuthoritativeDomainError):
+    """
+    The name does not exist in the zone (NXDOMAIN). authority holds the SOA
+    record of the zone.
+    """
+    def __init__(self, authority):
+        super().__init__()
+        self.authority = authority
+
+
+class Quoted(str):
+    """
+    A token that was a quoted string in the zone file.
+    """
+
+
+def parseTTL(text):
+    text = text.lower()
+    if text.isdigit():
+        return int(text)
+    pos = 0
+    ttl = 0
+    for match in TTL_PART.finditer(text):
+        if match.start() != pos:
+            break
+        ttl += int(match.group(1)) * TTL_UNITS[match.group(2)]
+        pos = match.end()
+    if pos != len(text) or pos == 0:
+        raise ValueError("invalid TTL {}".format(text))
+    return ttl
+
+
+def isTTL(token):
+    return token[:1].isdigit() and not isinstance(token, Quoted)
+
+
+def tokenize(line):
+    """
+    Splits a line into tokens, honouring quoted strings and comments.
+    Parentheses are returned as tokens of their own.
+    """
+    tokens = []
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c in ' \t\r\n':
+            i += 1
+        elif c == ';':
+            break
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            value = []
+            i += 1
+            while i < n and line[i] != '"':
+                if line[i] == '\\' and i + 1 < n:
+                    i += 1
+                value.append(line[i])
+                i += 1
+            if i >= n:
+                raise ValueError("unterminated quoted string")
+            tokens.append(Quoted(''.join(value)))
+            i += 1
+        else:
+            start = i
+            while i < n and not line[i] in ' \t\r\n;()"':
+                if line[i] == '\\':
+                    i += 1
+                i += 1
+            tokens.append(line[start:i])
+    return tokens
+
+
+def readEntries(filename):
+    """
+    Yields (line number, starts with blank, tokens) for every entry of the
+    file, joining the lines of entries in parentheses.
+    """
+    with open(filename) as f:
+        pending = None
+        depth = 0
+        for number, line in enumerate(f, 1):
+            if SPECIAL.search(line) is None:
+                tokens = line.split()
+            else:
+                try:
+                    tokens = tokenize(line)
+                except ValueError as e:
+                    raise RuntimeError("ERROR: {}:{}: {}".format(filename,
+                                                                 number, e))
+            if pending is None:
+                if not tokens:
+                    continue
+                pending = (number, line[:1] in ' \t', [])
+            for token in tokens:
+                if token == '(' and not isinstance(token, Quoted):
+                    depth += 1
+                elif token == ')' and not isinstance(token, Quoted):
+                    depth -= 1
+                else:
+                    pending[2].append(token)
+            if depth <= 0:
+                if pending[2]:
+                    yield pending
+                pending = None
+                depth = 0
+        if pending is not None:
+            raise RuntimeError("ERROR: {}:{}: unbalanced parentheses".format(
+                               filename, pending[0]))
+
+
+class Zone:
+    """
+    The records of one zone, indexed by owner name and record type. Names
+    are lower case and without the trailing dot.
+    """
+    def __init__(self, origin):
+        self.origin = origin
+        self.soa = None
+        # name -> record type -> list of RRHeader
+        self.records = dict()
+        # all names that exist, including empty non-terminals
+        self.nodes = set()
+        self.wildcards = False
+        # names below the origin with NS records, delegated to other servers
+        self.delegations = set()
+
+    def __len__(self):
+        return sum(len(rrset) for rrsets in self.records.values()
+                   for rrset in rrsets.values())
+
+    def contains(self, name):
+        return name == self.origin or self.origin == '' or \
+               name.endswith('.' + self.origin)
+
+    def add(self, name, record):
+        rrsets = self.records.get(name)
+        if rrsets is None:
+            rrsets = self.records[name] = dict()
+            node = name
+            while node not in self.nodes:
+                self.nodes.add(node)
+                if node == self.origin:
+                    break
+                node = node.split('.', 1)[1] if '.' in node else self.origin
+            if name.startswith('*.'):
+                self.wildcards = True
+        rrsets.setdefault(record.type, []).append(record)
+        if record.type == dns.SOA and name == self.origin:
+            self.soa = record
+        elif record.type == dns.NS and name != self.origin:
+            self.delegations.add(name)
+
+    def findDelegation(self, name):
+        """
+        Returns the delegated name at or above name, or None if name is not
+        below a delegation.
+        """
+        if not self.delegations:
+            return None
+        node = name
+        while node != self.origin:
+            if node in self.delegations:
+                return node
+            node = node.split('.', 1)[1] if '.' in node else self.origin
+        return None
+
+    def getReferral(self, cut):
+        """
+        Returns the referral to the name servers of the delegated name cut:
+        their NS records in the authority and the addresses of the name
+        servers inside the zone (glue) in the additional section. The
+        records are not authoritative.
+        """
+        def copy(records):
+            return [dns.RRHeader(name=r.name.name, type=r.type, cls=r.cls,
+                                 ttl=r.ttl, payload=r.payload) for r in records]
+        authority = copy(self.records[cut][dns.NS])
+        additional = []
+        for record in authority:
+            rrsets = self.records.get(record.payload.name.name.decode(), {})
+            additional.extend(copy(rrsets.get(dns.A, [])))
+            additional.extend(copy(rrsets.get(dns.AAAA, [])))
+        return [], authority, additional
+
+    def findRRsets(self, name):
+        """
+        Returns (owner, rrsets) for name, where owner is the wildcard name
+        that matched if name does not exist. Returns (name, {}) for names
+        that exist without records, and (None, None) for names that do not
+        exist.
+        """
+        rrsets = self.records.get(name)
+        if rrsets is not None:
+            return name, rrsets
+        if name in self.nodes:
+            return name, {}
+        if not self.wildcards:
+            return None, None
+        # the closest encloser is the longest existing ancestor of the name
+        encloser = name
+        while encloser != self.origin:
+            encloser = encloser.split('.', 1)[1] if '.' in encloser else self.origin
+            if encloser in self.nodes:
+                break
+        wildcard = '*.' + encloser if encloser else '*'
+        rrsets = self.records.get(wildcard)
+        if rrsets is None:
+            return None, None
+        return wildcard, rrsets
+
+    def getAnswers(self, owner, rrsets, name, qtype):
+        if qtype == dns.ALL_RECORDS:
+            records = [r for rrset in rrsets.values() for r in rrset]
+        else:
+            records = rrsets.get(qtype, [])
+        if owner == name:
+            return list(records)
+        # records of a wildcard are returned with the name of the query
+        return [dns.RRHeader(name=name.encode(), type=r.type, cls=r.cls, ttl=r.ttl,
+                             payload=r.payload, auth=True) for r in records]
+
+    def lookup(self, name, qtype):
+        """
+        Returns the (answers, authority, additional) for name. Names without
+        records of type qtype get the SOA of the zone in the authority
+        (NODATA). Names at or below a delegation get a referral. Raises
+        ZoneNameError if name does not exist.
+        """
+        cut = self.findDelegation(name)
+        if cut is not None:
+            return self.getReferral(cut)
+        owner, rrsets = self.findRRsets(name)
+        if rrsets is None:
+            raise ZoneNameError([self.soa])
+        answers = self.getAnswers(owner, rrsets, name, qtype)
+        if answers or qtype == dns.CNAME or not dns.CNAME in rrsets:
+            if answers:
+                return answers, [], []
+            return [], [self.soa], []
+        # follow the CNAME inside the zone
+        answers = self.getAnswers(owner, rrsets, name, dns.CNAME)
+        seen = { name }
+        for _ in range(MAX_CNAME_CHAIN):
+            target = answers[-1].payload.name.name.decode().lower().rstrip('.')
+            if target in seen or not self.contains(target) or \
+                    self.findDelegation(target) is not None:
+                break
+            seen.add(target)
+            owner, rrsets = self.findRRsets(target)
+            if rrsets is None:
+                break
+            records = self.getAnswers(owner, rrsets, target, qtype)
+            if records:
+                answers.extend(records)
+                break
+            if not dns.CNAME in rrsets:
+                break
+            answers.extend(self.getAnswers(owner, rrsets, target, dns.CNAME))
+        return answers, [], []
+
+
+class ZoneParser:
+    """
+    Reads a zone file into a Zone.
+    """
+    def __init__(self, filename, origin=None, default_ttl=3600):
+        self.filename = filename
+        self.origin = self.normalizeName(origin) if origin is not None else None
+        self.zone = None
+        self.ttl = None
+        self.last_ttl = default_ttl
+        self.owner = None
+
+    def normalizeName(self, name):
+        return name.lower().rstrip('.')
+
+    def error(self, number, message):
+        return RuntimeError("ERROR: {}:{}: {}".format(self.filename, number,
+                                                      message))
+
+    def absoluteName(self, name, origin, number):
+        if name == '@':
+            if origin is None:
+                raise self.error(number, "@ used without an origin")
+            return origin
+        if name.endswith('.'):
+            return self.normalizeName(name)
+        if origin is None:
+            raise self.error(number, "relative name {} without an "
+                                     "origin".format(name))
+        name = name.lower()
+        return name + '.' + origin if origin else name
+
+    def parse(self):
+        self.parseFile(self.filename, self.origin)
+        if self.zone is None or self.zone.soa is None:
+            raise RuntimeError("ERROR: zone file {} has no SOA record for its "
+                               "origin".format(self.filename))
+        return self.zone
+
+    def parseFile(self, filename, origin):
+        for number, blank, tokens in readEntries(filename):
+            directive = tokens[0].upper() if tokens and not blank else None
+            if directive == '$ORIGIN':
+                origin = self.absoluteName(tokens[1], origin, number)
+                continue
+            if directive == '$TTL':
+                self.ttl = self.parseTTL(tokens[1], number)
+                continue
+            if directive == '$INCLUDE':
+                path = os.path.join(os.path.dirname(filename), tokens[1])
+                include_origin = origin
+                if len(tokens) > 2:
+                    include_origin = self.absoluteName(tokens[2], origin, number)
+                self.parseFile(path, include_origin)
+                continue
+            if directive is not None and directive.startswith('$'):
+                raise self.error(number, "unknown directive {}".format(tokens[0]))
+            self.parseRecord(tokens, blank, origin, number)
+
+    def parseTTL(self, text, number):
+        try:
+            return parseTTL(text)
+        except ValueError as e:
+            raise self.error(number, e)
+
+    def parseRecord(self, tokens, blank, origin, number):
+        if blank:
+            if self.owner is None:
+                raise self.error(number, "record without an owner name")
+            owner = self.owner
+            pos = 0
+        else:
+            owner = self.absoluteName(tokens[0], origin, number)
+            pos = 1
+        ttl = None
+        while pos < len(tokens):
+            token = tokens[pos]
+            if isTTL(token):
+                ttl = self.parseTTL(token, number)
+            elif token.upper() in CLASSES:
+                if token.upper() != 'IN':
+                    raise self.error(number, "unsupported class {}".format(token))
+            else:
+                break
+            pos += 1
+        if pos >= len(tokens):
+            raise self.error(number, "record without a type")
+        rtype = tokens[pos].upper()
+        rdata = tokens[pos + 1:]
+        if ttl is None:
+            ttl = self.ttl if self.ttl is not None else self.last_ttl
+        else:
+            self.last_ttl = ttl
+        self.owner = owner
+
+        if self.zone is None:
+            if rtype != 'SOA':
+                raise self.error(number, "the first record must be the SOA")
+            self.zone = Zone(owner)
+        elif not self.zone.contains(owner):
+            raise self.error(number, "{} is outside of zone {}".format(
+                                     owner, self.zone.origin))
+        try:
+            payload = self.parseRdata(rtype, rdata, origin, ttl, number)
+        except (IndexError, ValueError, OSError):
+            raise self.error(number, "invalid {} record: {}".format(
+                                     rtype, ' '.join(rdata)))
+        # names are passed as bytes, which spares twisted the IDNA encoding
+        self.zone.add(owner, dns.RRHeader(name=owner.encode(), type=payload.TYPE,
+                                          ttl=ttl, payload=payload, auth=True))
+
+    def parseRdata(self, rtype, rdata, origin, ttl, number):
+        def name(token):
+            return self.absoluteName(token, origin, number).encode()
+        if rtype == 'A':
+            return dns.Record_A(rdata[0], ttl=ttl)
+        if rtype == 'AAAA':
+            return dns.Record_AAAA(rdata[0], ttl=ttl)
+        if rtype == 'NS':
+            return dns.Record_NS(name(rdata[0]), ttl=ttl)
+        if rtype == 'CNAME':
+            return dns.Record_CNAME(name(rdata[0]), ttl=ttl)
+        if rtype == 'PTR':
+            return dns.Record_PTR(name(rdata[0]), ttl=ttl)
+        if rtype == 'MX':
+            return dns.Record_MX(int(rdata[0]), name(rdata[1]), ttl=ttl)
+        if rtype == 'SRV':
+            return dns.Record_SRV(int(rdata[0]), int(rdata[1]), int(rdata[2]),
+                                  name(rdata[3]), ttl=ttl)
+        if rtype == 'TXT':
+            if not rdata:
+                raise ValueError()
+            return dns.Record_TXT(*[t.encode() for t in rdata], ttl=ttl)
+        if rtype == 'SOA':
+            serial, refresh, retry, expire, minimum = rdata[2:7]
+            return dns.Record_SOA(name(rdata[0]), name(rdata[1]), int(serial),
+                                  self.parseTTL(refresh, number),
+                                  self.parseTTL(retry, number),
+                                  self.parseTTL(expire, number),
+                                  self.parseTTL(minimum, number), ttl=ttl)
+        raise self.error(number, "unsupported record type {}".format(rtype))
+
+
+class ZoneStore:
+    """
+    The zones of all zone_files, looked up by the longest origin that is a
+    suffix of the query name.
+    """
+    def __init__(self, zones=()):
+        self.zones = dict()
+        for zone in zones:
+            self.addZone(zone)
+
+    @classmethod
+    def fromConfig(cls, entries):
+        """
+        Parses the zone_files of the configuration, a list of file names or
+        of dicts with a file and an origin.
+        """
+        zones = []
+        for entry in entries:
+            if isinstance(entry, str):
+                entry = { 'file': entry }
+            zones.append(ZoneParser(entry['file'], entry.get('origin')).parse())
+        return cls(zones)
+
+    def addZone(self, zone):
+        if zone.origin in self.zones:
+            raise RuntimeError("ERROR: zone {} is defined twice".format(
+                               zone.origin))
+        self.zones[zone.origin] = zone
+
+    def findZone(self, name):
+        """
+        Returns the zone name belongs to, or None.
+        """
+        name = name.lower().rstrip('.')
+        while True:
+            zone = self.zones.get(name)
+            if zone is not None:
+                return zone
+            if not name:
+                return None
+            name = name.split('.', 1)[1] if '.' in name else ''
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 
 import sys
-from core.main import FakeDnsProxy
-from core.observer import createLoggerObserver
-
-from twisted.logger import globalLogBeginner
+import core.aio
+from core.config import ConfigParser
 
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("Usage: {} <config_file>".format(sys.argv[0]))
         sys.exit(1)
+
+    # the reactor must be chosen before anything imports it
+    config = ConfigParser()
+    config.parse_config(sys.argv[1])
+    if 'engine' in config and config['engine'] == 'asyncio':
+        use_uvloop = config['use_uvloop'] if 'use_uvloop' in config else True
+        core.aio.installReactor(use_uvloop)
+
+    from core.main import FakeDnsProxy
+    from core.observer import createLoggerObserver
+    from twisted.logger import globalLogBeginner
+
     srv = FakeDnsProxy(sys.argv[1])
     observer = createLoggerObserver(sys.stdout)
     globalLogBeginner.beginLoggingTo([observer])
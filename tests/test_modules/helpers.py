@@ -0,0 +1,17 @@
+"""
+Helpers shared by the test modules
+"""
+
+from twisted.names import dns
+
+
+def generateResponse(name, address, ttl):
+    answer = dns.RRHeader(name=name, ttl=ttl,
+                          payload=dns.Record_A(address=address))
+    return [ answer ], [], []
+
+
+def buildQuery(name, qtype=dns.A, msg_id=4321, **kwargs):
+    m = dns.Message(id=msg_id, recDes=1, **kwargs)
+    m.addQuery(name, qtype)
+    return m
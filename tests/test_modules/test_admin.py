@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import yaml
+
+from twisted.names.dns import Query
+from twisted.test import proto_helpers
+
+from core.admin import AdminController, AdminFactory
+from core.config import ConfigParser
+from core.main import DNSHandler
+
+
+def getHandler(settings=None):
+    config = { 'default_dns_policy': 'default_value',
+               'default_dns_value': '1.2.3.4',
+               'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+               'domain_config': {
+                   '*.foo.com': 'nxdomain',
+               }
+             }
+    config.update(settings or {})
+    cp = ConfigParser(config)
+    cp.generate_config_objects()
+    return DNSHandler(cp)
+
+
+class AdminControllerTester(unittest.TestCase):
+    def test_add_and_remove_rules(self):
+        handler = getHandler()
+        admin = AdminController(handler)
+        admin.execute('add bar.com [5.6.7.8, "::1"]')
+        self.assertEqual('custom_value', handler.get_action_for_query(Query('bar.com')))
+        admin.execute('add a.foo.com forward')
+        # the older pattern has priority
+        self.assertEqual('nxdomain', handler.get_action_for_query(Query('a.foo.com')))
+        admin.execute('remove *.foo.com')
+        self.assertEqual('forward', handler.get_action_for_query(Query('a.foo.com')))
+        self.assertEqual(['bar.com {"A": ["5.6.7.8"], "AAAA": ["::1"]}',
+                          'a.foo.com forward'],
+                         admin.execute('list'))
+
+    def test_errors(self):
+        admin = AdminController(getHandler())
+        for line in ['remove bar.com', 'add bar.com', 'add bar.com nonsense',
+                     'add bar.com 5', 'add bar.com ~', 'add bad[.com 1.2.3.4',
+                     'add [z-a].com 1.2.3.4', 'policy nonsense', 'bogus', 'save', 'top']:
+            with self.assertRaises(RuntimeError, msg=line):
+                admin.execute(line)
+        self.assertEqual(['*.foo.com nxdomain'], admin.execute('list'))
+
+    def test_policy(self):
+        handler = getHandler()
+        admin = AdminController(handler)
+        admin.execute('policy nxdomain')
+        self.assertEqual('nxdomain', handler.get_action_for_query(Query('x.com')))
+        admin.execute('policy default_value 9.9.9.9')
+        self.assertEqual(['9.9.9.9'], handler.config['default_dns_value']['A'])
+        self.assertEqual(['default_value'], admin.execute('policy'))
+
+    def test_persist(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'config.yaml')
+            admin = AdminController(getHandler(), persist_file=filename)
+            admin.execute('add bar.com 5.6.7.8')
+            with open(filename) as f:
+                written = yaml.safe_load(f)
+            self.assertEqual({'*.foo.com': 'nxdomain',
+                              'bar.com': {'A': ['5.6.7.8']}},
+                             written['domain_config'])
+            self.assertEqual({'A': ['1.2.3.4']}, written['default_dns_value'])
+            self.assertFalse('domain_matcher' in written)
+
+    def test_stats_and_flush(self):
+        handler = getHandler({'forward_cache': {}, 'heavy_hitters': {}})
+        admin = AdminController(handler)
+        handler.query(Query('a.foo.com'), address=('10.0.0.1', 1234))
+        stats = admin.execute('stats')
+        self.assertTrue('rules 1' in stats)
+        self.assertTrue('forward_cache_entries 0' in stats)
+        self.assertTrue('queries 1' in stats)
+        self.assertEqual(['flushed 0 entries'], admin.execute('flush'))
+        self.assertEqual(3, len(admin.execute('top 1')))
+
+
+class AdminProtocolTester(unittest.TestCase):
+    def test_protocol(self):
+        factory = AdminFactory(AdminController(getHandler()))
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(b'add bar.com 5.6.7.8\nlist\nremove x.com\n')
+        self.assertEqual(b'OK\n*.foo.com nxdomain\nbar.com {"A": ["5.6.7.8"]}\nOK\n'
+                         b'ERROR: there is no rule for x.com\n',
+                         transport.value())
+        transport.clear()
+        proto.dataReceived(b'add [z-a].com 1.2.3.4\n')
+        self.assertTrue(transport.value().startswith(
+                        b'ERROR: invalid domain pattern [z-a].com'))
+        self.assertFalse(transport.disconnecting)
+        proto.dataReceived(b'quit\n')
+        self.assertTrue(transport.disconnecting)
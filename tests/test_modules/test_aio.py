@@ -0,0 +1,123 @@
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.names import dns
+
+import sys
+import os
+import socket
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.aio import AsyncioDNSProtocol, getEventLoop, listenUDP
+from core.config import ConfigParser
+from core.main import CustomDNSServerFactory, DNSHandler
+
+
+class TransportStub(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+class AsyncioDNSProtocolTester(unittest.TestCase):
+    def setUp(self):
+        config = { 'default_dns_policy': 'default_value',
+                   'default_dns_value': '1.2.3.4' }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        factory = CustomDNSServerFactory(clients=[DNSHandler(cp)])
+        self.protocol = AsyncioDNSProtocol(factory)
+        self.transport = TransportStub()
+        self.protocol.connection_made(self.transport)
+
+    def _query(self, name, qtype):
+        m = dns.Message(id=1234, recDes=1)
+        m.addQuery(name, qtype)
+        return m.toStr()
+
+    def test_query_is_answered(self):
+        self.protocol.datagram_received(self._query(b'foobar.com', dns.A),
+                                        ('127.0.0.1', 12345))
+        self.assertEqual(1, len(self.transport.sent))
+        data, address = self.transport.sent[0]
+        self.assertEqual(('127.0.0.1', 12345), address)
+        response = dns.Message()
+        response.fromStr(data)
+        self.assertEqual(1234, response.id)
+        self.assertEqual(1, len(response.answers))
+        self.assertEqual('1.2.3.4', response.answers[0].payload.dottedQuad())
+
+    def test_truncated_packet_is_ignored(self):
+        self.protocol.datagram_received(self._query(b'foobar.com', dns.A)[:5],
+                                        ('127.0.0.1', 12345))
+        self.assertEqual([], self.transport.sent)
+
+    def test_response_is_ignored(self):
+        m = dns.Message(id=1234, answer=1)
+        m.addQuery(b'foobar.com', dns.A)
+        self.protocol.datagram_received(m.toStr(), ('127.0.0.1', 12345))
+        self.assertEqual([], self.transport.sent)
+
+
+class BatchReadTester(unittest.TestCase):
+    def setUp(self):
+        config = { 'default_dns_policy': 'default_value',
+                   'default_dns_value': '1.2.3.4' }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        self.factory = CustomDNSServerFactory(clients=[DNSHandler(cp)])
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.setblocking(False)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.socket.close)
+        self.addCleanup(self.client.close)
+        self.transport = TransportStub()
+
+    def _send(self, count):
+        query = dns.Message(id=1, recDes=1)
+        query.addQuery(b'foobar.com', dns.A)
+        for i in range(count):
+            self.client.sendto(query.toStr(), self.socket.getsockname())
+        return query.toStr()
+
+    def test_pending_datagrams_are_read(self):
+        protocol = AsyncioDNSProtocol(self.factory, sock=self.socket)
+        protocol.connection_made(self.transport)
+        data = self._send(5)
+        protocol.datagram_received(data, ('127.0.0.1', 12345))
+        self.assertEqual(6, len(self.transport.sent))
+
+    def test_read_is_bounded(self):
+        data = self._send(5)
+        protocol = AsyncioDNSProtocol(self.factory, sock=self.socket,
+                                      max_read_bytes=3 * len(data))
+        protocol.connection_made(self.transport)
+        protocol.datagram_received(data, ('127.0.0.1', 12345))
+        self.assertEqual(3, len(self.transport.sent))
+        protocol.reading = False
+        protocol.datagram_received(data, ('127.0.0.1', 12345))
+        self.assertEqual(4, len(self.transport.sent))
+
+
+class ListenUDPTester(unittest.TestCase):
+    def test_requires_asyncio_reactor(self):
+        if getEventLoop(reactor) is not None:
+            raise unittest.SkipTest("tests run on the asyncio reactor")
+        with self.assertRaises(RuntimeError):
+            listenUDP(reactor, 0, None, interface='127.0.0.1')
+
+
+class InstallReactorTester(unittest.TestCase):
+    def test_config_does_not_import_reactor(self):
+        # fakednsproxy.py reads the config before it installs the reactor,
+        # this needs a fresh interpreter as the tests run on a reactor
+        code = ("import core.config, core.aio; "
+                "core.aio.installReactor(False); "
+                "from twisted.internet import reactor; "
+                "print(type(reactor).__name__)")
+        root = os.path.join(os.path.dirname(__file__), '..', '..')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(b'AsyncioSelectorReactor', output.strip())
@@ -0,0 +1,129 @@
+from twisted.trial import unittest
+from twisted.names import dns
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.admin import AdminController
+from core.answerpolicy import AnswerPolicy
+from core.config import ConfigParser
+from core.harness import Harness
+
+
+POLICY = { 'rules': [ { 'networks': ['10.0.0.0/8', 'fc00::/7'],
+                        'action': 'drop' },
+                      { 'networks': ['10.1.0.0/16'],
+                        'action': 'rewrite',
+                        'addresses': ['192.0.2.1', '2001:db8::1'] } ] }
+
+
+def record(name, payload):
+    return dns.RRHeader(name=name, type=payload.TYPE, payload=payload, ttl=30)
+
+
+class AnswerPolicyTester(unittest.TestCase):
+    def setUp(self):
+        self.policy = AnswerPolicy(POLICY)
+
+    def test_unchanged_response(self):
+        response = ([record('foo.com', dns.Record_A('1.2.3.4')),
+                     record('foo.com', dns.Record_MX(10, 'mail.foo.com'))],
+                    [], [record('mail.foo.com', dns.Record_A('8.8.8.8'))])
+        self.assertIs(response, self.policy.filterResponse(response, dns.A))
+        self.assertEqual([0, 0, 0], [v for _, v in self.policy.getStats()])
+
+    def test_drop(self):
+        response = ([record('foo.com', dns.Record_A('10.0.0.1')),
+                     record('foo.com', dns.Record_A('1.2.3.4'))], [], [])
+        ans, auth, add = self.policy.filterResponse(response, dns.A)
+        self.assertEqual(['1.2.3.4'], [r.payload.dottedQuad() for r in ans])
+        self.assertEqual(1, self.policy.dropped)
+        response = ([record('foo.com', dns.Record_AAAA('fd00::1'))], [], [])
+        self.assertEqual(None, self.policy.filterResponse(response, dns.AAAA))
+
+    def test_most_specific_network_wins(self):
+        response = ([record('foo.com', dns.Record_A('10.1.2.3'))], [], [])
+        ans, _, _ = self.policy.filterResponse(response, dns.A)
+        self.assertEqual(['192.0.2.1'], [r.payload.dottedQuad() for r in ans])
+        self.assertEqual(b'foo.com', ans[0].name.name)
+        self.assertEqual(30, ans[0].ttl)
+        self.assertEqual(1, self.policy.rewritten)
+
+    def test_rewrites_are_deduplicated(self):
+        response = ([record('foo.com', dns.Record_A('10.1.0.1')),
+                     record('foo.com', dns.Record_A('10.1.0.2')),
+                     record('bar.com', dns.Record_A('10.1.0.3'))], [], [])
+        ans, _, _ = self.policy.filterResponse(response, dns.A)
+        self.assertEqual([(b'foo.com', '192.0.2.1'), (b'bar.com', '192.0.2.1')],
+                         [(r.name.name, r.payload.dottedQuad()) for r in ans])
+        self.assertEqual(3, self.policy.rewritten)
+
+    def test_ipv4_mapped(self):
+        response = ([record('foo.com', dns.Record_AAAA('::ffff:10.1.0.1'))],
+                    [], [])
+        ans, _, _ = self.policy.filterResponse(response, dns.AAAA)
+        self.assertEqual([dns.Record_AAAA('2001:db8::1')], [r.payload for r in ans])
+
+    def test_strip_aaaa(self):
+        policy = AnswerPolicy({ 'strip_aaaa': True })
+        response = ([record('foo.com', dns.Record_A('1.2.3.4'))], [],
+                    [record('foo.com', dns.Record_AAAA('2001:db8::2'))])
+        ans, auth, add = policy.filterResponse(response, dns.A)
+        self.assertEqual(response[0], ans)
+        self.assertEqual([], add)
+        self.assertEqual(1, policy.stripped)
+
+
+class ForwardedAnswerTester(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness({ 'default_dns_policy': 'forward',
+                                 'dns_server': { 'ip': '192.0.2.53', 'port': 53 },
+                                 'forward_cache': { 'max_entries': 10 },
+                                 'answer_policy': POLICY })
+        self.harness.upstream.setAnswer('internal.com', dns.A,
+                                        [dns.Record_A('10.2.3.4')])
+        self.harness.upstream.setAnswer('sinkhole.com', dns.A,
+                                        [dns.Record_A('10.1.3.4')])
+
+    def test_dropped_answer_is_nodata(self):
+        for _ in range(2):
+            reply = self.harness.query('internal.com')
+            self.assertEqual(dns.OK, reply.rCode)
+            self.assertEqual([], reply.answers)
+            self.assertEqual(dns.SOA, reply.authority[0].type)
+        # the second answer came from the forward_cache
+        self.assertEqual(1, len(self.harness.upstream.queries))
+        self.assertEqual(1, self.harness.dns_handler.answer_policy.dropped)
+
+    def test_rewritten_answer(self):
+        reply = self.harness.query('sinkhole.com')
+        self.assertEqual('192.0.2.1', reply.answers[0].payload.dottedQuad())
+        admin = AdminController(self.harness.dns_handler)
+        self.assertIn('answer_policy_rewritten 1', admin.execute('stats'))
+
+    def test_validate_config(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                 'listening_info': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(dict(base, answer_policy=dict(POLICY, strip_aaaa=True)))
+        cp.validate_config()
+        for policy in [[], { 'strip_aaaa': 'yes' }, { 'rules': {} },
+                       { 'rules': [ { 'networks': ['10.0.0.0/33'],
+                                      'action': 'drop' } ] },
+                       { 'rules': [ { 'networks': ['10.0.0.0/8'],
+                                      'action': 'block' } ] },
+                       { 'rules': [ { 'networks': ['10.0.0.0/8'],
+                                      'action': 'rewrite' } ] },
+                       { 'rules': [ { 'networks': ['10.0.0.0/8'],
+                                      'action': 'drop',
+                                      'addresses': ['1.2.3.4'] } ] },
+                       { 'rules': [ { 'networks': ['10.0.0.0/8'],
+                                      'action': 'rewrite',
+                                      'addresses': ['1.2.3'] } ] },
+                       { 'rules': [ { 'networks': ['10.0.0.0/8'],
+                                      'action': 'drop' },
+                                    { 'networks': ['10.0.0.0/8'],
+                                      'action': 'drop' } ] }]:
+            cp = ConfigParser(dict(base, answer_policy=policy))
+            self.assertRaises(RuntimeError, cp.validate_config)
@@ -0,0 +1,233 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.names import dns, error
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.cache import ForwardCache
+from tests.test_modules.helpers import generateResponse
+from core.main import DNSHandler
+from core.config import ConfigParser
+
+
+class ResolverStub(object):
+    """
+    Resolver that returns the Deferreds it handed out, so that the tests can
+    decide when (and if) the upstream answers.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def query(self, query, timeout=None):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class ForwardCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.query = Query('foobar.com')
+
+    def test_fresh_lookup_reduces_ttl(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(10)
+        response, is_stale = cache.lookup(self.query)
+        self.assertEqual(False, is_stale)
+        self.assertEqual(50, response[0][0].ttl)
+
+    def test_lookup_is_case_insensitive(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.assertNotEqual(None, cache.lookup(Query('FooBar.com')))
+
+    def test_expired_without_stale(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(61)
+        self.assertEqual(None, cache.lookup(self.query))
+        self.assertEqual(0, len(cache))
+
+    def test_expired_with_stale(self):
+        cache = ForwardCache(max_stale_age=100, clock=self.clock)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(100)
+        _, is_stale = cache.lookup(self.query)
+        self.assertEqual(True, is_stale)
+        self.clock.advance(100)
+        self.assertEqual(None, cache.lookup(self.query))
+
+    def test_empty_response_not_cached(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(self.query, ([], [], []))
+        self.assertEqual(None, cache.lookup(self.query))
+
+    def test_max_entries(self):
+        cache = ForwardCache(max_entries=2, clock=self.clock)
+        for name in ['a.com', 'b.com', 'c.com']:
+            cache.store(Query(name), generateResponse(name, '1.2.3.4', 60))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.lookup(Query('a.com')))
+
+
+class SnapshotTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.filename = self.mktemp()
+
+    def test_roundtrip_reduces_ttl(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(Query('a.com'), generateResponse('a.com', '1.2.3.4', 60))
+        cache.store(Query('b.com'), generateResponse('b.com', '1.2.3.5', 600))
+        cache.dump(self.filename)
+        # the time the proxy is down counts as time spent in the cache
+        self.clock.advance(100)
+        restored = ForwardCache(clock=self.clock)
+        self.assertEqual(1, restored.load(self.filename))
+        self.assertEqual(None, restored.lookup(Query('a.com')))
+        response, is_stale = restored.lookup(Query('b.com'))
+        self.assertEqual(False, is_stale)
+        self.assertEqual(500, response[0][0].ttl)
+        self.assertEqual('1.2.3.5', response[0][0].payload.dottedQuad())
+
+    def test_roundtrip_large_response(self):
+        cache = ForwardCache(clock=self.clock)
+        answers = [dns.RRHeader(name='a.com', ttl=60,
+                                payload=dns.Record_A(address='10.0.0.{}'.format(i)))
+                   for i in range(50)]
+        cache.store(Query('a.com'), (answers, [], []))
+        cache.dump(self.filename)
+        restored = ForwardCache(clock=self.clock)
+        self.assertEqual(1, restored.load(self.filename))
+        response, _ = restored.lookup(Query('a.com'))
+        # the 50 records do not fit into 512 bytes and must not be truncated
+        self.assertEqual([r.payload.dottedQuad() for r in answers],
+                         [r.payload.dottedQuad() for r in response[0]])
+
+    def test_stale_entries_are_kept(self):
+        cache = ForwardCache(max_stale_age=1000, clock=self.clock)
+        cache.store(Query('a.com'), generateResponse('a.com', '1.2.3.4', 60))
+        cache.dump(self.filename)
+        self.clock.advance(100)
+        restored = ForwardCache(max_stale_age=1000, clock=self.clock)
+        restored.load(self.filename)
+        _, is_stale = restored.lookup(Query('a.com'))
+        self.assertEqual(True, is_stale)
+
+    def test_most_recently_used_are_kept(self):
+        cache = ForwardCache(clock=self.clock)
+        for name in ['a.com', 'b.com', 'c.com']:
+            cache.store(Query(name), generateResponse(name, '1.2.3.4', 60))
+        cache.lookup(Query('a.com'))
+        cache.dump(self.filename)
+        restored = ForwardCache(max_entries=2, clock=self.clock)
+        self.assertEqual(2, restored.load(self.filename))
+        self.assertEqual(None, restored.lookup(Query('b.com')))
+        self.assertEqual(['c.com', 'a.com'],
+                         [key[0].decode() for key in restored.entries])
+
+    def test_load_time_is_bounded(self):
+        cache = ForwardCache(clock=self.clock)
+        cache.store(Query('a.com'), generateResponse('a.com', '1.2.3.4', 60))
+        cache.dump(self.filename)
+        restored = ForwardCache(clock=self.clock)
+        self.assertEqual(0, restored.load(self.filename, max_load_time=-1))
+
+    def test_invalid_snapshot(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'garbage garbage')
+        cache = ForwardCache(clock=self.clock)
+        self.assertRaises(RuntimeError, cache.load, self.filename)
+
+
+class ServeStaleTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        config = { 'default_dns_policy': 'forward',
+                   'forward_cache': {
+                       'serve_stale': True,
+                       'stale_client_timeout': 0.5,
+                       'stale_answer_ttl': 30,
+                    }
+                 }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        self.handler = DNSHandler(cp, clock=self.clock)
+        self.upstream = ResolverStub()
+        self.handler.resolver = self.upstream
+        self.query = Query('foobar.com')
+
+    def _warmCache(self):
+        self.handler.query(self.query)
+        self.upstream.pending.pop().callback(
+                generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(120)
+
+    def _collect(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_fresh_answer_from_cache(self):
+        self.handler.query(self.query)
+        self.upstream.pending.pop().callback(
+                generateResponse('foobar.com', '1.2.3.4', 60))
+        results = self._collect(self.handler.query(self.query))
+        self.assertEqual(0, len(self.upstream.pending))
+        self.assertEqual('1.2.3.4', results[0][0][0].payload.dottedQuad())
+
+    def test_stale_answer_after_client_timeout(self):
+        self._warmCache()
+        results = self._collect(self.handler.query(self.query))
+        self.assertEqual([], results)
+        self.clock.advance(0.5)
+        answers, _, _ = results[0]
+        self.assertEqual('1.2.3.4', answers[0].payload.dottedQuad())
+        self.assertEqual(30, answers[0].ttl)
+
+        # the refresh continues and updates the cache
+        self.upstream.pending.pop().callback(
+                generateResponse('foobar.com', '2.3.4.5', 60))
+        response, is_stale = self.handler.forward_cache.lookup(self.query)
+        self.assertEqual(False, is_stale)
+        self.assertEqual('2.3.4.5', response[0][0].payload.dottedQuad())
+
+    def test_upstream_answer_before_client_timeout(self):
+        self._warmCache()
+        results = self._collect(self.handler.query(self.query))
+        self.upstream.pending.pop().callback(
+                generateResponse('foobar.com', '2.3.4.5', 60))
+        self.assertEqual('2.3.4.5', results[0][0][0].payload.dottedQuad())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_upstream_failure_serves_stale(self):
+        self._warmCache()
+        results = self._collect(self.handler.query(self.query))
+        self.upstream.pending.pop().errback(error.DNSServerError())
+        self.assertEqual('1.2.3.4', results[0][0][0].payload.dottedQuad())
+
+    def test_upstream_timeout_serves_stale(self):
+        self._warmCache()
+        results = self._collect(self.handler.query(self.query))
+        self.upstream.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+        self.assertEqual('1.2.3.4', results[0][0][0].payload.dottedQuad())
+
+    def test_nxdomain_is_not_answered_stale(self):
+        self._warmCache()
+        results = self._collect(self.handler.query(self.query))
+        self.upstream.pending.pop().errback(error.DNSNameError())
+        self.assertIsNotNone(results[0].check(error.DNSNameError))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_no_stale_answer_available(self):
+        results = self._collect(self.handler.query(self.query))
+        self.clock.advance(5)
+        self.assertEqual([], results)
+        self.upstream.pending.pop().errback(error.DNSServerError())
+        self.assertIsNotNone(results[0].check(error.DNSServerError))
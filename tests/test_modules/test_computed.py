@@ -0,0 +1,124 @@
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names import dns
+from twisted.names.dns import Query
+
+from core.computed import ComputedAnswer, findEmbeddedAddress, parseReverseName
+from core.config import ConfigParser, DNSAnswerConfig
+from core.main import DNSHandler
+
+
+def getAnswers(handler, name, qtype=dns.A):
+    results = []
+    handler.query(Query(name, qtype)).addBoth(results.append)
+    return results[0][0]
+
+
+class EmbeddedAddressTester(unittest.TestCase):
+    def test_find(self):
+        self.assertEqual('10.1.2.3', findEmbeddedAddress('10-1-2-3.lab.example'))
+        self.assertEqual('10.1.2.3', findEmbeddedAddress('app.10.1.2.3.lab.example'))
+        self.assertEqual('192.168.0.1',
+                         findEmbeddedAddress('web-192-168-000-001.lab.example'))
+        self.assertEqual(None, findEmbeddedAddress('10-1-2.lab.example'))
+        self.assertEqual(None, findEmbeddedAddress('10-1-2-300.lab.example'))
+        self.assertEqual(None, findEmbeddedAddress('x10-1-2-3.lab.example'))
+
+    def test_reverse_names(self):
+        self.assertEqual('1.2.3.4', str(parseReverseName('4.3.2.1.in-addr.arpa')))
+        name = '.'.join(reversed('20010db8' + '0' * 23 + '1')) + '.ip6.arpa'
+        self.assertEqual('2001:db8::1', str(parseReverseName(name)))
+        self.assertEqual(None, parseReverseName('3.2.1.in-addr.arpa'))
+        self.assertEqual(None, parseReverseName('4.3.2.x.in-addr.arpa'))
+        self.assertEqual(None, parseReverseName('foobar.com'))
+
+
+class ComputedAnswerTester(unittest.TestCase):
+    def test_embedded_ip(self):
+        computed = ComputedAnswer({ 'compute': 'embedded_ip' })
+        self.assertEqual(['10.1.2.3'], computed.getValues('10-1-2-3.lab', 'A'))
+        self.assertEqual([], computed.getValues('10-1-2-3.lab', 'AAAA'))
+        self.assertEqual([], computed.getValues('www.lab', 'A'))
+
+    def test_hash_is_stable(self):
+        pool = ['10.0.0.{}'.format(i) for i in range(1, 9)] + ['::1']
+        computed = ComputedAnswer({ 'compute': 'hash', 'pool': pool })
+        picked = set()
+        for i in range(100):
+            name = 'host{}.example.com'.format(i)
+            values = computed.getValues(name, 'A')
+            other = ComputedAnswer({ 'compute': 'hash', 'pool': pool,
+                                     'cache_size': 0 })
+            self.assertEqual(values, other.getValues(name.upper(), 'A'))
+            picked.update(values)
+        self.assertEqual(8, len(picked))
+        self.assertEqual(['::1'], computed.getValues('foo.com', 'AAAA'))
+        self.assertEqual([], computed.getValues('foo.com', 'MX'))
+
+    def test_ptr_template(self):
+        computed = ComputedAnswer({ 'compute': 'ptr',
+                                    'template': 'host-{dashed}.lab.example' })
+        self.assertEqual(['host-1-2-3-4.lab.example'],
+                         computed.getValues('4.3.2.1.in-addr.arpa', 'PTR'))
+        self.assertEqual([], computed.getValues('4.3.2.1.in-addr.arpa', 'A'))
+
+    def test_memo_is_bounded_lru(self):
+        computed = ComputedAnswer({ 'compute': 'embedded_ip', 'cache_size': 2 })
+        computed.getValues('1-1-1-1.lab', 'A')
+        computed.getValues('2-2-2-2.lab', 'A')
+        computed.getValues('1-1-1-1.LAB', 'A')
+        computed.getValues('3-3-3-3.lab', 'A')
+        self.assertEqual(1, computed.hits)
+        self.assertEqual(3, computed.misses)
+        self.assertEqual([('1-1-1-1.lab', 'A'), ('3-3-3-3.lab', 'A')],
+                         list(computed.memo))
+
+    def test_invalid_settings(self):
+        for settings in [{ 'compute': 'magic' },
+                         { 'compute': 'hash' },
+                         { 'compute': 'hash', 'pool': ['not-an-ip'] },
+                         { 'compute': 'ptr' },
+                         { 'compute': 'ptr', 'template': 'host-{name}' },
+                         { 'compute': 'ptr', 'template': 'host-{ip.foo}' },
+                         { 'compute': 'ptr', 'template': 'host-{ip[a]}' },
+                         { 'compute': 'embedded_ip', 'pool': ['1.2.3.4'] },
+                         { 'compute': 'embedded_ip', 'cache_size': -1 }]:
+            self.assertRaises(RuntimeError, DNSAnswerConfig, settings)
+
+
+class ComputedRuleTester(unittest.TestCase):
+    def setUp(self):
+        cp = ConfigParser({
+                'default_dns_policy': 'nxdomain',
+                'domain_config': {
+                    '*.lab.example': { 'compute': 'embedded_ip' },
+                    '*.sink.example': { 'compute': 'hash',
+                                        'pool': ['10.9.0.1', '10.9.0.2'] },
+                    '*.in-addr.arpa': { 'compute': 'ptr',
+                                        'template': 'host-{dashed}.lab.example' },
+                } })
+        cp.generate_config_objects()
+        self.config = cp
+        self.handler = DNSHandler(cp)
+
+    def test_answers(self):
+        ans = getAnswers(self.handler, '10-1-2-3.lab.example')
+        self.assertEqual('10.1.2.3', ans[0].payload.dottedQuad())
+        self.assertEqual(b'10-1-2-3.lab.example', ans[0].name.name)
+        ans = getAnswers(self.handler, 'a.sink.example')
+        self.assertIn(ans[0].payload.dottedQuad(), ['10.9.0.1', '10.9.0.2'])
+        ans = getAnswers(self.handler, '3.2.1.10.in-addr.arpa', dns.PTR)
+        self.assertEqual(b'host-10-1-2-3.lab.example', ans[0].payload.name.name)
+
+    def test_no_embedded_ip_is_nxdomain(self):
+        self.assertEqual([], getAnswers(self.handler, 'www.lab.example'))
+
+    def test_plain_config_round_trip(self):
+        plain = self.config.getPlainConfig()['domain_config']
+        self.assertEqual({ 'compute': 'ptr',
+                           'template': 'host-{dashed}.lab.example' },
+                         plain['*.in-addr.arpa'])
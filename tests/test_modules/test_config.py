@@ -147,6 +147,11 @@ class DNSAnswerConfigTester(unittest.TestCase):
             a = DNSAnswerConfig(['::1', 'invalid_address'])
 
 
+    def test_invalid_value_type(self):
+        for value in [5, 1.5, True]:
+            with self.assertRaises(RuntimeError):
+                DNSAnswerConfig(value)
+
     def test_ip_list_invalid_address(self):
         with self.assertRaises(RuntimeError):
             a = DNSAnswerConfig('invalid_address')
@@ -12,6 +12,7 @@ from twisted.names.dns import Query
 
 from core.dns_reply_generators import DNSReplyGenerator
 from core.config import ConfigParser
+from core.harness import Harness
 
 class DNSReplygeneratorMatchTester(unittest.TestCase):
     def _test_domain_match(self, config, qtype, domain, should_match=None):
@@ -79,3 +80,46 @@ class DNSReplygeneratorMatchTester(unittest.TestCase):
         self._test_domain_match(config, 'A', 'foobar.barfoo.com', should_match=['127.0.0.1'])
 
 
+class NoDataTester(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness({ 'default_dns_policy': 'default_value',
+                                 'default_dns_value': { 'A': '1.2.3.4' },
+                                 'negative_ttl': 300,
+                                 'domain_config': {
+                                    'v6.com': '::1',
+                                    'gone.com': 'nxdomain',
+                                    '*.nip.lab': { 'compute': 'embedded_ip' },
+                                 } })
+
+    def test_missing_type_is_nodata(self):
+        for name, qtype in [('v6.com', dns.A), ('foobar.com', dns.AAAA),
+                            ('10-1-2-3.nip.lab', dns.AAAA)]:
+            reply = self.harness.query(name, qtype)
+            self.assertEqual(dns.OK, reply.rCode)
+            self.assertEqual([], reply.answers)
+            soa = reply.authority[0]
+            self.assertEqual(dns.SOA, soa.type)
+            self.assertEqual(name.encode(), soa.name.name)
+            self.assertEqual(300, soa.ttl)
+            self.assertEqual(300, soa.payload.minimum)
+
+    def test_nxdomain_is_kept(self):
+        for name in ['gone.com', 'www.nip.lab']:
+            reply = self.harness.query(name)
+            self.assertEqual(dns.ENAME, reply.rCode)
+            self.assertEqual([], reply.authority)
+
+    def test_counters(self):
+        self.harness.query('v6.com')
+        self.harness.query('gone.com')
+        self.harness.query('v6.com', dns.AAAA)
+        handler = self.harness.dns_handler
+        self.assertEqual((1, 1), (handler.nxdomain_answers, handler.nodata_answers))
+
+    def test_fast_path(self):
+        harness = Harness({ 'default_dns_policy': 'default_value',
+                            'default_dns_value': '1.2.3.4' }, fast_path=True)
+        reply = harness.query('foobar.com', dns.MX)
+        self.assertEqual(dns.OK, reply.rCode)
+        self.assertEqual(dns.SOA, reply.authority[0].type)
+        self.assertEqual(60, reply.authority[0].ttl)
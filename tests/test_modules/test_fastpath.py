@@ -0,0 +1,123 @@
+from twisted.trial import unittest
+from twisted.names import dns
+
+import struct
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.config import ConfigParser
+from core.fastpath import FastPathResponder, parseQuestion
+from core.harness import Harness
+from core.main import CustomDNSServerFactory, DNSHandler
+from tests.test_modules.helpers import buildQuery
+
+
+class ProtocolStub(object):
+    def __init__(self):
+        self.sent = []
+
+    def writeMessage(self, message, address):
+        self.sent.append(message.toStr())
+
+
+class ParseQuestionTester(unittest.TestCase):
+    def test_plain_query(self):
+        data = buildQuery(b'www.foobar.com', dns.AAAA).toStr()
+        msg_id, name, qtype, qclass, end = parseQuestion(data)
+        self.assertEqual(4321, msg_id)
+        self.assertEqual(b'www.foobar.com', name)
+        self.assertEqual(dns.AAAA, qtype)
+        self.assertEqual(dns.IN, qclass)
+        self.assertEqual(len(data), end)
+
+    def test_root_name(self):
+        data = buildQuery(b'', dns.NS).toStr()
+        self.assertEqual(b'', parseQuestion(data)[1])
+
+    def test_truncated_datagram(self):
+        data = buildQuery(b'www.foobar.com').toStr()
+        for length in [5, 15, len(data) - 2]:
+            self.assertEqual(None, parseQuestion(data[:length]))
+
+    def test_response_not_parsed(self):
+        data = buildQuery(b'foobar.com', answer=1).toStr()
+        self.assertEqual(None, parseQuestion(data))
+
+    def test_other_opcode_not_parsed(self):
+        data = buildQuery(b'foobar.com', opCode=dns.OP_NOTIFY).toStr()
+        self.assertEqual(None, parseQuestion(data))
+
+    def test_multiple_questions_not_parsed(self):
+        m = buildQuery(b'foobar.com')
+        m.addQuery(b'barfoo.com')
+        self.assertEqual(None, parseQuestion(m.toStr()))
+
+    def test_edns_not_parsed(self):
+        m = dns._EDNSMessage(id=1, queries=[dns.Query(b'foobar.com')])
+        self.assertEqual(None, parseQuestion(m.toStr()))
+
+    def test_compressed_question_not_parsed(self):
+        data = struct.pack('!6H', 1, 0, 1, 0, 0, 0) + b'\xc0\x0c' + \
+               struct.pack('!HH', dns.A, dns.IN)
+        self.assertEqual(None, parseQuestion(data))
+
+
+class FastPathResponderTester(unittest.TestCase):
+    def _getResponder(self, config):
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        handler = DNSHandler(cp)
+        self.factory = CustomDNSServerFactory(clients=[handler])
+        return FastPathResponder(handler, self.factory)
+
+    def _getFullPathResponse(self, message):
+        protocol = ProtocolStub()
+        self.factory.messageReceived(message, protocol, ('127.0.0.1', 12345))
+        return protocol.sent[0]
+
+    def test_same_response_as_full_path(self):
+        responder = self._getResponder({
+                'default_dns_policy': 'nxdomain',
+                'domain_config': { 'foobar.com': ['1.2.3.4', '2.3.4.5'] }
+        })
+        for name in [b'foobar.com', b'unknown.com']:
+            message = buildQuery(name)
+            fast = responder.handleDatagram(message.toStr(),
+                                            ('127.0.0.1', 12345))
+            self.assertEqual(self._getFullPathResponse(message), fast)
+
+    def test_answer_with_names(self):
+        responder = self._getResponder({
+                'default_dns_policy': 'default_value',
+                'default_dns_value': { 'MX': 'mail.foobar.com' }
+        })
+        data = responder.handleDatagram(buildQuery(b'foobar.com', dns.MX).toStr(),
+                                        ('127.0.0.1', 12345))
+        response = dns.Message()
+        response.fromStr(data)
+        self.assertEqual(dns.OK, response.rCode)
+        self.assertEqual(b'foobar.com', response.answers[0].name.name)
+        self.assertEqual(b'mail.foobar.com', response.answers[0].payload.name.name)
+
+    def test_forward_takes_normal_path(self):
+        responder = self._getResponder({ 'default_dns_policy': 'forward' })
+        data = buildQuery(b'foobar.com').toStr()
+        self.assertEqual(None, responder.handleDatagram(data, ('127.0.0.1', 1)))
+
+    def test_forward_action_is_decided_once(self):
+        harness = Harness({ 'default_dns_policy': 'forward',
+                            'dns_server': { 'ip': '192.0.2.53', 'port': 53 } },
+                          fast_path=True)
+        harness.upstream.setAnswer('foobar.com', dns.A, [dns.Record_A('1.2.3.4')])
+        handler = harness.dns_handler
+        actions = []
+        get_action = handler.get_action_for_query
+        def count(query, address=None):
+            actions.append(query)
+            return get_action(query, address)
+        handler.get_action_for_query = count
+        reply = harness.query('foobar.com')
+        self.assertEqual('1.2.3.4', reply.answers[0].payload.dottedQuad())
+        self.assertEqual(1, len(actions))
+        self.assertEqual(None, harness.factory.fast_path_action)
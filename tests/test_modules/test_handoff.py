@@ -0,0 +1,85 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, threads
+
+import socket
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.handoff import HandoffFactory, finishHandoff, receiveSocket
+from core.main import DNSHandler
+
+
+class ProxyStub(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.handed_off = False
+
+    def getListeningSocket(self):
+        return self.sock.fileno(), socket.AF_INET
+
+    def handOff(self):
+        self.handed_off = True
+        return defer.succeed(None)
+
+
+class HandoffTester(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.proxy = ProxyStub()
+        self.port = reactor.listenUNIX(self.path, HandoffFactory(self.proxy))
+
+    def tearDown(self):
+        self.proxy.sock.close()
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_socket_is_passed(self):
+        def takeOver():
+            conn, fd, family = receiveSocket(self.path)
+            sock = socket.socket(family, socket.SOCK_DGRAM, fileno=fd)
+            address = sock.getsockname()
+            sock.close()
+            finishHandoff(conn)
+            return address, family
+
+        address, family = yield threads.deferToThread(takeOver)
+        self.assertEqual(self.proxy.sock.getsockname(), address)
+        self.assertEqual(socket.AF_INET, family)
+        self.assertTrue(self.proxy.handed_off)
+
+    @defer.inlineCallbacks
+    def test_no_handoff_without_ready(self):
+        def abort():
+            conn, fd, _ = receiveSocket(self.path)
+            os.close(fd)
+            conn.close()
+
+        yield threads.deferToThread(abort)
+        self.assertFalse(self.proxy.handed_off)
+
+    def test_nobody_listening(self):
+        self.assertEqual(None, receiveSocket(self.mktemp()))
+
+
+class ForwardsInFlightTester(unittest.TestCase):
+    def test_counter(self):
+        config = { 'default_dns_policy': 'forward',
+                   'dns_server': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        handler = DNSHandler(cp)
+        pending = defer.Deferred()
+
+        class ResolverStub(object):
+            def query(self, query, timeout=None):
+                return pending
+        handler.resolver = ResolverStub()
+        handler.query(Query('foobar.com'))
+        self.assertEqual(1, handler.forwards_in_flight)
+        pending.callback(([], [], []))
+        self.assertEqual(0, handler.forwards_in_flight)
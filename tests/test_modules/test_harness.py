@@ -0,0 +1,95 @@
+from twisted.trial import unittest
+from twisted.names import dns
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.harness import Harness
+
+
+FORWARD = { 'default_dns_policy': 'forward',
+            'dns_server': { 'ip': '192.0.2.53', 'port': 53 } }
+
+
+def parse(data):
+    message = dns.Message()
+    message.fromStr(data)
+    return message
+
+
+class HarnessTester(unittest.TestCase):
+    def test_generated_answer(self):
+        harness = Harness({ 'default_dns_policy': 'default_value',
+                            'default_dns_value': '1.2.3.4' })
+        reply = harness.query('foobar.com')
+        self.assertEqual('1.2.3.4', reply.answers[0].payload.dottedQuad())
+        self.assertEqual([0], harness.latencies)
+        self.assertEqual(('127.0.0.1', 53000), harness.replies[0][1])
+        self.assertEqual([], harness.upstream.queries)
+
+    def test_fast_path(self):
+        harness = Harness({ 'default_dns_policy': 'nxdomain' }, fast_path=True)
+        reply = harness.query('foobar.com')
+        self.assertEqual(dns.ENAME, reply.rCode)
+
+    def test_upstream_latency(self):
+        harness = Harness(FORWARD)
+        harness.upstream.setAnswer('foo.com', dns.A, [dns.Record_A('10.0.0.1')],
+                                   latency=0.05)
+        self.assertEqual(None, harness.query('foo.com'))
+        self.assertEqual(1, harness.upstream.in_flight)
+        self.assertEqual([], harness.advance(0.04))
+        replies = harness.advance(0.01)
+        self.assertEqual('10.0.0.1', parse(replies[0]).answers[0].payload.dottedQuad())
+        self.assertEqual([0.05], harness.latencies)
+        self.assertEqual([dns.Query('foo.com')], harness.upstream.queries)
+
+    def test_upstream_errors(self):
+        harness = Harness(dict(FORWARD, dns_server={ 'ip': '192.0.2.53',
+                                                     'port': 53,
+                                                     'query_deadline': 2 }))
+        self.assertEqual(dns.ENAME, harness.query('unknown.com').rCode)
+        harness.upstream.setAnswer('slow.com', dns.A, [dns.Record_A('10.0.0.1')],
+                                   latency=10)
+        harness.query('slow.com')
+        replies = harness.advance(2)
+        self.assertEqual(dns.ESERVER, parse(replies[0]).rCode)
+        self.assertEqual(2, harness.latencies[-1])
+        self.flushLoggedErrors(dns.DNSQueryTimeoutError)
+
+    def test_rule_upstreams_are_faked(self):
+        harness = Harness(dict(FORWARD, domain_config={
+                                  '*.corp.example': { 'forward': '10.0.0.53' } }))
+        harness.upstream.setAnswer('a.corp.example', dns.A,
+                                   [dns.Record_A('10.1.1.1')])
+        reply = harness.query('a.corp.example')
+        self.assertEqual('10.1.1.1', reply.answers[0].payload.dottedQuad())
+
+    def test_stale_answer_deadline(self):
+        harness = Harness(dict(FORWARD, forward_cache={ 'serve_stale': True }))
+        harness.upstream.setAnswer('foo.com', dns.A,
+                                   [dns.RRHeader('foo.com', ttl=60,
+                                                 payload=dns.Record_A('10.0.0.1'))])
+        harness.query('foo.com')
+        harness.advance(120)
+        harness.upstream.latency = 5
+        harness.upstream.setAnswer('foo.com', dns.A, [dns.Record_A('10.0.0.2')])
+        self.assertEqual(None, harness.query('foo.com'))
+        replies = harness.advance(1.8)
+        self.assertEqual('10.0.0.1', parse(replies[0]).answers[0].payload.dottedQuad())
+        self.assertAlmostEqual(1.8, harness.latencies[-1])
+
+    def test_many_queries_in_flight(self):
+        harness = Harness(dict(FORWARD, dns_server={ 'ip': '192.0.2.53',
+                                                     'port': 53,
+                                                     'adaptive_timeout': True }))
+        for i in range(100):
+            harness.upstream.setAnswer('host{}.com'.format(i), dns.A,
+                                       [dns.Record_A('10.0.0.1')],
+                                       latency=0.01 * (i % 10 + 1))
+            harness.query('host{}.com'.format(i), address=('192.0.2.1', 1000 + i))
+        self.assertEqual(100, harness.upstream.in_flight)
+        self.assertEqual(100, len(harness.advance(1)))
+        self.assertEqual(0.055, round(sum(harness.latencies) / 100, 6))
+        self.assertEqual(0, harness.dns_handler.forwards_in_flight)
@@ -0,0 +1,130 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.names import dns
+from twisted.python import failure
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.limits import ForwardLimiter, ForwardQueryShed
+from core.main import CustomDNSServerFactory, DNSHandler
+
+
+class ResolverStub(object):
+    def __init__(self):
+        self.pending = []
+
+    def query(self, query, timeout=None):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+def collect(d):
+    results = []
+    d.addBoth(results.append)
+    return results
+
+
+class ForwardLimiterTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_global_limit_without_queue(self):
+        limiter = ForwardLimiter({ 'max_in_flight': 2 }, clock=self.clock)
+        collect(limiter.acquire('a'))
+        collect(limiter.acquire('b'))
+        results = collect(limiter.acquire('c'))
+        results[0].trap(ForwardQueryShed)
+        self.assertEqual(1, limiter.shed_queue_full)
+        limiter.release('a')
+        self.assertEqual([None], collect(limiter.acquire('c')))
+
+    def test_per_client_limit(self):
+        limiter = ForwardLimiter({ 'max_in_flight_per_client': 1 },
+                                 clock=self.clock)
+        collect(limiter.acquire('a'))
+        collect(limiter.acquire('a')).pop().trap(ForwardQueryShed)
+        self.assertEqual([None], collect(limiter.acquire('b')))
+        self.assertEqual(1, limiter.shed_client)
+        limiter.release('a')
+        self.assertEqual([None], collect(limiter.acquire('a')))
+
+    def test_queue(self):
+        limiter = ForwardLimiter({ 'max_in_flight': 1, 'max_queued': 1,
+                                   'queue_timeout': 1 }, clock=self.clock)
+        collect(limiter.acquire('a'))
+        queued = collect(limiter.acquire('b'))
+        collect(limiter.acquire('c')).pop().trap(ForwardQueryShed)
+        self.assertEqual([], queued)
+        limiter.release('a')
+        self.assertEqual([None], queued)
+        self.assertEqual(1, limiter.in_flight)
+        self.assertEqual(0, limiter.queued)
+
+    def test_queue_timeout(self):
+        limiter = ForwardLimiter({ 'max_in_flight': 1, 'max_queued': 5,
+                                   'queue_timeout': 1 }, clock=self.clock)
+        collect(limiter.acquire('a'))
+        queued = collect(limiter.acquire('b'))
+        self.clock.advance(1)
+        queued.pop().trap(ForwardQueryShed)
+        self.assertEqual(1, limiter.shed_timeout)
+        self.assertEqual(0, limiter.clients['b'])
+        limiter.release('a')
+        self.assertEqual(0, limiter.in_flight)
+        self.assertEqual({}, dict(limiter.clients))
+
+
+class ForwardSheddingTester(unittest.TestCase):
+    def getHandler(self, settings):
+        config = { 'default_dns_policy': 'forward',
+                   'forward_limits': { 'max_in_flight': 1 } }
+        config.update(settings)
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        self.clock = task.Clock()
+        handler = DNSHandler(cp, clock=self.clock)
+        handler.resolver = ResolverStub()
+        return handler
+
+    def test_shed_query_fails(self):
+        handler = self.getHandler({})
+        first = collect(handler.query(Query('a.com'), address=('10.0.0.1', 53)))
+        second = collect(handler.query(Query('b.com'), address=('10.0.0.1', 53)))
+        second.pop().trap(ForwardQueryShed)
+        handler.resolver.pending.pop().callback(([], [], []))
+        self.assertEqual([([], [], [])], first)
+        self.assertEqual(0, handler.forward_limiter.in_flight)
+        self.assertEqual(0, handler.forwards_in_flight)
+
+    def test_shed_query_gets_stale_answer(self):
+        handler = self.getHandler({ 'forward_cache': { 'serve_stale': True } })
+        query = Query('a.com')
+        handler.query(query)
+        answer = dns.RRHeader(name='a.com', ttl=10,
+                              payload=dns.Record_A(address='1.2.3.4'))
+        handler.resolver.pending.pop().callback(([ answer ], [], []))
+        self.clock.advance(20)
+        handler.query(Query('b.com'))
+        results = collect(handler.query(query))
+        self.assertEqual('1.2.3.4', results[0][0][0].payload.dottedQuad())
+
+    def test_servfail(self):
+        factory = CustomDNSServerFactory()
+        message = dns.Message(id=7)
+        message.addQuery('a.com')
+        message.timeReceived = 0
+        sent = []
+
+        class ProtocolStub(object):
+            def writeMessage(self, message, address):
+                sent.append(message)
+        factory.gotResolverError(failure.Failure(ForwardQueryShed()),
+                                 ProtocolStub(), message, ('10.0.0.1', 53))
+        self.assertEqual(dns.ESERVER, sent[0].rCode)
+        self.assertEqual(0, len(self.flushLoggedErrors()))
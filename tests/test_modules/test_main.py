@@ -278,6 +278,17 @@ class MainTester(unittest.TestCase):
             self.assertEqual(answer.payload.dottedQuad(), '2.3.4.5')
         p.addCallback(callBack)
         return p
+
+    def test_heavy_hitters_snapshot_error(self):
+        self.serv.config['default_dns_policy'] = 'nxdomain'
+        self.serv.config['dns_server']['ip'] = '127.0.0.1'
+        self.serv.config['dns_server']['port'] = FAKE_DNS_PORT
+        self.serv.config['heavy_hitters'] = { 'size': 10 }
+        self.serv.setup()
+        filename = os.path.join(self.mktemp(), 'missing', 'heavy_hitters')
+        # a failing snapshot is logged instead of stopping the LoopingCall
+        self.serv.snapshotHeavyHitters(filename)
+        self.assertFalse(os.path.exists(filename))
       
 class DNSHandlerTester(unittest.TestCase):
     """
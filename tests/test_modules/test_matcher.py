@@ -0,0 +1,164 @@
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.main import DNSHandler
+from core.matcher import DomainMatcher, translateGlob
+
+
+class TranslateGlobTester(unittest.TestCase):
+    def test_translation(self):
+        self.assertEqual(r'ads.*\.example\.com', translateGlob('ads*.example.com'))
+        self.assertEqual(r'cdn\-..\.foo\.net', translateGlob('cdn-??.foo.net'))
+        self.assertEqual(r'host[0-9]\.com', translateGlob('host[0-9].com'))
+        self.assertEqual(r'host[^ab]\.com', translateGlob('host[!ab].com'))
+
+    def test_unterminated_class(self):
+        with self.assertRaises(RuntimeError):
+            translateGlob('host[0-9.com')
+
+
+class DomainMatcherTester(unittest.TestCase):
+    def _getMatcher(self, domains):
+        return DomainMatcher(dict((d, i) for i, d in enumerate(domains)))
+
+    def test_exact_match(self):
+        m = self._getMatcher(['foo.com', 'bar.com'])
+        self.assertEqual(1, m.match('bar.com'))
+        self.assertEqual(None, m.match('a.bar.com'))
+        self.assertEqual(None, m.match('bar.com.evil.net'))
+
+    def test_case_insensitive(self):
+        m = self._getMatcher(['Foo.com', '*.BAR.com'])
+        self.assertEqual(0, m.match('foo.COM'))
+        self.assertEqual(1, m.match('a.bar.com'))
+
+    def test_rich_patterns(self):
+        m = self._getMatcher(['ads*.example.com', 'cdn-??.foo.net',
+                              'host[0-9].lab', 'db[!0-9].lab'])
+        self.assertEqual(0, m.match('ads.example.com'))
+        self.assertEqual(0, m.match('ads-eu1.example.com'))
+        self.assertEqual(1, m.match('cdn-01.foo.net'))
+        self.assertEqual(None, m.match('cdn-1.foo.net'))
+        self.assertEqual(2, m.match('host7.lab'))
+        self.assertEqual(None, m.match('hostx.lab'))
+        self.assertEqual(3, m.match('dbx.lab'))
+        self.assertEqual(None, m.match('db1.lab'))
+
+    def test_first_rule_wins(self):
+        m = self._getMatcher(['*.foo.com', 'a.*', 'a.foo.com'])
+        self.assertEqual(0, m.match('a.foo.com'))
+        self.assertEqual(1, m.match('a.bar.com'))
+        m = self._getMatcher(['a.foo.com', '*.foo.com'])
+        self.assertEqual(0, m.match('a.foo.com'))
+        self.assertEqual(1, m.match('b.foo.com'))
+
+    def test_suffix_patterns(self):
+        m = self._getMatcher(['a.*', '*.foo.com', '*.b.foo.com', '*.com'])
+        self.assertEqual(0, m.match('a.foo.com'))
+        self.assertEqual(1, m.match('x.b.foo.com'))
+        self.assertEqual(3, m.match('foo.com'))
+        self.assertEqual(None, m.match('xcom'))
+        m = self._getMatcher(['*.b.foo.com', '*.foo.com'])
+        self.assertEqual(0, m.match('X.B.foo.com'))
+        self.assertEqual(1, m.match('x.c.foo.com'))
+        self.assertEqual(None, m.match('foo.com'))
+        self.assertEqual(None, m.match('xfoo.com'))
+
+    def test_many_suffix_patterns(self):
+        m = self._getMatcher(['*.zone{}.example'.format(i) for i in range(5000)])
+        self.assertEqual(4999, m.match('a.zone4999.example'))
+        self.assertEqual(None, m.match('a.zone5000.example'))
+        self.assertEqual(0, len(m.patterns))
+
+    def test_trailing_dot(self):
+        m = self._getMatcher(['foo.com.'])
+        self.assertEqual(0, m.match('foo.com'))
+
+
+class DomainPolicyTester(unittest.TestCase):
+    def test_domain_policies_are_applied(self):
+        config = { 'default_dns_policy': 'default_value',
+                   'default_dns_value': '1.2.3.4',
+                   'domain_config': {
+                       'a.com': 'nxdomain',
+                       'b.com': 'forward',
+                       'c.com': '127.0.0.1',
+                    }
+                 }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        handler = DNSHandler(cp)
+        self.assertEqual('nxdomain', handler.get_action_for_query(Query('a.com')))
+        self.assertEqual('forward', handler.get_action_for_query(Query('b.com')))
+        self.assertEqual('custom_value', handler.get_action_for_query(Query('c.com')))
+        self.assertEqual('default_value', handler.get_action_for_query(Query('d.com')))
+
+
+class IncrementalUpdateTester(unittest.TestCase):
+    def test_add_exact_and_pattern(self):
+        domain_config = {'*.foo.com': 0}
+        m = DomainMatcher(domain_config)
+        m.add('a.bar.com', 1)
+        m.add('*.bar.com', 2)
+        self.assertEqual(1, m.match('a.bar.com'))
+        self.assertEqual(2, m.match('b.bar.com'))
+        self.assertEqual(['*.foo.com', 'a.bar.com', '*.bar.com'],
+                         list(domain_config))
+
+    def test_new_rules_have_lowest_priority(self):
+        m = DomainMatcher({'*.foo.com': 0})
+        m.add('a.foo.com', 1)
+        self.assertEqual(0, m.match('a.foo.com'))
+
+    def test_replace_keeps_priority(self):
+        m = DomainMatcher({'a.foo.com': 0, '*.foo.com': 1})
+        m.add('a.foo.com', 2)
+        self.assertEqual(2, m.match('a.foo.com'))
+        self.assertEqual(2, m.domain_config['a.foo.com'])
+
+    def test_remove(self):
+        domain_config = {'*.foo.com': 0, 'a.*': 1, 'b.foo.com': 2}
+        m = DomainMatcher(domain_config)
+        m.remove('*.foo.com')
+        self.assertEqual(1, m.match('a.foo.com'))
+        self.assertEqual(2, m.match('b.foo.com'))
+        self.assertEqual(None, m.match('c.foo.com'))
+        m.remove('b.foo.com')
+        self.assertEqual(None, m.match('b.foo.com'))
+        self.assertEqual(['a.*'], list(domain_config))
+        with self.assertRaises(KeyError):
+            m.remove('b.foo.com')
+
+    def test_remove_suffix_pattern(self):
+        m = DomainMatcher({'*.foo.com': 0, '*.b.foo.com': 1})
+        m.remove('*.foo.com')
+        self.assertEqual(None, m.match('a.foo.com'))
+        self.assertEqual(1, m.match('a.b.foo.com'))
+        m.add('*.foo.com', 2)
+        self.assertEqual(1, m.match('a.b.foo.com'))
+        self.assertEqual(2, m.match('a.foo.com'))
+
+    def test_remove_added_pattern(self):
+        m = DomainMatcher({})
+        m.add('*.foo.com', 0)
+        m.remove('*.foo.com')
+        self.assertEqual(None, m.match('a.foo.com'))
+        self.assertEqual(0, len(m))
+
+    def test_invalid_pattern_leaves_no_rule(self):
+        domain_config = {'a.foo.com': 0}
+        m = DomainMatcher(domain_config)
+        self.assertRaises(RuntimeError, m.add, 'bad[.com', 1)
+        self.assertRaises(RuntimeError, m.add, '[z-a].com', 1)
+        self.assertEqual(1, len(m))
+        self.assertEqual(['a.foo.com'], list(domain_config))
+        with self.assertRaises(KeyError):
+            m.remove('bad[.com')
+        self.assertEqual(0, m.match('a.foo.com'))
+        self.assertRaises(RuntimeError, DomainMatcher, {'[z-a].com': 1})
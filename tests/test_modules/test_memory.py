@@ -0,0 +1,111 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+import gc
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.admin import AdminController
+from core.config import ConfigParser, DNSAnswerConfig
+from core.main import DNSHandler
+from core.memory import MemoryMonitor, formatBytes, measure
+
+
+class MeasureTester(unittest.TestCase):
+    def test_shared_objects_count_once(self):
+        answer = DNSAnswerConfig(['10.0.0.1'])
+        seen = set()
+        size, count = measure([answer], seen)
+        self.assertTrue(size > sys.getsizeof(answer.value_dict))
+        self.assertEqual((0, 0), measure([answer.value_dict['A']], seen))
+        # a second answer only brings its own objects
+        other = DNSAnswerConfig(['10.0.0.1'])
+        self.assertEqual(count, measure([other], set())[1])
+        self.assertTrue(measure([other], seen)[1] < count)
+
+    def test_other_objects_are_not_followed(self):
+        self.assertEqual((0, 0), measure([task.Clock()], set()))
+        size, count = measure([{ 'clock': task.Clock() }], set())
+        self.assertEqual(2, count)
+
+    def test_cycles(self):
+        a = { 'b': None }
+        b = { 'a': a }
+        a['b'] = b
+        self.assertEqual(4, measure([a], set())[1])
+
+    def test_format(self):
+        self.assertEqual('512.0 B', formatBytes(512))
+        self.assertEqual('1.5 MiB', formatBytes(1.5 * 1024 * 1024))
+        self.assertEqual('2.0 GiB', formatBytes(2 * 1024 ** 3))
+
+
+class MemoryMonitorTester(unittest.TestCase):
+    def setUp(self):
+        config = { 'default_dns_policy': 'default_value',
+                   'default_dns_value': '1.2.3.4',
+                   'forward_cache': {},
+                   'domain_config': dict(('host{}.example.com'.format(i),
+                                          '10.0.{}.{}'.format(i // 256, i % 256))
+                                         for i in range(1000)) }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        self.handler = DNSHandler(cp)
+        self.clock = task.Clock()
+        self.monitor = MemoryMonitor(self.handler, {}, clock=self.clock)
+
+    def test_report(self):
+        report = dict((name, (size, count))
+                      for name, size, count in self.monitor.getReport())
+        self.assertEqual(['answers', 'forward_cache', 'heavy_hitters', 'rules',
+                          'zones'], sorted(report))
+        self.assertTrue(report['answers'][1] > 1000 * 4)
+        self.assertTrue(report['rules'][1] > 1000)
+        self.assertEqual((0, 0), report['zones'])
+        self.assertEqual((0, 0), report['heavy_hitters'])
+        messages = self.monitor.getReportMessages()
+        self.assertTrue(messages[0].startswith('Memory of answers: '))
+
+    def test_freeze(self):
+        self.addCleanup(gc.unfreeze)
+        self.assertTrue(self.monitor.freeze() > 0)
+        self.assertEqual(gc.get_freeze_count(), dict(self.monitor.getStats())
+                                                    ['gc_frozen_objects'])
+        gc.unfreeze()
+        monitor = MemoryMonitor(self.handler, { 'freeze': False })
+        self.assertEqual(0, monitor.freeze())
+        self.assertEqual(0, gc.get_freeze_count())
+
+    def test_gauges(self):
+        self.assertNotIn('memory_peak_rss_bytes', dict(self.monitor.getStats()))
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+        stats = dict(self.monitor.getStats())
+        self.assertTrue(stats['memory_peak_rss_bytes'] > 0)
+        self.assertIn('gc_gen2_collections', stats)
+        if sys.platform.startswith('linux'):
+            self.assertTrue(stats['memory_rss_bytes'] > 0)
+
+    def test_admin(self):
+        self.addCleanup(gc.unfreeze)
+        admin = AdminController(self.handler, memory_monitor=self.monitor)
+        self.assertTrue(admin.execute('memory')[1].startswith('Memory of rules: '))
+        self.assertIn('gc_frozen_objects 0', admin.execute('stats'))
+        admin.execute('add new.example.com 1.2.3.4')
+        # admin commands do not collect and freeze again
+        self.assertEqual(0, gc.get_freeze_count())
+        admin = AdminController(self.handler)
+        self.assertRaises(RuntimeError, admin.execute, 'memory')
+
+    def test_validate_config(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                 'listening_info': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(dict(base, memory={ 'report': False, 'freeze': True,
+                                              'gauge_interval': 5 }))
+        cp.validate_config()
+        for memory in [[], { 'report': 'yes' }, { 'freeze': 1 },
+                       { 'gauge_interval': 0 }]:
+            cp = ConfigParser(dict(base, memory=memory))
+            self.assertRaises(RuntimeError, cp.validate_config)
@@ -0,0 +1,131 @@
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.logger import Logger, formatEvent
+from twisted.names import dns, error
+from twisted.python.failure import Failure
+
+from core.limits import ForwardQueryShed
+from core.main import CustomDNSServerFactory
+from core.querylog import SQLiteQueryLogObserver
+
+
+def queryEvent(log_time, client, qname, rcode='NOERROR'):
+    return { 'log_time': log_time,
+             'dns_query': { 'client': client, 'port': 5353, 'qname': qname,
+                            'qtype': 'A', 'rcode': rcode, 'answers': '' } }
+
+
+class SQLiteQueryLogTester(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'queries.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def select(self, sql):
+        db = sqlite3.connect(self.filename)
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def test_events_are_written(self):
+        observer = SQLiteQueryLogObserver(self.filename, batch_size=2)
+        observer.start()
+        observer(queryEvent(100, '10.0.0.1', 'a.com'))
+        observer(queryEvent(101, '10.0.0.2', 'a.com', 'NXDOMAIN'))
+        observer(queryEvent(102, '10.0.0.1', 'b.com'))
+        observer({ 'log_format': 'text only' })
+        observer.stop()
+        self.assertEqual(3, observer.written)
+        self.assertEqual([('10.0.0.1', ), ('10.0.0.2', )],
+                         self.select("SELECT DISTINCT client FROM queries "
+                                     "WHERE qname = 'a.com' ORDER BY client"))
+        self.assertEqual([(1, )],
+                         self.select("SELECT COUNT(*) FROM queries "
+                                     "WHERE rcode = 'NXDOMAIN'"))
+
+    def test_prune(self):
+        now = time.time()
+        observer = SQLiteQueryLogObserver(self.filename, retention=50)
+        observer.start()
+        observer(queryEvent(now - 100, '10.0.0.1', 'a.com'))
+        observer(queryEvent(now - 10, '10.0.0.1', 'b.com'))
+        observer.stop()
+        db = observer.connect()
+        observer.prune(db, now=now)
+        db.close()
+        self.assertEqual([('b.com', )], self.select("SELECT qname FROM queries"))
+
+    def test_write_error_is_logged(self):
+        events = []
+        observer = SQLiteQueryLogObserver(self.filename)
+        observer.logger = Logger(observer=events.append)
+        db = observer.connect()
+        db.execute("CREATE TRIGGER fail BEFORE INSERT ON queries "
+                   "BEGIN SELECT RAISE(ABORT, '{disk full}'); END")
+        db.close()
+        observer.start()
+        observer(queryEvent(100, '10.0.0.1', 'a.com'))
+        observer.stop()
+        self.assertEqual(1, observer.dropped)
+        self.assertEqual("Could not write query log to {}: "
+                         "{{disk full}}".format(self.filename),
+                         formatEvent(events[0]))
+
+    def test_full_queue_drops(self):
+        observer = SQLiteQueryLogObserver(self.filename, max_queue=1)
+        observer(queryEvent(100, '10.0.0.1', 'a.com'))
+        observer(queryEvent(101, '10.0.0.1', 'a.com'))
+        self.assertEqual(1, observer.dropped)
+
+
+class QueryEventTester(unittest.TestCase):
+    def test_factory_emits_events(self):
+        events = []
+        factory = CustomDNSServerFactory()
+        factory.logger = Logger(observer=events.append)
+        answer = dns.RRHeader(name='foobar.com',
+                              payload=dns.Record_A(address='1.2.3.4'))
+        query = dns.Query('foobar.com')
+        factory.logResponse(([ answer ], [], []), query, ('10.0.0.1', 5353))
+        self.assertEqual([], [e for e in events if 'dns_query' in e])
+        factory.log_query_events = True
+        factory.logResponse(([], [], []), query, ('10.0.0.1', 5353))
+        factory.logResponse(([ answer ], [], []), query, ('10.0.0.1', 5353))
+        records = [e['dns_query'] for e in events if 'dns_query' in e]
+        self.assertEqual('NXDOMAIN', records[0]['rcode'])
+        self.assertEqual({ 'client': '10.0.0.1', 'port': 5353,
+                           'qname': 'foobar.com', 'qtype': 'A',
+                           'rcode': 'NOERROR',
+                           'answers': 'A - foobar.com - 1.2.3.4' }, records[1])
+
+    def test_failed_lookups_are_logged(self):
+        events = []
+        factory = CustomDNSServerFactory()
+        factory.logger = Logger(observer=events.append)
+        factory.log_query_events = True
+        sent = []
+        factory.sendReply = lambda protocol, response, address: \
+                            sent.append(response.rCode)
+        message = dns.Message()
+        message.addQuery('foobar.com', dns.A)
+        factory.gotResolverError(Failure(ForwardQueryShed()), None, message,
+                                 ('10.0.0.1', 5353))
+        factory.gotResolverError(Failure(error.DNSServerError()), None,
+                                 message, ('10.0.0.1', 5353))
+        factory.gotResolverError(Failure(dns.DomainError()), None, message,
+                                 ('10.0.0.1', 5353))
+        records = [e['dns_query'] for e in events if 'dns_query' in e]
+        self.assertEqual(['SERVFAIL', 'SERVFAIL', 'NXDOMAIN'],
+                         [r['rcode'] for r in records])
+        self.assertEqual([dns.ESERVER, dns.ESERVER, dns.ENAME], sent)
+        self.assertIn('Answer: SERVFAIL', formatEvent(events[0]))
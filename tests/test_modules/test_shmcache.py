@@ -0,0 +1,131 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.names import dns
+
+import multiprocessing
+import tempfile
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.main import DNSHandler
+from core.shmcache import SharedForwardCache
+from tests.test_modules.helpers import generateResponse
+
+
+def storeInChild(filename, name):
+    cache = SharedForwardCache(filename, slots=64)
+    cache.store(Query(name), generateResponse(name, '10.0.0.1', 300))
+    cache.close()
+
+
+class SharedForwardCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'cache')
+        self.caches = []
+        self.query = Query('foobar.com')
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.tmpdir.cleanup()
+
+    def getCache(self, **kwargs):
+        kwargs.setdefault('slots', 64)
+        cache = SharedForwardCache(self.filename, clock=self.clock, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def test_hit_from_other_mapping(self):
+        writer = self.getCache()
+        reader = self.getCache()
+        writer.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(10)
+        response, is_stale = reader.lookup(Query('FOOBAR.com'))
+        self.assertEqual(False, is_stale)
+        self.assertEqual(50, response[0][0].ttl)
+        self.assertEqual('1.2.3.4', response[0][0].payload.dottedQuad())
+        self.assertEqual(1, len(reader))
+
+    def test_hit_from_other_process(self):
+        ctx = multiprocessing.get_context('fork')
+        self.getCache()
+        p = ctx.Process(target=storeInChild, args=(self.filename, 'child.com'))
+        p.start()
+        p.join()
+        self.assertEqual(0, p.exitcode)
+        cache = SharedForwardCache(self.filename, slots=64)
+        self.caches.append(cache)
+        self.assertNotEqual(None, cache.lookup(Query('child.com')))
+
+    def test_large_response(self):
+        cache = self.getCache(slot_size=2048)
+        answers = [dns.RRHeader(name='foobar.com', ttl=60,
+                                payload=dns.Record_A(address='10.0.0.{}'.format(i)))
+                   for i in range(50)]
+        cache.store(self.query, (answers, [], []))
+        response, _ = cache.lookup(self.query)
+        # the 50 records do not fit into 512 bytes and must not be truncated
+        self.assertEqual([r.payload.dottedQuad() for r in answers],
+                         [r.payload.dottedQuad() for r in response[0]])
+
+    def test_expiry_and_stale(self):
+        cache = self.getCache(max_stale_age=100)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        self.clock.advance(100)
+        _, is_stale = cache.lookup(self.query)
+        self.assertEqual(True, is_stale)
+        self.clock.advance(100)
+        self.assertEqual(None, cache.lookup(self.query))
+        self.assertEqual(0, len(cache))
+
+    def test_replace_and_eviction(self):
+        cache = self.getCache(slots=4)
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        cache.store(self.query, generateResponse('foobar.com', '5.6.7.8', 60))
+        self.assertEqual(1, len(cache))
+        response, _ = cache.lookup(self.query)
+        self.assertEqual('5.6.7.8', response[0][0].payload.dottedQuad())
+        # the entry that expires first is replaced
+        for i in range(4):
+            name = '{}.com'.format(i)
+            cache.store(Query(name), generateResponse(name, '1.2.3.4', 100 + i))
+        self.assertEqual(4, len(cache))
+        self.assertEqual(None, cache.lookup(self.query))
+
+    def test_too_large_and_empty(self):
+        cache = self.getCache(slot_size=128)
+        answers = [ dns.RRHeader(name='foobar.com', ttl=60,
+                                 payload=dns.Record_A(address='1.2.3.{}'.format(i)))
+                    for i in range(10) ]
+        cache.store(self.query, (answers, [], []))
+        cache.store(Query('empty.com'), ([], [], []))
+        self.assertEqual(0, len(cache))
+
+    def test_flush(self):
+        cache = self.getCache()
+        cache.store(self.query, generateResponse('foobar.com', '1.2.3.4', 60))
+        cache.flush()
+        self.assertEqual(None, cache.lookup(self.query))
+
+    def test_geometry_mismatch(self):
+        self.getCache()
+        self.assertRaises(RuntimeError, self.getCache, slots=128)
+
+    def test_handler_uses_shared_cache(self):
+        config = { 'default_dns_policy': 'forward',
+                   'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                   'forward_cache': { 'shared_file': self.filename,
+                                      'max_entries': 64 },
+                 }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        handler = DNSHandler(cp, clock=self.clock)
+        self.caches.append(handler.forward_cache)
+        self.assertIsInstance(handler.forward_cache, SharedForwardCache)
@@ -0,0 +1,66 @@
+import json
+import random
+import tempfile
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.stats import HeavyHitters, SpaceSaving
+
+
+class SpaceSavingTester(unittest.TestCase):
+    def test_exact_counts_below_size(self):
+        s = SpaceSaving(10)
+        for item in ['a', 'b', 'a', 'c', 'a', 'b']:
+            s.add(item)
+        self.assertEqual([('a', 3, 0), ('b', 2, 0), ('c', 1, 0)], s.top())
+        self.assertEqual(6, s.total)
+
+    def test_eviction_of_minimum(self):
+        s = SpaceSaving(2)
+        for item in ['a', 'a', 'b', 'c']:
+            s.add(item)
+        self.assertEqual(2, len(s))
+        self.assertEqual([('a', 2, 0), ('c', 2, 1)], s.top())
+
+    def test_heavy_hitters_survive(self):
+        rand = random.Random(42)
+        s = SpaceSaving(20)
+        for i in range(10000):
+            if i % 4 == 0:
+                s.add('heavy')
+            elif i % 10 == 1:
+                s.add('medium')
+            else:
+                s.add('noise{}'.format(rand.randint(0, 5000)))
+        top = s.top(2)
+        self.assertEqual(['heavy', 'medium'], [item for item, _, _ in top])
+        count, error = top[0][1], top[0][2]
+        self.assertTrue(count - error <= 2500 <= count)
+        self.assertEqual(20, len(s))
+
+    def test_top_k(self):
+        s = SpaceSaving(10)
+        for item in ['a', 'b', 'b']:
+            s.add(item)
+        self.assertEqual([('b', 2, 0)], s.top(1))
+
+
+class HeavyHittersTester(unittest.TestCase):
+    def test_report_and_snapshot(self):
+        h = HeavyHitters(10)
+        h.record('foobar.com', ('10.0.0.1', 5353), 'forward')
+        h.record('foobar.com', ('10.0.0.2', 5353), 'forward')
+        report = h.report()
+        self.assertEqual({'key': 'foobar.com', 'count': 2, 'error': 0},
+                         report['qnames'][0])
+        self.assertEqual(2, len(report['clients']))
+        self.assertEqual('foobar.com forward', report['qname_policies'][0]['key'])
+
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'top.json')
+            h.snapshot(filename)
+            with open(filename) as f:
+                self.assertEqual(report, json.load(f))
@@ -0,0 +1,113 @@
+import collections
+import unittest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names import dns
+from twisted.names.dns import Query
+
+from core.config import ConfigParser, DNSAnswerConfig
+from core.main import DNSHandler
+from core.strategies import AnswerStrategy
+
+
+POOL = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+
+class AnswerStrategyTester(unittest.TestCase):
+    def test_round_robin(self):
+        strategy = AnswerStrategy({ 'strategy': 'round_robin' }, { 'A': POOL })
+        self.assertEqual([POOL, POOL[1:] + POOL[:1], POOL[2:] + POOL[:2], POOL],
+                         [strategy.select('A', POOL) for i in range(4)])
+        strategy = AnswerStrategy({ 'strategy': 'round_robin', 'count': 1 },
+                                  { 'A': POOL })
+        self.assertEqual([['10.0.0.1'], ['10.0.0.2']],
+                         [strategy.select('A', POOL) for i in range(2)])
+        # query types without values are left alone
+        self.assertEqual([], strategy.select('AAAA', []))
+
+    def test_weighted(self):
+        numbers = iter(i / 8 for i in range(8))
+        strategy = AnswerStrategy({ 'strategy': 'weighted', 'count': 2,
+                                    'weights': { '10.0.0.1': 6, '10.0.0.3': 2 } },
+                                  { 'A': POOL }, random=lambda: next(numbers))
+        picked = collections.Counter(tuple(strategy.select('A', POOL))
+                                     for i in range(8))
+        self.assertEqual({ ('10.0.0.1', '10.0.0.2'): 6,
+                           ('10.0.0.2', '10.0.0.3'): 1,
+                           ('10.0.0.3', '10.0.0.1'): 1 }, picked)
+
+    def test_large_weights(self):
+        strategy = AnswerStrategy({ 'strategy': 'weighted',
+                                    'weights': { '10.0.0.1': 10 ** 9,
+                                                 '10.0.0.2': 3 } },
+                                  { 'A': POOL }, random=lambda: 0.9999999985)
+        # the weights are not expanded into a table
+        self.assertEqual(3, len(strategy.cumulative['A']))
+        self.assertEqual(['10.0.0.2'], strategy.select('A', POOL))
+
+    def test_consistent(self):
+        strategy = AnswerStrategy({ 'strategy': 'consistent' }, { 'A': POOL })
+        picked = set()
+        for i in range(100):
+            address = ('192.0.2.{}'.format(i), 1000 + i)
+            answer = strategy.select('A', POOL, address)
+            self.assertEqual(1, len(answer))
+            self.assertEqual(answer, strategy.select('A', POOL,
+                                                     (address[0], 53)))
+            picked.update(answer)
+        self.assertEqual(set(POOL), picked)
+
+    def test_invalid_settings(self):
+        for settings in [{ 'strategy': 'random' },
+                         { 'strategy': 'round_robin', 'count': 0 },
+                         { 'strategy': 'round_robin', 'weights': { '10.0.0.1': 2 } },
+                         { 'strategy': 'weighted', 'weights': ['10.0.0.1'] },
+                         { 'strategy': 'weighted', 'weights': { '10.0.0.9': 2 } },
+                         { 'strategy': 'weighted', 'weights': { '10.0.0.1': 0 } },
+                         { 'weights': { '10.0.0.1': 2 } }]:
+            self.assertRaises(RuntimeError, DNSAnswerConfig,
+                              dict(settings, A=POOL))
+
+
+class StrategyRuleTester(unittest.TestCase):
+    def setUp(self):
+        cp = ConfigParser({
+                'default_dns_policy': 'default_value',
+                'default_dns_value': { 'A': POOL, 'strategy': 'round_robin',
+                                       'count': 1 },
+                'domain_config': {
+                    'pool.example': { 'A': POOL, 'AAAA': ['::1', '::2'],
+                                      'strategy': 'consistent' },
+                    'all.example': POOL,
+                } })
+        cp.generate_config_objects()
+        self.config = cp
+        self.handler = DNSHandler(cp)
+
+    def getAddresses(self, name, qtype=dns.A, client='127.0.0.1'):
+        answers, _, _ = self.handler.generateReply(
+                            self.handler.get_action_for_query(Query(name, qtype)),
+                            Query(name, qtype), (client, 5353))
+        if qtype != dns.A:
+            return answers
+        return [answer.payload.dottedQuad() for answer in answers]
+
+    def test_answers(self):
+        self.assertEqual(POOL, self.getAddresses('all.example'))
+        self.assertEqual(['10.0.0.1'], self.getAddresses('foobar.com'))
+        self.assertEqual(['10.0.0.2'], self.getAddresses('foobar.com'))
+        first = self.getAddresses('pool.example', client='192.0.2.7')
+        self.assertEqual(1, len(first))
+        self.assertEqual(first, self.getAddresses('pool.example',
+                                                  client='192.0.2.7'))
+        self.assertEqual(1, len(self.getAddresses('pool.example', dns.AAAA)))
+
+    def test_plain_config_round_trip(self):
+        plain = self.config.getPlainConfig()
+        self.assertEqual({ 'A': POOL, 'AAAA': ['::1', '::2'],
+                           'strategy': 'consistent' },
+                         plain['domain_config']['pool.example'])
+        self.assertEqual('round_robin', plain['default_dns_value']['strategy'])
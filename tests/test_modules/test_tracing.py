@@ -0,0 +1,242 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.names import dns
+
+import json
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.config import ConfigParser
+from core.fastpath import FastPathResponder
+from core.main import CustomDNSServerFactory, DNSHandler
+from core.tracing import QueryTracer
+from tests.test_modules.helpers import buildQuery
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        # every stage takes one millisecond
+        self.now += 0.001
+        return self.now
+
+
+class ProtocolStub(object):
+    def __init__(self):
+        self.sent = []
+
+    def writeMessage(self, message, address):
+        self.sent.append(message)
+
+
+class ResolverStub(object):
+    def __init__(self):
+        self.pending = []
+
+    def query(self, query, timeout=None):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class QueryTracerTester(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+
+    def getTracer(self, **kwargs):
+        kwargs.setdefault('timer', FakeTimer())
+        tracer = QueryTracer(self.filename, **kwargs)
+        return tracer
+
+    def readEvents(self):
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def test_sampling(self):
+        values = iter([0.5, 0.005, 0.01])
+        tracer = self.getTracer(sample_rate=0.01, random=lambda: next(values))
+        self.assertEqual(None, tracer.startTrace())
+        self.assertNotEqual(None, tracer.startTrace())
+        self.assertEqual(None, tracer.startTrace())
+        tracer.close()
+
+    def test_max_traces(self):
+        tracer = self.getTracer(sample_rate=1, max_traces=2)
+        self.assertNotEqual(None, tracer.startTrace())
+        self.assertNotEqual(None, tracer.startTrace())
+        self.assertEqual(None, tracer.startTrace())
+        tracer.close()
+
+    def test_events(self):
+        tracer = self.getTracer(sample_rate=1)
+        trace = tracer.startTrace(('10.0.0.1', 5353))
+        trace.args['qname'] = 'foobar.com'
+        trace.mark('policy')
+        trace.mark('answer')
+        tracer.finishTrace(trace)
+        tracer.close()
+        events = self.readEvents()
+        self.assertEqual(['foobar.com', 'policy', 'answer'],
+                         [e['name'] for e in events])
+        self.assertEqual({ 'client': '10.0.0.1:5353', 'qname': 'foobar.com' },
+                         events[0]['args'])
+        self.assertEqual([2000, 1000, 1000], [e['dur'] for e in events])
+        self.assertEqual([1000, 1000, 2000], [e['ts'] for e in events])
+        self.assertEqual({ 'X' }, set(e['ph'] for e in events))
+        self.assertEqual({ 1 }, set(e['tid'] for e in events))
+
+    def test_file_is_readable_before_close(self):
+        tracer = self.getTracer(sample_rate=1)
+        for _ in range(2):
+            tracer.finishTrace(tracer.startTrace())
+        tracer.flush()
+        with open(self.filename) as f:
+            data = f.read()
+        # the closing bracket is optional in the trace event format
+        self.assertEqual(2, len(json.loads(data + ']')))
+        tracer.close()
+        self.assertEqual(2, len(self.readEvents()))
+
+
+class QueryTracingTester(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+        self.tracer = QueryTracer(self.filename, sample_rate=1,
+                                  timer=FakeTimer())
+
+    def getFactory(self, config):
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        handler = DNSHandler(cp)
+        factory = CustomDNSServerFactory(clients=[handler])
+        factory.tracer = self.tracer
+        return handler, factory
+
+    def getStages(self):
+        self.tracer.close()
+        with open(self.filename) as f:
+            events = json.load(f)
+        return events[0]['args'], [e['name'] for e in events[1:]]
+
+    def test_generated_answer(self):
+        _, factory = self.getFactory({ 'default_dns_policy': 'nxdomain' })
+        protocol = ProtocolStub()
+        factory.messageReceived(buildQuery(b'foobar.com'), protocol,
+                                ('10.0.0.1', 5353))
+        self.assertEqual(1, len(protocol.sent))
+        args, stages = self.getStages()
+        self.assertEqual(['policy', 'answer', 'logged', 'reply_sent'], stages)
+        self.assertEqual({ 'client': '10.0.0.1:5353', 'qname': 'foobar.com',
+                           'qtype': 'A', 'action': 'nxdomain',
+                           'rcode': 'NXDOMAIN' }, args)
+
+    def test_forwarded_query(self):
+        handler, factory = self.getFactory({
+                'default_dns_policy': 'forward',
+                'dns_server': { 'ip': '127.0.0.1', 'port': 53 } })
+        handler.resolver = ResolverStub()
+        protocol = ProtocolStub()
+        factory.messageReceived(buildQuery(b'foobar.com'), protocol,
+                                ('10.0.0.1', 5353))
+        answer = dns.RRHeader(b'foobar.com', payload=dns.Record_A('1.2.3.4'))
+        handler.resolver.pending[0].callback(([answer], [], []))
+        self.assertEqual(1, len(protocol.sent))
+        args, stages = self.getStages()
+        self.assertEqual(['policy', 'upstream_sent', 'upstream_received',
+                          'logged', 'reply_sent'], stages)
+        self.assertEqual('NOERROR', args['rcode'])
+
+    def test_failed_query(self):
+        handler, factory = self.getFactory({
+                'default_dns_policy': 'forward',
+                'dns_server': { 'ip': '127.0.0.1', 'port': 53 } })
+        handler.resolver = ResolverStub()
+        factory.messageReceived(buildQuery(b'foobar.com'), ProtocolStub(),
+                                ('10.0.0.1', 5353))
+        handler.resolver.pending[0].errback(RuntimeError('upstream broke'))
+        self.flushLoggedErrors(RuntimeError)
+        args, stages = self.getStages()
+        self.assertEqual(['policy', 'upstream_sent', 'upstream_received',
+                          'reply_sent'], stages)
+        self.assertEqual('RuntimeError', args['error'])
+
+    def test_only_queries_are_traced(self):
+        _, factory = self.getFactory({ 'default_dns_policy': 'nxdomain' })
+        protocol = ProtocolStub()
+        status = buildQuery(b'foobar.com')
+        status.opCode = dns.OP_STATUS
+        factory.messageReceived(status, protocol, ('10.0.0.1', 5353))
+        # no question, refused
+        factory.messageReceived(dns.Message(id=4321), protocol,
+                                ('10.0.0.1', 5353))
+        self.assertEqual(2, len(protocol.sent))
+        self.assertEqual(0, self.tracer.started)
+
+    def test_fast_path(self):
+        handler, factory = self.getFactory({
+                'default_dns_policy': 'default_value',
+                'default_dns_value': '1.2.3.4' })
+        responder = FastPathResponder(handler, factory)
+        sent = []
+        def write(data, address):
+            sent.append(self.tracer.timer.now)
+        responder.handleDatagram(buildQuery(b'foobar.com').toStr(),
+                                 ('10.0.0.1', 5353), write)
+        args, stages = self.getStages()
+        self.assertEqual(['policy', 'answer', 'logged', 'reply_sent'], stages)
+        self.assertTrue(args['fast_path'])
+        self.assertEqual('default_value', args['action'])
+        with open(self.filename) as f:
+            events = json.load(f)
+        # reply_sent ends after the reply was written
+        reply_sent = events[-1]
+        end = self.tracer.epoch + (reply_sent['ts'] + reply_sent['dur']) / 1e6
+        self.assertTrue(sent[0] < end)
+
+    def test_fast_path_forwarded_query(self):
+        handler, factory = self.getFactory({
+                'default_dns_policy': 'forward',
+                'dns_server': { 'ip': '127.0.0.1', 'port': 53 } })
+        responder = FastPathResponder(handler, factory)
+        self.assertEqual(None, responder.handleDatagram(
+                                   buildQuery(b'foobar.com').toStr(),
+                                   ('10.0.0.1', 5353)))
+        # the normal path samples the query
+        self.assertEqual(0, self.tracer.started)
+
+    def test_fast_path_error(self):
+        handler, factory = self.getFactory({ 'default_dns_policy': 'nxdomain' })
+        responder = FastPathResponder(handler, factory)
+        def generateReply(action, query, address=None):
+            raise RuntimeError('broken')
+        handler.generateReply = generateReply
+        self.assertEqual(None, responder.handleDatagram(
+                                   buildQuery(b'foobar.com').toStr(),
+                                   ('10.0.0.1', 5353)))
+        # the normal path samples the query
+        self.assertEqual(0, self.tracer.started)
+
+
+class TracingConfigTester(unittest.TestCase):
+    def test_validate_config(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                 'listening_info': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(dict(base, tracing={ 'file': '/tmp/trace.json',
+                                               'sample_rate': 0.1 }))
+        cp.validate_config()
+        for settings in [{}, { 'file': 1 },
+                         { 'file': '/tmp/trace.json', 'sample_rate': 0 },
+                         { 'file': '/tmp/trace.json', 'sample_rate': 2 },
+                         { 'file': '/tmp/trace.json', 'max_traces': 0 },
+                         { 'file': '/tmp/trace.json', 'flush_interval': 'x' }]:
+            cp = ConfigParser(dict(base, tracing=settings))
+            self.assertRaises(RuntimeError, cp.validate_config)
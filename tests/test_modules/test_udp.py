@@ -0,0 +1,116 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+import sys
+import os
+import socket
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.admin import AdminController
+from core.config import ConfigParser
+from core.main import DNSHandler
+from core.udp import UDPSocketMonitor, readProcDrops, readSocketDrops, tuneSocket
+
+
+def flood(sock, count=500):
+    """
+    Sends more datagrams to sock than its receive buffer holds.
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for i in range(count):
+            client.sendto(b'x' * 1000, sock.getsockname())
+    finally:
+        client.close()
+
+
+class UDPSocketTester(unittest.TestCase):
+    def setUp(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.addCleanup(self.socket.close)
+
+    def test_tune_socket(self):
+        receive_buffer, send_buffer = tuneSocket(self.socket, {})
+        self.assertTrue(receive_buffer > 0 and send_buffer > 0)
+        # Linux doubles the requested sizes for its own bookkeeping
+        receive_buffer, send_buffer = tuneSocket(self.socket,
+                                                 { 'receive_buffer': 4096,
+                                                   'send_buffer': 8192 })
+        self.assertIn(receive_buffer, [4096, 8192])
+        self.assertIn(send_buffer, [8192, 16384])
+
+    def test_drops_are_read(self):
+        if readSocketDrops(self.socket) is None:
+            raise unittest.SkipTest("the platform does not report drops")
+        self.assertEqual((0, 0), readSocketDrops(self.socket))
+        tuneSocket(self.socket, { 'receive_buffer': 4096 })
+        flood(self.socket)
+        queued, drops = readSocketDrops(self.socket)
+        self.assertTrue(queued > 0)
+        self.assertTrue(drops > 0)
+        proc = readProcDrops(self.socket)
+        if proc is not None:
+            self.assertEqual(drops, proc[1])
+
+
+class UDPSocketMonitorTester(unittest.TestCase):
+    def setUp(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.socket.close)
+        self.results = [(0, 7)]
+        self.clock = task.Clock()
+        self.monitor = UDPSocketMonitor(self.socket, interval=10,
+                                        clock=self.clock, read=self.read)
+
+    def read(self, sock):
+        return self.results[-1]
+
+    def test_counts_new_drops(self):
+        self.assertTrue(self.monitor.start())
+        self.assertEqual(0, self.monitor.drops)
+        self.results.append((2048, 10))
+        self.clock.advance(10)
+        self.assertEqual(3, self.monitor.drops)
+        self.assertEqual(2048, self.monitor.queued)
+        # the kernel counter wraps around
+        self.results.append((0, 1))
+        self.clock.advance(10)
+        self.assertEqual(2 ** 32 - 10 + 1 + 3, self.monitor.drops)
+        self.monitor.stop()
+        self.assertFalse(self.monitor.loop.running)
+
+    def test_unsupported_platform(self):
+        self.results.append(None)
+        self.assertFalse(self.monitor.start())
+        self.assertFalse(self.monitor.loop.running)
+
+    def test_admin_stats(self):
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+        self.results.append((512, 12))
+        self.clock.advance(10)
+        cp = ConfigParser({ 'default_dns_policy': 'nxdomain' })
+        cp.generate_config_objects()
+        admin = AdminController(DNSHandler(cp), udp_monitor=self.monitor)
+        stats = admin.execute('stats')
+        self.assertIn('udp_receive_queue 512', stats)
+        self.assertIn('udp_drops 5', stats)
+
+
+class ListeningInfoConfigTester(unittest.TestCase):
+    def test_validate(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 } }
+        listening_info = { 'ip': '127.0.0.1', 'port': 53 }
+        cp = ConfigParser(dict(base, listening_info=dict(listening_info,
+                                                         receive_buffer=1 << 20,
+                                                         max_read_bytes=65536,
+                                                         drop_check_interval=0.5)))
+        cp.validate_config()
+        for key, value in [('receive_buffer', 0), ('send_buffer', '1M'),
+                           ('max_read_bytes', -1), ('drop_check_interval', 0),
+                           ('drop_check_interval', 'often')]:
+            cp = ConfigParser(dict(base, listening_info=dict(listening_info,
+                                                             **{ key: value })))
+            self.assertRaises(RuntimeError, cp.validate_config)
@@ -0,0 +1,317 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.names import dns, error
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser, parseUpstream
+from core.main import DNSHandler
+from core.upstream import HedgedResolver, RTTEstimator, Upstream, \
+                          UpstreamPool, UpstreamUnavailable
+
+
+class ResolverStub(object):
+    def __init__(self):
+        self.pending = []
+        self.timeouts = []
+
+    def query(self, query, timeout=None):
+        d = defer.Deferred()
+        self.pending.append(d)
+        self.timeouts.append(timeout)
+        return d
+
+
+class RTTEstimatorTester(unittest.TestCase):
+    def test_first_sample(self):
+        rtt = RTTEstimator(min_timeout=0.001)
+        rtt.addSample(0.002)
+        self.assertAlmostEqual(0.002, rtt.srtt)
+        self.assertAlmostEqual(0.001, rtt.rttvar)
+        self.assertAlmostEqual(0.006, rtt.rto)
+
+    def test_min_timeout(self):
+        rtt = RTTEstimator(min_timeout=0.02)
+        for i in range(10):
+            rtt.addSample(0.002)
+        self.assertAlmostEqual(0.02, rtt.rto)
+
+    def test_max_timeout(self):
+        rtt = RTTEstimator(max_timeout=3)
+        rtt.addSample(10)
+        self.assertAlmostEqual(3, rtt.rto)
+
+    def test_timeouts_back_off_until_deadline(self):
+        rtt = RTTEstimator(initial_timeout=0.1, max_timeout=0.5)
+        timeouts = rtt.getTimeouts(2)
+        self.assertEqual((0.1, 0.2, 0.4, 0.5, 0.5), timeouts[:5])
+        self.assertAlmostEqual(2, sum(timeouts))
+
+
+class UpstreamTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = ResolverStub()
+
+    def _getUpstream(self, **settings):
+        settings.update({'ip': '127.0.0.1', 'port': 53})
+        upstream = Upstream(settings, clock=self.clock)
+        upstream.resolver = self.stub
+        return upstream
+
+    def test_default_timeouts_limited_by_deadline(self):
+        upstream = self._getUpstream(query_deadline=5)
+        self.assertEqual((1, 3, 1), upstream.getTimeouts())
+        upstream = self._getUpstream()
+        self.assertEqual((1, 3, 11, 45), upstream.getTimeouts())
+
+    def test_adaptive_timeouts_follow_rtt(self):
+        upstream = self._getUpstream(adaptive_timeout=True, query_deadline=1)
+        for i in range(5):
+            upstream.query(Query('foobar.com'))
+            self.clock.advance(0.002)
+            self.stub.pending.pop().callback(([], [], []))
+        upstream.query(Query('foobar.com'))
+        self.assertAlmostEqual(0.02, self.stub.timeouts[-1][0])
+        self.assertAlmostEqual(1, sum(self.stub.timeouts[-1]))
+
+    def test_retransmitted_answer_not_measured(self):
+        upstream = self._getUpstream(adaptive_timeout=True)
+        upstream.query(Query('foobar.com'))
+        self.clock.advance(2)
+        self.stub.pending.pop().callback(([], [], []))
+        self.assertEqual(None, upstream.rtt.srtt)
+
+    def test_timeout_not_measured(self):
+        upstream = self._getUpstream(adaptive_timeout=True)
+        d = upstream.query(Query('foobar.com'))
+        self.clock.advance(0.5)
+        self.stub.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+        self.assertEqual(None, upstream.rtt.srtt)
+        return self.assertFailure(d, dns.DNSQueryTimeoutError)
+
+
+class UpstreamHealthTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = ResolverStub()
+        self.upstream = Upstream({ 'ip': '127.0.0.1', 'port': 53,
+                                   'max_failures': 2, 'retry_interval': 10 },
+                                 clock=self.clock)
+        self.upstream.resolver = self.stub
+
+    def _fail(self):
+        d = self.upstream.query(Query('foobar.com'))
+        d.addErrback(lambda f: None)
+        self.stub.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+
+    def test_down_after_max_failures(self):
+        self._fail()
+        self.assertTrue(self.upstream.isHealthy())
+        self._fail()
+        self.assertFalse(self.upstream.isHealthy())
+        d = self.upstream.query(Query('foobar.com'))
+        self.assertEqual([], self.stub.pending)
+        self.failureResultOf(d, UpstreamUnavailable)
+
+    def test_retry_after_interval(self):
+        self._fail()
+        self._fail()
+        self.clock.advance(10)
+        self.assertTrue(self.upstream.isHealthy())
+        self.upstream.query(Query('foobar.com'))
+        self.stub.pending.pop().callback(([], [], []))
+        self.assertEqual(0, self.upstream.failures)
+        self.assertTrue(self.upstream.isHealthy())
+
+    def test_nxdomain_is_healthy(self):
+        for i in range(3):
+            d = self.upstream.query(Query('foobar.com'))
+            d.addErrback(lambda f: None)
+            self.stub.pending.pop().errback(dns.DomainError())
+        self.assertTrue(self.upstream.isHealthy())
+
+
+class UpstreamPoolTester(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual({'ip': '10.0.0.53', 'port': 53}, parseUpstream('10.0.0.53'))
+        self.assertEqual({'ip': '10.0.0.53', 'port': 5353},
+                         parseUpstream('10.0.0.53:5353'))
+        self.assertEqual({'ip': '::1', 'port': 53}, parseUpstream('::1'))
+        self.assertEqual({'ip': '::1', 'port': 5353}, parseUpstream('[::1]:5353'))
+        self.assertEqual({'ip': '::1', 'port': 53, 'max_failures': 3},
+                         parseUpstream({'ip': '::1', 'max_failures': 3}))
+        self.assertRaises(RuntimeError, parseUpstream, '10.0.0.53:dns')
+
+    def test_shared_instances(self):
+        pool = UpstreamPool(clock=task.Clock())
+        a = pool.get({'ip': '10.0.0.53', 'port': 53})
+        self.assertIs(a, pool.get({'ip': '10.0.0.53', 'port': 53}))
+        self.assertIsNot(a, pool.get({'ip': '10.0.0.54', 'port': 53}))
+        self.assertEqual(2, len(pool))
+        self.assertRaises(RuntimeError, pool.get,
+                          {'ip': '10.0.0.53', 'port': 53, 'max_failures': 1})
+
+
+class ConditionalForwardingTester(unittest.TestCase):
+    def _getHandler(self, rule):
+        config = { 'default_dns_policy': 'default_value',
+                   'default_dns_value': '1.2.3.4',
+                   'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                   'domain_config': {
+                       '*.corp.example': rule,
+                       'other.corp.example': { 'forward': '10.0.0.53:53' },
+                       'ext.example': 'forward',
+                   }
+                 }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        cp.validate_domain_upstreams(cp['domain_config'])
+        return DNSHandler(cp, clock=task.Clock())
+
+    def test_rule_upstream(self):
+        handler = self._getHandler({ 'forward': '10.0.0.53' })
+        self.assertEqual(1, len(handler.upstreams))
+        upstream = handler.getResolverForQuery(Query('a.corp.example'))
+        self.assertEqual(('10.0.0.53', 53), (upstream.ip, upstream.port))
+        self.assertIs(upstream, handler.getResolverForQuery(Query('other.corp.example')))
+        self.assertIs(handler.resolver, handler.getResolverForQuery(Query('ext.example')))
+        self.assertEqual('forward', handler.get_action_for_query(Query('a.corp.example')))
+
+        stub = ResolverStub()
+        upstream.resolver = stub
+        handler.query(Query('a.corp.example'))
+        self.assertEqual(1, len(stub.pending))
+
+    def test_fallback_when_down(self):
+        handler = self._getHandler({ 'forward': { 'ip': '10.0.0.54',
+                                                  'max_failures': 1,
+                                                  'fallback': True } })
+        upstream = handler.getResolverForQuery(Query('a.corp.example'))
+        upstream.down_until = handler.clock.seconds() + 10
+        self.assertIs(handler.resolver, handler.getResolverForQuery(Query('a.corp.example')))
+
+    def test_fallback_is_per_rule(self):
+        handler = self._getHandler({ 'forward': { 'ip': '10.0.0.53',
+                                                  'fallback': True } })
+        self.assertEqual(1, len(handler.upstreams))
+        upstream = handler.getResolverForQuery(Query('a.corp.example'))
+        upstream.down_until = handler.clock.seconds() + 10
+        self.assertIs(handler.resolver, handler.getResolverForQuery(Query('a.corp.example')))
+        self.assertFalse(handler.config['domain_config']['other.corp.example'].fallback)
+        plain = handler.config.getPlainConfig()
+        self.assertEqual({ 'forward': { 'ip': '10.0.0.53', 'port': 53,
+                                        'fallback': True } },
+                         plain['domain_config']['*.corp.example'])
+        self.assertRaises(RuntimeError, self._getHandler,
+                          { 'forward': { 'ip': '10.0.0.54', 'fallback': 'yes' } })
+
+    def test_conflicting_settings(self):
+        self.assertRaises(RuntimeError, self._getHandler,
+                          { 'forward': { 'ip': '10.0.0.53', 'max_failures': 1 } })
+
+    def test_round_trip(self):
+        handler = self._getHandler({ 'forward': '10.0.0.53' })
+        plain = handler.config.getPlainConfig()
+        self.assertEqual({ 'forward': { 'ip': '10.0.0.53', 'port': 53 } },
+                         plain['domain_config']['*.corp.example'])
+
+
+class HedgedResolverTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.primary_stub = ResolverStub()
+        self.secondary_stub = ResolverStub()
+        self.primary = self._getUpstream('127.0.0.1', self.primary_stub)
+        self.secondary = self._getUpstream('127.0.0.2', self.secondary_stub)
+
+    def _getUpstream(self, ip, stub):
+        upstream = Upstream({'ip': ip, 'port': 53}, clock=self.clock)
+        upstream.resolver = stub
+        return upstream
+
+    def _getResolver(self, **settings):
+        settings.setdefault('budget', 1)
+        return HedgedResolver(self.primary, [self.secondary], settings,
+                              clock=self.clock)
+
+    def _collect(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_primary_answers_in_time(self):
+        resolver = self._getResolver(max_delay=0.1)
+        results = self._collect(resolver.query(Query('foobar.com')))
+        self.primary_stub.pending.pop().callback(([], [], []))
+        self.clock.advance(1)
+        self.assertEqual([([], [], [])], results)
+        self.assertEqual([], self.secondary_stub.pending)
+        self.assertEqual(0, resolver.hedged)
+
+    def test_secondary_wins(self):
+        resolver = self._getResolver(max_delay=0.1)
+        results = self._collect(resolver.query(Query('foobar.com')))
+        self.clock.advance(0.1)
+        self.assertEqual(1, len(self.secondary_stub.pending))
+        self.secondary_stub.pending.pop().callback(([], [], []))
+        self.assertEqual([([], [], [])], results)
+        self.assertEqual(1, resolver.hedge_wins)
+        # we no longer wait for the primary query
+        self.assertEqual(True, self.primary_stub.pending[0].called)
+
+    def test_hedge_delay_from_percentile(self):
+        resolver = self._getResolver(delay_percentile=50, min_delay=0.001)
+        for rtt in [0.01, 0.02, 0.03]:
+            self.primary.query(Query('foobar.com'))
+            self.clock.advance(rtt)
+            self.primary_stub.pending.pop().callback(([], [], []))
+        self.assertAlmostEqual(0.02, resolver.getHedgeDelay())
+
+    def test_budget_limits_hedging(self):
+        resolver = self._getResolver(budget=0.5, max_delay=0.1)
+        resolver.query(Query('foobar.com'))
+        self.clock.advance(0.1)
+        self.assertEqual(0, len(self.secondary_stub.pending))
+        resolver.query(Query('foobar.com'))
+        self.clock.advance(0.1)
+        self.assertEqual(1, len(self.secondary_stub.pending))
+
+    def test_primary_failure_hedges_immediately(self):
+        resolver = self._getResolver(max_delay=1)
+        results = self._collect(resolver.query(Query('foobar.com')))
+        self.primary_stub.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+        self.assertEqual(1, len(self.secondary_stub.pending))
+        self.secondary_stub.pending.pop().callback(([], [], []))
+        self.assertEqual([([], [], [])], results)
+
+    def test_nxdomain_is_final(self):
+        resolver = self._getResolver(max_delay=0.1)
+        for _ in range(5):
+            d = resolver.query(Query('unknown.com'))
+            self.primary_stub.pending.pop().errback(error.DNSNameError())
+            self.assertFailure(d, error.DNSNameError)
+        self.clock.advance(1)
+        self.assertEqual([], self.secondary_stub.pending)
+        self.assertEqual(0, resolver.hedged)
+
+    def test_nxdomain_while_hedging(self):
+        resolver = self._getResolver(max_delay=0.1)
+        d = resolver.query(Query('unknown.com'))
+        self.clock.advance(0.1)
+        self.assertEqual(1, resolver.hedged)
+        self.primary_stub.pending.pop().errback(error.DNSNameError())
+        self.assertEqual(True, self.secondary_stub.pending[0].called)
+        return self.assertFailure(d, error.DNSNameError)
+
+    def test_all_upstreams_fail(self):
+        resolver = self._getResolver(max_delay=0.1)
+        d = resolver.query(Query('foobar.com'))
+        self.clock.advance(0.1)
+        self.primary_stub.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+        self.secondary_stub.pending.pop().errback(dns.DNSQueryTimeoutError(None))
+        return self.assertFailure(d, dns.DNSQueryTimeoutError)
@@ -0,0 +1,146 @@
+from twisted.trial import unittest
+from twisted.names import dns
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.harness import Harness
+from core.main import DNSHandler
+from core.prefixtree import PrefixTree
+
+
+class PrefixTreeTester(unittest.TestCase):
+    def setUp(self):
+        self.tree = PrefixTree()
+        self.tree.insert('10.0.0.0/8', 'a')
+        self.tree.insert('10.1.0.0/16', 'b')
+        self.tree.insert('10.1.2.3/32', 'c')
+        self.tree.insert('fd00::/8', 'd')
+
+    def test_longest_match(self):
+        self.assertEqual('a', self.tree.lookup('10.2.0.1'))
+        self.assertEqual('b', self.tree.lookup('10.1.2.4'))
+        self.assertEqual('c', self.tree.lookup('10.1.2.3'))
+        self.assertEqual('d', self.tree.lookup('fd00::1'))
+
+    def test_no_match(self):
+        self.assertEqual(None, self.tree.lookup('192.168.0.1'))
+        self.assertEqual('x', self.tree.lookup('fe80::1', 'x'))
+
+    def test_ipv4_mapped_address(self):
+        self.assertEqual('b', self.tree.lookup('::ffff:10.1.0.1'))
+
+    def test_scoped_address(self):
+        self.assertEqual('d', self.tree.lookup('fd00::1%eth0'))
+        self.assertEqual('x', self.tree.lookup('fe80::1%eth0', 'x'))
+
+    def test_default_route(self):
+        self.tree.insert('0.0.0.0/0', 'default')
+        self.assertEqual('default', self.tree.lookup('192.168.0.1'))
+        self.assertEqual(None, self.tree.lookup('2001:db8::1'))
+
+    def test_remove(self):
+        self.tree.remove('10.1.0.0/16')
+        self.assertEqual('a', self.tree.lookup('10.1.2.4'))
+        self.assertEqual('c', self.tree.lookup('10.1.2.3'))
+        self.assertEqual(3, len(self.tree))
+        with self.assertRaises(KeyError):
+            self.tree.remove('10.1.0.0/16')
+
+
+class ViewsTester(unittest.TestCase):
+    def setUp(self):
+        config = {
+            'default_dns_policy': 'nxdomain',
+            'default_dns_value': '1.1.1.1',
+            'domain_config': { 'foobar.com': '1.2.3.4' },
+            'views': [
+                { 'name': 'lab1',
+                  'clients': [ '10.1.0.0/16' ],
+                  'default_dns_policy': 'default_value' },
+                { 'name': 'lab2',
+                  'clients': [ '10.2.0.0/16', 'fd00::/8' ],
+                  'domain_config': { 'foobar.com': '5.6.7.8' } },
+            ]
+        }
+        cp = ConfigParser(config)
+        cp.generate_config_objects()
+        self.handler = DNSHandler(cp)
+
+    def _answer(self, name, client):
+        query = Query(name)
+        action = self.handler.get_action_for_query(query, (client, 53))
+        answers, _, _ = self.handler.generateReply(action, query, (client, 53))
+        return [a.payload.dottedQuad() for a in answers]
+
+    def test_global_config_without_view(self):
+        self.assertEqual(['1.2.3.4'], self._answer('foobar.com', '192.168.0.1'))
+        self.assertEqual([], self._answer('other.com', '192.168.0.1'))
+
+    def test_view_inherits_domain_config(self):
+        self.assertEqual(['1.2.3.4'], self._answer('foobar.com', '10.1.0.1'))
+        self.assertEqual(['1.1.1.1'], self._answer('other.com', '10.1.0.1'))
+
+    def test_view_domain_config(self):
+        self.assertEqual(['5.6.7.8'], self._answer('foobar.com', '10.2.0.1'))
+        self.assertEqual(['5.6.7.8'], self._answer('foobar.com', 'fd00::5'))
+        self.assertEqual([], self._answer('other.com', '10.2.0.1'))
+
+    def test_scoped_client_address(self):
+        self.assertEqual(['5.6.7.8'], self._answer('foobar.com', 'fd00::5%eth0'))
+        self.assertEqual(['1.2.3.4'], self._answer('foobar.com', 'fe80::1%eth0'))
+
+
+class ViewsForwardCacheTester(unittest.TestCase):
+    def test_rule_upstream_answers_are_not_cached(self):
+        harness = Harness({
+            'default_dns_policy': 'forward',
+            'dns_server': { 'ip': '192.0.2.53', 'port': 53 },
+            'forward_cache': { 'max_entries': 10 },
+            'views': [
+                { 'name': 'lab',
+                  'clients': [ '10.2.0.0/16' ],
+                  'domain_config': { 'internal.com': { 'forward': '10.9.9.9' } } },
+            ]
+        })
+        harness.upstream.setAnswer('internal.com', dns.A,
+                                   [dns.RRHeader(name='internal.com', ttl=60,
+                                                 payload=dns.Record_A('10.2.3.4'))])
+        harness.query('internal.com', address=('10.2.0.1', 5353))
+        self.assertEqual(0, len(harness.dns_handler.forward_cache))
+        # other clients do not get the answer of the upstream of the view
+        harness.query('internal.com')
+        self.assertEqual(2, len(harness.upstream.queries))
+        harness.query('internal.com')
+        self.assertEqual(2, len(harness.upstream.queries))
+
+
+class ViewsConfigTester(unittest.TestCase):
+    def _validate(self, views):
+        cp = ConfigParser({})
+        cp['dns_server' ] = {'ip': '127.0.0.1', 'port': 53}
+        cp['listening_info'] = {'ip': '127.0.0.1', 'port': 53}
+        cp['default_dns_policy'] = 'forward'
+        cp['views'] = views
+        cp.validate_config()
+
+    def test_valid_views(self):
+        self._validate([{ 'name': 'a', 'clients': [ '10.0.0.0/8' ] }])
+
+    def test_invalid_network(self):
+        with self.assertRaises(RuntimeError):
+            self._validate([{ 'name': 'a', 'clients': [ '10.0.0.0/33' ] }])
+
+    def test_duplicate_network(self):
+        with self.assertRaises(RuntimeError):
+            self._validate([{ 'name': 'a', 'clients': [ '10.0.0.0/8' ] },
+                            { 'name': 'b', 'clients': [ '10.0.0.0/8' ] }])
+
+    def test_missing_default_value(self):
+        with self.assertRaises(RuntimeError):
+            self._validate([{ 'name': 'a', 'clients': [ '10.0.0.0/8' ],
+                              'default_dns_policy': 'default_value' }])
@@ -0,0 +1,156 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+import gc
+import sys
+import os
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.admin import AdminController
+from core.config import ConfigParser
+from core.main import DNSHandler
+from core.watchdog import LagHistogram, ReactorWatchdog
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LagHistogramTester(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = LagHistogram()
+        for lag in [0.0005, 0.003, 0.003, 0.7, 10]:
+            histogram.record(lag)
+        stats = dict(histogram.getStats())
+        self.assertEqual(1, stats['loop_lag_le_1ms'])
+        self.assertEqual(1, stats['loop_lag_le_2ms'])
+        self.assertEqual(3, stats['loop_lag_le_5ms'])
+        self.assertEqual(3, stats['loop_lag_le_500ms'])
+        self.assertEqual(4, stats['loop_lag_le_5000ms'])
+        self.assertEqual(5, stats['loop_lag_count'])
+        self.assertEqual(10000, stats['loop_lag_max_ms'])
+
+
+class ReactorWatchdogTester(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timer = FakeTimer()
+        self.watchdog = ReactorWatchdog({ 'interval': 0.1, 'threshold': 0.5 },
+                                        clock=self.clock, timer=self.timer)
+        self.watchdog.start(monitor=False)
+        self.addCleanup(self.watchdog.stop)
+
+    def advance(self, seconds):
+        self.timer.now += seconds
+        self.clock.advance(seconds)
+
+    def test_lag_is_recorded(self):
+        self.advance(0.1)
+        self.timer.now += 0.12
+        self.clock.advance(0.1)
+        stats = dict(self.watchdog.getStats())
+        self.assertEqual(2, stats['loop_lag_count'])
+        self.assertEqual(1, stats['loop_lag_le_1ms'])
+        self.assertEqual(20, stats['loop_lag_max_ms'])
+        self.assertEqual(0, stats['stalls'])
+
+    def test_stall_with_stack(self):
+        self.advance(0.1)
+        # the reactor is blocked for a second
+        self.timer.now += 0.3
+        self.watchdog.checkStall(self.timer.now)
+        self.assertIsNone(self.watchdog.pending)
+        self.timer.now += 0.7
+        self.watchdog.checkStall(self.timer.now)
+        self.assertIsNotNone(self.watchdog.pending)
+        pending = self.watchdog.pending
+        self.timer.now += 0.5
+        # a stall is captured only once
+        self.watchdog.checkStall(self.timer.now)
+        self.assertIs(pending, self.watchdog.pending)
+        self.clock.advance(0.1)
+        self.assertEqual(1, self.watchdog.stall_count)
+        stall = self.watchdog.stalls[0]
+        self.assertAlmostEqual(1.4, stall.duration)
+        # the test itself runs in the thread the watchdog was started in
+        self.assertIn('test_stall_with_stack', ''.join(stall.stack))
+        message = self.watchdog.getStallMessages()[0]
+        self.assertTrue(message.startswith('Reactor stalled for 1400 ms, at:'))
+
+    def test_stall_missed_by_monitor(self):
+        self.timer.now += 0.8
+        self.clock.advance(0.1)
+        self.assertEqual(1, self.watchdog.stall_count)
+        self.assertEqual(['Reactor stalled for 700 ms, no stack captured'],
+                         self.watchdog.getStallMessages())
+
+    def test_gc_time_is_attributed(self):
+        self.advance(0.1)
+        self.watchdog.gcCallback('start', {})
+        self.timer.now += 0.7
+        self.watchdog.checkStall(self.timer.now)
+        self.assertTrue(self.watchdog.pending.in_gc)
+        self.watchdog.gcCallback('stop', {})
+        self.timer.now += 0.1
+        self.clock.advance(0.1)
+        message = self.watchdog.getStallMessages()[0]
+        self.assertTrue(message.startswith('Reactor stalled for 700 ms, 700 ms '
+                                           'of it in garbage collection, in '
+                                           'garbage collection called at:'))
+
+    def test_stop_removes_gc_callback(self):
+        self.assertIn(self.watchdog.gcCallback, gc.callbacks)
+        self.watchdog.stop()
+        self.assertNotIn(self.watchdog.gcCallback, gc.callbacks)
+        self.assertFalse(self.watchdog.loop.running)
+
+
+class MonitorThreadTester(unittest.TestCase):
+    def test_monitor_captures_blocked_thread(self):
+        watchdog = ReactorWatchdog({ 'interval': 0.01, 'threshold': 0.05 },
+                                   clock=task.Clock())
+        watchdog.start()
+        self.addCleanup(watchdog.stop)
+        deadline = time.monotonic() + 5
+        while watchdog.pending is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(watchdog.pending)
+        self.assertIn('test_monitor_captures_blocked_thread',
+                      ''.join(watchdog.pending.stack))
+
+
+class WatchdogAdminTester(unittest.TestCase):
+    def test_stats_and_stalls(self):
+        cp = ConfigParser({ 'default_dns_policy': 'forward',
+                            'dns_server': { 'ip': '127.0.0.1', 'port': 53 } })
+        cp.generate_config_objects()
+        timer = FakeTimer()
+        clock = task.Clock()
+        watchdog = ReactorWatchdog({}, clock=clock, timer=timer)
+        watchdog.start(monitor=False)
+        self.addCleanup(watchdog.stop)
+        admin = AdminController(DNSHandler(cp), watchdog=watchdog)
+        timer.now += 0.7
+        clock.advance(0.1)
+        self.assertIn('stalls 1', admin.execute('stats'))
+        self.assertEqual(['Reactor stalled for 600 ms, no stack captured'],
+                         admin.execute('stalls'))
+        self.assertRaises(RuntimeError, AdminController(DNSHandler(cp)).execute,
+                          'stalls')
+
+    def test_validate_config(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                 'listening_info': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(dict(base, watchdog={ 'interval': 0.05,
+                                                'threshold': 0.2 }))
+        cp.validate_config()
+        for settings in [[], { 'interval': 0 }, { 'threshold': 'x' },
+                         { 'max_stalls': 0 }]:
+            cp = ConfigParser(dict(base, watchdog=settings))
+            self.assertRaises(RuntimeError, cp.validate_config)
@@ -0,0 +1,266 @@
+from twisted.trial import unittest
+from twisted.names import dns
+
+import sys
+import os
+import shutil
+import tempfile
+import textwrap
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.names.dns import Query
+
+from core.config import ConfigParser
+from core.harness import Harness
+from core.main import CustomDNSServerFactory, DNSHandler
+from core.zones import ZoneNameError, ZoneParser, ZoneStore, parseTTL
+
+
+ZONE = """\
+$ORIGIN lab.example.
+$TTL 1h
+@       IN SOA ns1 hostmaster (
+                2024010101 ; serial
+                3600 900 1w 300 )
+        IN NS  ns1
+        IN MX  10 mail
+ns1     IN A   10.0.0.53
+mail    300 IN A 10.0.0.25
+www     CNAME  web.lab.example.
+web     A      10.0.0.80
+        AAAA   fd00::80
+txt     TXT    "hello world" "a \\"quoted\\" string"
+_sip._udp SRV  10 60 5060 sip
+sip     A      10.0.0.5
+a.b.deep A     10.0.0.7
+*.dyn   A      10.9.9.9
+child   NS     ns.child
+ns.child A     10.0.2.53
+; a comment line
+
+$ORIGIN sub.lab.example.
+host    A      10.0.1.1
+"""
+
+
+class ProtocolStub(object):
+    def __init__(self):
+        self.sent = []
+
+    def writeMessage(self, message, address):
+        self.sent.append(message)
+
+
+class ZoneFileTester(unittest.TestCase):
+    def writeFile(self, content, name='zone'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(content))
+        return path
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.zone = ZoneParser(self.writeFile(ZONE)).parse()
+
+    def lookup(self, name, qtype=dns.A):
+        return self.zone.lookup(name, qtype)
+
+    def test_parse(self):
+        self.assertEqual('lab.example', self.zone.origin)
+        soa = self.zone.soa.payload
+        self.assertEqual(b'ns1.lab.example', soa.mname.name)
+        self.assertEqual(b'hostmaster.lab.example', soa.rname.name)
+        self.assertEqual(2024010101, soa.serial)
+        self.assertEqual(604800, soa.expire)
+        self.assertEqual(300, soa.minimum)
+        self.assertEqual(3600, self.zone.soa.ttl)
+        self.assertEqual(16, len(self.zone))
+
+    def test_answers(self):
+        ans, auth, add = self.lookup('ns1.lab.example')
+        self.assertEqual('10.0.0.53', ans[0].payload.dottedQuad())
+        self.assertTrue(ans[0].auth)
+        self.assertEqual(([], []), (auth, add))
+        ans, _, _ = self.lookup('mail.lab.example')
+        self.assertEqual(300, ans[0].ttl)
+        ans, _, _ = self.lookup('lab.example', dns.MX)
+        self.assertEqual(b'mail.lab.example', ans[0].payload.name.name)
+        ans, _, _ = self.lookup('txt.lab.example', dns.TXT)
+        self.assertEqual([b'hello world', b'a "quoted" string'], ans[0].payload.data)
+        ans, _, _ = self.lookup('_sip._udp.lab.example', dns.SRV)
+        self.assertEqual(5060, ans[0].payload.port)
+        ans, _, _ = self.lookup('host.sub.lab.example')
+        self.assertEqual('10.0.1.1', ans[0].payload.dottedQuad())
+
+    def test_blank_owner_and_all_records(self):
+        ans, _, _ = self.lookup('web.lab.example', dns.ALL_RECORDS)
+        self.assertEqual([dns.A, dns.AAAA], [r.type for r in ans])
+
+    def test_cname_is_followed(self):
+        ans, _, _ = self.lookup('www.lab.example')
+        self.assertEqual([dns.CNAME, dns.A], [r.type for r in ans])
+        self.assertEqual(b'web.lab.example', ans[1].name.name)
+        ans, _, _ = self.lookup('www.lab.example', dns.CNAME)
+        self.assertEqual([dns.CNAME], [r.type for r in ans])
+        # the zone itself is not changed by following the CNAME
+        ans, _, _ = self.lookup('www.lab.example')
+        self.assertEqual(2, len(ans))
+
+    def test_nodata(self):
+        self.assertEqual(([], [self.zone.soa], []),
+                         self.lookup('ns1.lab.example', dns.AAAA))
+        # empty non-terminals exist
+        self.assertEqual(([], [self.zone.soa], []), self.lookup('b.deep.lab.example'))
+
+    def test_nxdomain(self):
+        for name in ['nothere.lab.example', 'x.web.lab.example']:
+            e = self.assertRaises(ZoneNameError, self.lookup, name)
+            self.assertEqual([self.zone.soa], e.authority)
+
+    def test_wildcard(self):
+        ans, _, _ = self.lookup('anything.dyn.lab.example')
+        self.assertEqual(b'anything.dyn.lab.example', ans[0].name.name)
+        self.assertEqual('10.9.9.9', ans[0].payload.dottedQuad())
+        ans, _, _ = self.lookup('a.b.dyn.lab.example')
+        self.assertEqual('10.9.9.9', ans[0].payload.dottedQuad())
+        self.assertEqual(([], [self.zone.soa], []),
+                         self.lookup('x.dyn.lab.example', dns.MX))
+        # the wildcard does not cover names below existing names
+        self.assertRaises(ZoneNameError, self.lookup, 'x.a.b.deep.lab.example')
+
+    def test_delegation(self):
+        for name in ['child.lab.example', 'www.child.lab.example',
+                     'ns.child.lab.example']:
+            ans, auth, add = self.lookup(name)
+            self.assertEqual([], ans)
+            self.assertEqual([(b'child.lab.example', b'ns.child.lab.example')],
+                             [(r.name.name, r.payload.name.name) for r in auth])
+            self.assertEqual(['10.0.2.53'], [r.payload.dottedQuad() for r in add])
+            self.assertFalse(any(r.auth for r in auth + add))
+
+    def test_include_and_origin_setting(self):
+        self.writeFile("""\
+            www  A  10.1.0.80
+            """, 'hosts.inc')
+        path = self.writeFile("""\
+            @ 60 SOA ns1 hostmaster 1 2 3 4 5
+            $INCLUDE hosts.inc
+            """, 'other.zone')
+        zone = ZoneParser(path, origin='other.example').parse()
+        self.assertEqual('other.example', zone.origin)
+        ans, _, _ = zone.lookup('www.other.example', dns.A)
+        self.assertEqual(60, ans[0].ttl)
+
+    def test_errors(self):
+        for content in ['www A 10.0.0.1\n',
+                        '@ SOA ns1 hostmaster 1 2 3 4 5\nwww A 10.0.0.300\n',
+                        '@ SOA ns1 hostmaster 1 2 3 4 5\nwww HINFO a b\n',
+                        '@ SOA ns1 hostmaster 1 2 3 4 5\nwww.other.example. A 1.2.3.4\n',
+                        '@ SOA ns1 hostmaster ( 1 2 3 4 5\n',
+                        '$FOO bar\n']:
+            path = self.writeFile(content, 'bad.zone')
+            self.assertRaises(RuntimeError,
+                              ZoneParser(path, origin='bad.example').parse)
+
+    def test_ttl_units(self):
+        self.assertEqual(5400, parseTTL('1h30m'))
+        self.assertEqual(86400, parseTTL('1D'))
+        self.assertRaises(ValueError, parseTTL, '1x')
+
+    def test_store_finds_longest_origin(self):
+        path = self.writeFile("""\
+            $ORIGIN sub.lab.example.
+            @ SOA ns1 hostmaster 1 2 3 4 5
+            """, 'sub.zone')
+        store = ZoneStore([self.zone, ZoneParser(path).parse()])
+        self.assertEqual('sub.lab.example',
+                         store.findZone('Host.Sub.lab.example.').origin)
+        self.assertEqual('lab.example', store.findZone('www.lab.example').origin)
+        self.assertEqual(None, store.findZone('example'))
+        self.assertRaises(RuntimeError, store.addZone, self.zone)
+
+
+class ZoneReplyTester(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'lab.zone')
+        with open(path, 'w') as f:
+            f.write(ZONE)
+        self.config = { 'default_dns_policy': 'default_value',
+                        'default_dns_value': '1.2.3.4',
+                        'zone_files': [path],
+                        'domain_config': { 'override.lab.example': 'nxdomain' } }
+        cp = ConfigParser(dict(self.config))
+        cp.generate_config_objects()
+        self.handler = DNSHandler(cp)
+        self.factory = CustomDNSServerFactory(clients=[self.handler])
+
+    def resolve(self, name, qtype=dns.A):
+        message = dns.Message(id=1)
+        message.timeReceived = 0
+        message.addQuery(name, qtype)
+        protocol = ProtocolStub()
+        self.factory.handleQuery(message, protocol, ('127.0.0.1', 1234))
+        return protocol.sent[0]
+
+    def test_actions(self):
+        self.assertEqual('zone', self.handler.get_action_for_query(
+                                    Query('web.lab.example')))
+        self.assertEqual('nxdomain', self.handler.get_action_for_query(
+                                        Query('override.lab.example')))
+        self.assertEqual('default_value', self.handler.get_action_for_query(
+                                             Query('foobar.com')))
+
+    def test_answer(self):
+        response = self.resolve('web.lab.example')
+        self.assertEqual(dns.OK, response.rCode)
+        self.assertTrue(response.auth)
+        self.assertEqual('10.0.0.80', response.answers[0].payload.dottedQuad())
+
+    def test_nodata(self):
+        response = self.resolve('ns1.lab.example', dns.AAAA)
+        self.assertEqual(dns.OK, response.rCode)
+        self.assertTrue(response.auth)
+        self.assertEqual([], response.answers)
+        self.assertEqual(dns.SOA, response.authority[0].type)
+
+    def test_referral(self):
+        response = self.resolve('www.child.lab.example')
+        self.assertEqual(dns.OK, response.rCode)
+        self.assertFalse(response.auth)
+        self.assertEqual([dns.NS], [r.type for r in response.authority])
+        self.assertEqual([dns.A], [r.type for r in response.additional])
+
+    def test_fast_path_flags(self):
+        harness = Harness(dict(self.config), fast_path=True)
+        response = harness.query('ns1.lab.example', dns.AAAA)
+        self.assertEqual((dns.OK, True), (response.rCode, response.auth))
+        response = harness.query('www.child.lab.example')
+        self.assertEqual((dns.OK, False), (response.rCode, response.auth))
+        self.assertEqual([dns.NS], [r.type for r in response.authority])
+        self.assertEqual(0, harness.dns_handler.nxdomain_answers)
+
+    def test_nxdomain(self):
+        response = self.resolve('nothere.lab.example')
+        self.assertEqual(dns.ENAME, response.rCode)
+        self.assertTrue(response.auth)
+        self.assertEqual(dns.SOA, response.authority[0].type)
+
+    def test_nxdomain_counted_once_on_fast_path(self):
+        harness = Harness(dict(self.config), fast_path=True)
+        self.assertEqual(dns.ENAME, harness.query('nothere.lab.example').rCode)
+        self.assertEqual(1, harness.dns_handler.nxdomain_answers)
+
+    def test_validate_config(self):
+        base = { 'default_dns_policy': 'forward',
+                 'dns_server': { 'ip': '127.0.0.1', 'port': 53 },
+                 'listening_info': { 'ip': '127.0.0.1', 'port': 53 } }
+        cp = ConfigParser(dict(base, zone_files=['a.zone', { 'file': 'b.zone',
+                                                             'origin': 'b' }]))
+        cp.validate_config()
+        for zone_files in ['a.zone', [1], [{ 'origin': 'b' }],
+                           [{ 'file': 'b.zone', 'origin': 1 }]]:
+            cp = ConfigParser(dict(base, zone_files=zone_files))
+            self.assertRaises(RuntimeError, cp.validate_config)